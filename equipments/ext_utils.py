@@ -1,14 +1,17 @@
 from django.utils.http import urlquote
 from rest_framework.response import Response
 from rest_framework import status
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, FileResponse
 from xlrd import xldate_as_tuple
+from django.apps import apps
 from django.db import connection
+from itertools import islice
+from openpyxl import load_workbook
 
 import os
 import re
+import tempfile
 import pandas as pd
-import numpy as np
 import datetime
 import time
 
@@ -141,46 +144,58 @@ def trans_float_ts(ts, infmt, outfmt):
         return ts
 
 
-def analysis_equipment_data(datas):
-    if not datas:
-        return []
-    df = pd.DataFrame(datas)
-    df = df[list(columns_map.keys())]
-    df.rename(columns=columns_map, inplace=True)
-    df['number'] = df['number'].fillna(1)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    ndf['manufacture_date'] = ndf['manufacture_date'].map(trans_type)
-    ndf['manufacture_date'] = ndf['manufacture_date'].apply(trans_float_ts, args=('%Y', '%Y'))
-    ndf['install_date'] = ndf['install_date'].apply(trans_float_ts, args=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S'))
-    # ndf['calibration_time'] = ndf['calibration_time'].apply(trans_float_ts, args=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'))
-    # ndf['recalibration_time'] = ndf['recalibration_time'].apply(trans_float_ts, args=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'))
-    ndf['name'] = ndf['name'].map(lambda x: re.sub(r'/r|/n|\n', '', x) if x else x)
-    ndf['serial_number'] = ndf['serial_number'].map(lambda x: re.sub(r' |/r|/n|\n', '', str(x)) if x else x)
-    ndf['deposit_position'] = ndf['deposit_position'].map(lambda x: re.sub(r' |/r|/n|\n', '', x) if x else x)
-    ndf['fixed_asset_code'] = ndf['fixed_asset_code'].map(lambda x: re.sub(r' |/r|/n|\n', '', str(x)) if x else x)
-
-    ndf['equipment_state'] = ndf['equipment_state'].map(lambda x: re.sub(r' |/r|/n|\n', '', x) if x else x)
-    ndf['equipment_state'] = ndf['equipment_state'].map(
-        lambda x: EQUIPMENT_STATES[x] if EQUIPMENT_STATES.get(x) else None)
-
-    ndf['fixed_asset_category'] = ndf['fixed_asset_category'].map(lambda x: re.sub(r'/r|/n|\n', '', x) if x else x)
-    ndf['fixed_asset_category'] = ndf['fixed_asset_category'].map(lambda x: str(x).strip() if x else x)
-    ndf['fixed_asset_category'] = ndf['fixed_asset_category'].map(
-        lambda x: FIXED_ASSET_CATEGORYS[x] if FIXED_ASSET_CATEGORYS.get(x) else None)
-
-    ndf['service_type'] = ndf['service_type'].map(lambda x: re.sub(r' |/r|/n|\n', '', x) if x else x)
-    ndf['service_type'] = ndf['service_type'].map(lambda x: service_type_map[x] if service_type_map.get(x) else None)
-
-    ndf['manage_type'] = ndf['manage_type'].map(lambda x: re.sub(r' |/r|/n|\n', '', x) if x else x)
-    ndf['manage_type'] = ndf['manage_type'].map(lambda x: manage_type_map[x] if manage_type_map.get(x) else None)
-    ndf['id'] = ndf['id'].map(lambda x: str(x).strip() if x else x)
-    ndf['name'] = ndf['name'].map(lambda x: x.strip() if x else x)
-    ndf['number'] = ndf['number'].map(lambda x: str(int(x)).strip() if x else x)
-    ndf['fixed_asset_code'] = ndf['fixed_asset_code'].map(lambda x: x.strip() if x else x)
-    ndf = ndf.replace({np.nan: None})
-    datas = ndf.to_dict('records')
-    return datas
+def to_text(x):
+    """文本列的值统一转为字符串, excel中的整数读出为int或float"""
+    if x is None or isinstance(x, str):
+        return x
+    if isinstance(x, float) and x.is_integer():
+        x = int(x)
+    return str(x)
+
+
+# 原样导入的文本列, 需先转为字符串, 避免同一列混有数字和文本
+EQUIPMENT_TEXT_COLUMNS = ['custodian', 'specification', 'performance', 'assort_material', 'manager',
+                          'application_specialist', 'manufacturer', 'origin_place']
+
+
+def strip_text(x, pattern=r' |/r|/n|\n'):
+    """去掉空格及换行符"""
+    return re.sub(pattern, '', str(x)) if x else x
+
+
+def clean_equipment_row(data):
+    """整理导入的一行设备信息"""
+    number = data['number'] if data['number'] is not None else 1
+    name = strip_text(data['name'], r'/r|/n|\n')
+    fixed_asset_code = strip_text(data['fixed_asset_code'])
+    fixed_asset_category = strip_text(data['fixed_asset_category'], r'/r|/n|\n')
+    fixed_asset_category = fixed_asset_category.strip() if fixed_asset_category else fixed_asset_category
+    return dict(
+        data,
+        **{column: to_text(data[column]) for column in EQUIPMENT_TEXT_COLUMNS},
+        id=str(data['id']).strip() if data['id'] else data['id'],
+        name=name.strip() if name else name,
+        number=str(int(number)).strip() if number else number,
+        serial_number=strip_text(data['serial_number']),
+        fixed_asset_code=fixed_asset_code.strip() if fixed_asset_code else fixed_asset_code,
+        fixed_asset_category=FIXED_ASSET_CATEGORYS.get(fixed_asset_category) or None,
+        equipment_state=EQUIPMENT_STATES.get(strip_text(data['equipment_state'])) or None,
+        service_type=service_type_map.get(strip_text(data['service_type'])) or None,
+        manage_type=manage_type_map.get(strip_text(data['manage_type'])) or None,
+        deposit_position=strip_text(data['deposit_position']),
+        install_date=to_text(trans_float_ts(data['install_date'], '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S')),
+        manufacture_date=trans_float_ts(trans_type(data['manufacture_date']), '%Y', '%Y'),
+    )
+
+
+def clean_equipment_id(x):
+    return strip_text(str(x).strip(), r'/r|/n|\n') if x else x
+
+
+def clean_date(x):
+    """excel中的日期转为date"""
+    x = trans_float_ts(x, '%Y-%m-%d', '%Y-%m-%d')
+    return datetime.datetime.strptime(x, '%Y-%m-%d').date() if x else x
 
 
 calibration_columns_map = {
@@ -192,22 +207,17 @@ calibration_columns_map = {
 }
 
 
-def analysis_calibration(datas):
-    if not datas:
-        return []
-    df = pd.DataFrame(datas)
-    df = df[list(calibration_columns_map.keys())]
-    df.rename(columns=calibration_columns_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    ndf['equipment_id'] = ndf['equipment_id'].map(lambda x: str(x).strip() if x else x)
-    ndf['equipment_id'] = ndf['equipment_id'].map(lambda x: re.sub(r'|/r|/n|\n', '', x) if x else x)
-    ndf['calibration_cycle'] = ndf['calibration_cycle'].map(lambda x: int(re.sub(r' |/r|/n|\n', '', str(x))) if x else x)
-    ndf['calibration_time'] = ndf['calibration_time'].apply(trans_float_ts, args=('%Y-%m-%d', '%Y-%m-%d'))
-    ndf['calibration_time'] = ndf['calibration_time'].map(lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date() if x else x)
-    ndf = ndf.replace({np.nan: None})
-    datas = ndf.to_dict('records')
-    return datas
+def clean_calibration_row(data):
+    """整理导入的一行校准规范"""
+    calibration_cycle = data['calibration_cycle']
+    return dict(
+        data,
+        equipment_id=clean_equipment_id(data['equipment_id']),
+        specification=to_text(data['specification']),
+        environment=to_text(data['environment']),
+        calibration_cycle=int(float(strip_text(calibration_cycle))) if calibration_cycle else calibration_cycle,
+        calibration_time=clean_date(data['calibration_time']),
+    )
 
 
 certificate_columns_map = {
@@ -217,20 +227,15 @@ certificate_columns_map = {
 }
 
 
-def analysis_certificate(datas):
-    if not datas:
-        return []
-    df = pd.DataFrame(datas)
-    df = df[list(certificate_columns_map.keys())]
-    df.rename(columns=certificate_columns_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    ndf['equipment_id'] = ndf['equipment_id'].map(lambda x: str(x).strip() if x else x)
-    ndf['equipment_id'] = ndf['equipment_id'].map(lambda x: re.sub(r'|/r|/n|\n', '', x) if x else x)
-    ndf['certificate_year'] = ndf['certificate_year'].map(lambda x: str(int(x)).strip() if x else '')
-    ndf = ndf.replace({np.nan: None})
-    datas = ndf.to_dict('records')
-    return datas
+def clean_certificate_row(data):
+    """整理导入的一行校准报告"""
+    certificate_year = data['certificate_year']
+    return dict(
+        data,
+        equipment_id=clean_equipment_id(data['equipment_id']),
+        certificate_year=str(int(certificate_year)).strip() if certificate_year else '',
+        certificate=to_text(data['certificate']),
+    )
 
 
 maintain_columns_map = {
@@ -240,21 +245,14 @@ maintain_columns_map = {
 }
 
 
-def analysis_maintain(datas):
-    if not datas:
-        return []
-    df = pd.DataFrame(datas)
-    df = df[list(maintain_columns_map.keys())]
-    df.rename(columns=maintain_columns_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    ndf['calibration_time'] = ndf['calibration_time'].apply(trans_float_ts, args=('%Y-%m-%d', '%Y-%m-%d'))
-    ndf['calibration_time'] = ndf['calibration_time'].map(lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date() if x else x)
-    ndf['recalibration_time'] = ndf['recalibration_time'].apply(trans_float_ts, args=('%Y-%m-%d', '%Y-%m-%d'))
-    ndf['recalibration_time'] = ndf['recalibration_time'].map(lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date() if x else x)
-    ndf = ndf.replace({np.nan: None})
-    datas = ndf.to_dict('records')
-    return datas
+def clean_maintain_row(data):
+    """整理导入的一行维护日期"""
+    return dict(
+        data,
+        equipment_id=clean_equipment_id(data['equipment_id']),
+        calibration_time=clean_date(data['calibration_time']),
+        recalibration_time=clean_date(data['recalibration_time']),
+    )
 
 
 def execute_batch_sql(sql, datas):
@@ -265,21 +263,168 @@ def execute_batch_sql(sql, datas):
     return res
 
 
+UPSERT_MAX_PARAMS = 2000  # SQL Server单条语句最多2100个参数, MERGE按此计算每批行数
+UPSERT_MAX_ROWS = 1000  # SQL Server的values最多1000行
+
+
+def get_column_types(table):
+    """按表名取各列的数据库类型, 找不到对应模型时返回空"""
+    for model in apps.get_models():
+        if model._meta.db_table == table:
+            return {field.column: field.db_type(connection) for field in model._meta.concrete_fields}
+    return {}
+
+
+def get_merge_sql(table, key_columns, insert_columns, update_columns, row_count):
+    """
+    SQL Server的values中同一列取各行中优先级最高的类型, 一列中同时有数字和文本时会按数字转换而报错
+    因此每个值都先cast为目标列的类型
+    """
+    qn = connection.ops.quote_name
+    column_types = get_column_types(table)
+    source_columns = ', '.join(qn(column) for column in insert_columns)
+    on_sql = ' and '.join('t.{0} = s.{0}'.format(qn(column)) for column in key_columns)
+    update_sql = ', '.join('{0} = s.{0}'.format(qn(column)) for column in update_columns)
+    insert_sql = ', '.join('s.{}'.format(qn(column)) for column in insert_columns)
+    row_sql = '({})'.format(', '.join('cast(%s as {})'.format(column_types[column]) if column_types.get(column)
+                                      else '%s' for column in insert_columns))
+    return """merge into {table} as t
+              using (values {values}) as s ({source_columns}) on {on_sql}
+              when matched then update set {update_sql}
+              when not matched then insert ({source_columns}) values ({insert_sql});""".format(
+        table=qn(table), values=', '.join([row_sql] * row_count), source_columns=source_columns,
+        on_sql=on_sql, update_sql=update_sql, insert_sql=insert_sql)
+
+
+def merge_rows(table, key_columns, insert_columns, update_columns, rows):
+    """SQL Server: 每批一条MERGE语句完成新增和更新"""
+    batch_size = min(max(UPSERT_MAX_PARAMS // len(insert_columns), 1), UPSERT_MAX_ROWS)
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            sql = get_merge_sql(table, key_columns, insert_columns, update_columns, len(batch))
+            cursor.execute(sql, [row[column] for row in batch for column in insert_columns])
+
+
+def get_exist_keys(table, key_columns, rows):
+    """一次查出rows中已存在的key, 按第一个key字段in查询"""
+    qn = connection.ops.quote_name
+    first_values = list({row[key_columns[0]] for row in rows})
+    exist_keys = set()
+    with connection.cursor() as cursor:
+        for values in iter_chunks(first_values):
+            cursor.execute('select {} from {} where {} in ({})'.format(
+                ', '.join(qn(column) for column in key_columns), qn(table), qn(key_columns[0]),
+                ', '.join(['%s'] * len(values))), values)
+            exist_keys.update(tuple(item) for item in cursor.fetchall())
+    return exist_keys
+
+
+def upsert_rows(table, key_columns, insert_columns, update_columns, rows):
+    """
+    按key_columns批量新增或更新, rows为包含insert_columns全部字段的dict列表, key相同的行以最后一行为准
+    已存在的记录只更新update_columns; SQL Server使用MERGE, 其他数据库先查出已存在的key再分别批量insert/update
+    需在调用方的事务中执行
+    """
+    rows = list({tuple(row[column] for column in key_columns): row for row in rows}.values())
+    if not rows:
+        return
+    if connection.vendor == 'microsoft':
+        merge_rows(table, key_columns, insert_columns, update_columns, rows)
+        return
+    qn = connection.ops.quote_name
+    exist_keys = get_exist_keys(table, key_columns, rows)
+    insert_ls = []
+    update_ls = []
+    for row in rows:
+        if tuple(row[column] for column in key_columns) in exist_keys:
+            update_ls.append([row[column] for column in update_columns + key_columns])
+        else:
+            insert_ls.append([row[column] for column in insert_columns])
+    insert_sql = 'insert into {}({}) values({})'.format(
+        qn(table), ', '.join(qn(column) for column in insert_columns), ', '.join(['%s'] * len(insert_columns)))
+    update_sql = 'update {} set {} where {}'.format(
+        qn(table), ', '.join('{} = %s'.format(qn(column)) for column in update_columns),
+        ' and '.join('{} = %s'.format(qn(column)) for column in key_columns))
+    execute_batch_sql(insert_sql, insert_ls)
+    execute_batch_sql(update_sql, update_ls)
+
+
 def create_suffix():
     ts = time.time()
     suffix = str(int(round(ts, 5) * 10**5))[:15]
     return suffix
 
 
-def create_excel_resp(file_path, filename):
-    with open(file_path, 'rb') as f:
-        result = f.read()
-    response = HttpResponse(result)
+EXCEL_SPOOL_SIZE = 10 * 1024 * 1024  # 导出文件超过该大小才转存到临时文件
+EXCEL_CHUNK_SIZE = 64 * 1024  # 分块返回的块大小
+
+
+def create_excel_buffer():
+    """导出excel用的缓冲区, 先写在内存中, 超过EXCEL_SPOOL_SIZE自动转存到临时文件, 关闭后自动删除"""
+    return tempfile.SpooledTemporaryFile(max_size=EXCEL_SPOOL_SIZE)
+
+
+def create_excel_resp(file, filename):
+    """
+    分块返回excel文件
+    file为文件路径(模板等固定文件), 或create_excel_buffer生成的缓冲区, 响应结束后文件会被关闭
+    """
+    if isinstance(file, str):
+        file = open(file, 'rb')
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    file.seek(0)
+    response = FileResponse(file)
+    response.block_size = EXCEL_CHUNK_SIZE
+    response['Content-Length'] = file_size
     response['Content-Type'] = 'application/vnd.ms-excel;charset=UTF-8'
     response['Content-Disposition'] = 'attachment;filename="' + urlquote(filename) + '.xlsx"'
     return response
 
 
+EXCEL_READ_CHUNK = 500  # 导入excel时每批交给写入的行数
+
+
+def iter_excel_rows(file, columns_map, sheet_name='Sheet1'):
+    """
+    以只读模式逐行读取excel, 按columns_map把表头转为字段名, 不会把整个sheet读入内存
+    file为文件路径或文件对象(如request.FILES中的上传文件)
+    返回(excel行号, 行数据)的生成器, 整行为空的行跳过, 缺少columns_map中的列时抛出ValueError
+    """
+    if isinstance(file, str):
+        # 传入文件对象, 上传文件保存的路径可能没有扩展名
+        with open(file, 'rb') as f:
+            yield from iter_excel_rows(f, columns_map, sheet_name)
+        return
+    file.seek(0)
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else None for cell in next(rows, ())]
+        missing = [column for column in columns_map if column not in header]
+        if missing:
+            raise ValueError('缺少列: {}'.format(', '.join(missing)))
+        indexes = [(header.index(column), field) for column, field in columns_map.items()]
+        for row_no, row in enumerate(rows, 2):
+            data = {field: row[index] if index < len(row) else None for index, field in indexes}
+            if all(value is None for value in data.values()):
+                continue
+            yield row_no, data
+    finally:
+        workbook.close()
+
+
+def iter_chunks(items, size=EXCEL_READ_CHUNK):
+    """把生成器按size分批, 每次只取出一批"""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def get_file_path(prefix, dir_name='report_files'):
     current_path = os.path.dirname(__file__)
     file_dir = os.path.join(current_path, dir_name)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from equipments.models import EquipmentBorrowRecord
+from task_tools.task_remind_return import get_remind_at
+
+
+class Command(BaseCommand):
+    help = '根据已批准未归还的借用记录重新计算下次提醒时间'
+
+    def handle(self, *args, **options):
+        queryset = EquipmentBorrowRecord.objects.filter(is_approval=1, is_return=0, is_delete=False).values_list(
+            'id', 'end_time', 'is_final_remind', 'is_overtime_remind')
+        total = 0
+        with transaction.atomic():
+            # 先清空其他记录的提醒时间, 再逐条计算需要提醒的记录
+            EquipmentBorrowRecord.objects.exclude(remind_at=None).update(remind_at=None)
+            for borrow_id, end_time, is_final_remind, is_overtime_remind in queryset:
+                remind_at = get_remind_at(end_time, is_final_remind, is_overtime_remind)
+                if remind_at:
+                    EquipmentBorrowRecord.objects.filter(id=borrow_id).update(remind_at=remind_at)
+                    total += 1
+        self.stdout.write('重建完成, 共{}条借用记录需要提醒'.format(total))
@@ -1,5 +1,6 @@
 from django.db import models
 from users.models import User, Section
+from utils.timedelta_utls import calculate_due_date
 
 
 class QuerySetManage(models.Manager):
@@ -210,6 +211,7 @@ class EquipmentDepreciationRecord(models.Model):
         db_table = 'equipment_depreciation_record'
         verbose_name = '资产折旧记录表'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def equipment_name(self):
@@ -252,6 +254,7 @@ class EquipmentBorrowRecord(models.Model):
     update_time = models.DateTimeField(verbose_name='更新时间', auto_now=True, auto_now_add=False)
     is_final_remind = models.BooleanField(default=False, verbose_name='是否已提醒临期')
     is_overtime_remind = models.BooleanField(default=False, verbose_name='是否已提醒超时')
+    remind_at = models.DateTimeField(verbose_name='下次提醒时间', null=True, db_index=True)
     is_return = models.IntegerField(default=0, verbose_name='是否已归还')  # 0 未归还，1 待确认，2 已归还
     return_position = models.CharField(max_length=100, verbose_name='归还位置', null=True)
     return_confirm_state = models.CharField(verbose_name='归还确认结果', max_length=20, choices=CONFIRM_STATE, null=True)
@@ -263,6 +266,7 @@ class EquipmentBorrowRecord(models.Model):
         db_table = 'equipment_borrow_record'
         verbose_name = '设备借用记录表'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def user_name(self):
@@ -327,6 +331,7 @@ class EquipmentReturnRecord(models.Model):
         db_table = 'equipment_return_record'
         verbose_name = '设备归还记录表'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def user_name(self):
@@ -422,8 +427,7 @@ class EquipmentCalibrationInfo(models.Model):
     environment = models.CharField(verbose_name='环境要求', max_length=100, null=True)
     calibration_cycle = models.IntegerField(verbose_name='校准周期(月)', default=12)
     calibration_time = models.DateField(verbose_name='校准日期', null=True)
-    recalibration_time = models.DateField(verbose_name='再校准日期', null=True)
-    due_date = models.CharField(verbose_name='到期日', max_length=50, null=True)
+    recalibration_time = models.DateField(verbose_name='再校准日期', null=True, db_index=True)
     state = models.CharField(verbose_name='校验状态', max_length=20, choices=STATE, null=True)
     remarks = models.TextField(verbose_name='备注', null=True)
     create_time = models.DateTimeField(verbose_name='添加时间', auto_now_add=True)
@@ -448,6 +452,14 @@ class EquipmentCalibrationInfo(models.Model):
         else:
             return None
 
+    @property
+    def due_date(self):
+        """到期日, 按再校准日期和当天日期计算"""
+        if self.recalibration_time:
+            return calculate_due_date(self.recalibration_time, 'calibration')
+        else:
+            return None
+
     @property
     def certificate_set(self):
         if self.equipment:
@@ -508,8 +520,7 @@ class EquipmentMaintenanceRecord(models.Model):
 class EquipmentMaintainInfo(models.Model):
     equipment = models.ForeignKey(Equipment, on_delete=models.CASCADE, verbose_name='设备')
     calibration_time = models.DateField(verbose_name='校准日期', null=True)
-    recalibration_time = models.DateField(verbose_name='再校准日期', null=True)
-    due_date = models.CharField(verbose_name='离PM-Y时间', max_length=50, null=True)
+    recalibration_time = models.DateField(verbose_name='再校准日期', null=True, db_index=True)
     pm_q1 = models.CharField(verbose_name='PM-Q1', max_length=20, null=True)
     pm_q2 = models.CharField(verbose_name='PM-Q2', max_length=20, null=True)
     pm_q3 = models.CharField(verbose_name='PM-Q3', max_length=20, null=True)
@@ -523,6 +534,14 @@ class EquipmentMaintainInfo(models.Model):
         verbose_name = '设备定期维护表'
         verbose_name_plural = verbose_name
 
+    @property
+    def due_date(self):
+        """离PM-Y时间, 按再校准日期和当天日期计算"""
+        if self.recalibration_time:
+            return calculate_due_date(self.recalibration_time, 'maintain')
+        else:
+            return None
+
     @property
     def equipment_name(self):
         if self.equipment:
@@ -1,3 +1,248 @@
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from openpyxl import Workbook
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-# Create your tests here.
+from equipments.ext_utils import iter_excel_rows, iter_chunks, calibration_columns_map, clean_calibration_row, \
+    upsert_rows, columns_map, clean_equipment_row, get_merge_sql
+from equipments.views import BorrowListGeneric, insert_certificate
+from equipments.models import Equipment, EquipmentCalibrationCertificate, EquipmentCalibrationInfo, \
+    EquipmentMaintainInfo, EquipmentBorrowRecord, Project
+from task_tools.task_refresh_calibration_state import refresh_calibration_state
+from task_tools.task_remind_return import RemindReturnTask, get_remind_at
+from unittest import mock
+from users.models import User
+
+import datetime
+import os
+import tempfile
+
+
+class ExcelRowsTest(SimpleTestCase):
+
+    def write_sheet(self, rows):
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = 'Sheet1'
+        for row in rows:
+            sheet.append(row)
+        fd, path = tempfile.mkstemp()  # 与上传文件一样没有扩展名
+        os.close(fd)
+        workbook.save(path)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_iter_rows(self):
+        path = self.write_sheet([
+            ['备注', 'ID', '校准规范', '环境要求', '校准周期(月)', '校准日期'],
+            ['a', ' E1 ', 's', 'e', 12, datetime.datetime(2022, 1, 5)],
+            [None, None, None, None, None, None],
+            ['b', 'E2', None, None, '6', None],
+        ])
+        rows = [(row_no, clean_calibration_row(data)) for row_no, data in
+                iter_excel_rows(path, calibration_columns_map)]
+        self.assertEqual([row_no for row_no, _ in rows], [2, 4])
+        self.assertEqual(rows[0][1], {'equipment_id': 'E1', 'specification': 's', 'environment': 'e',
+                                      'calibration_cycle': 12, 'calibration_time': datetime.date(2022, 1, 5)})
+        self.assertEqual(rows[1][1]['calibration_cycle'], 6)
+        self.assertFalse(rows[1][1]['calibration_time'])
+
+    def test_iter_rows_from_upload(self):
+        path = self.write_sheet([['ID', '校准规范', '环境要求', '校准周期(月)', '校准日期'], ['E1', 's', 'e', 3, None]])
+        with open(path, 'rb') as f:
+            upload = SimpleUploadedFile('calibration.xlsx', f.read())
+        rows = list(iter_excel_rows(upload, calibration_columns_map))
+        self.assertEqual([(row_no, data['equipment_id']) for row_no, data in rows], [(2, 'E1')])
+
+    def test_missing_column(self):
+        path = self.write_sheet([['ID', '校准规范']])
+        with self.assertRaises(ValueError):
+            list(iter_excel_rows(path, calibration_columns_map))
+
+    def test_mixed_text_column(self):
+        # 同一文本列中有的单元格是数字, 有的是文本
+        headers = list(columns_map.keys())
+        rows = [[None] * len(headers) for _ in range(2)]
+        rows[0][headers.index('ID')], rows[0][headers.index('固定资产保管人')] = 'E1', 10086
+        rows[1][headers.index('ID')], rows[1][headers.index('固定资产保管人')] = 'E2', '张三'
+        rows[1][headers.index('制造商')] = 3.0
+        path = self.write_sheet([headers] + rows)
+        datas = [clean_equipment_row(data) for _, data in iter_excel_rows(path, columns_map)]
+        self.assertEqual([data['custodian'] for data in datas], ['10086', '张三'])
+        self.assertEqual([data['manufacturer'] for data in datas], [None, '3'])
+        # MERGE中每个值都按目标列类型转换
+        sql = get_merge_sql('equipment', ['id'], ['id', 'custodian'], ['custodian'], 2)
+        self.assertEqual(sql.count('cast(%s as '), 4)
+
+    def test_iter_chunks(self):
+        chunks = list(iter_chunks(iter(range(7)), size=3))
+        self.assertEqual(chunks, [[0, 1, 2], [3, 4, 5], [6]])
+
+
+class UpsertRowsTest(TestCase):
+
+    def certificate_row(self, equipment_id, year, certificate):
+        now_ts = datetime.datetime.now()
+        return {'equipment_id': equipment_id, 'certificate_year': year, 'certificate': certificate,
+                'create_time': now_ts, 'update_time': now_ts}
+
+    def test_upsert(self):
+        for equipment_id in ['E1', 'E2']:
+            Equipment.objects.create(id=equipment_id)
+        EquipmentCalibrationCertificate.objects.create(equipment_id='E1', certificate_year='2021', certificate='old')
+        rows = [self.certificate_row('E1', '2021', 'a'), self.certificate_row('E1', '2022', 'b'),
+                self.certificate_row('E2', '2021', 'c'), self.certificate_row('E2', '2021', 'd')]
+        upsert_rows('equipment_calibration_certificate', ['equipment_id', 'certificate_year'],
+                    ['equipment_id', 'certificate_year', 'certificate', 'create_time', 'update_time'],
+                    ['certificate', 'update_time'], rows)
+        datas = EquipmentCalibrationCertificate.objects.order_by('equipment_id', 'certificate_year').values_list(
+            'equipment_id', 'certificate_year', 'certificate')
+        # 已有记录只更新, 同一key以最后一行为准
+        self.assertEqual(list(datas), [('E1', '2021', 'a'), ('E1', '2022', 'b'), ('E2', '2021', 'd')])
+
+
+    def test_insert_certificate_missing_id(self):
+        Equipment.objects.create(id='E1')
+        exist = EquipmentCalibrationCertificate.objects.create(equipment_id='E1', certificate_year='2021',
+                                                               certificate='old')
+        datas = [{'id': exist.id, 'equipment_id': 'E1', 'certificate_year': '2020', 'certificate': 'a'},
+                 {'id': exist.id + 100, 'equipment_id': 'E1', 'certificate_year': '2022', 'certificate': 'b'}]
+        self.assertIsNone(insert_certificate(datas))
+        datas = EquipmentCalibrationCertificate.objects.order_by('certificate_year').values_list(
+            'id', 'certificate_year', 'certificate')
+        # id已不存在的行按设备和年份新增, 不会被丢弃
+        self.assertEqual([item[1:] for item in datas], [('2020', 'a'), ('2022', 'b')])
+        self.assertEqual(datas[0][0], exist.id)
+
+
+class DueDateTest(TestCase):
+
+    def setUp(self):
+        self.today = datetime.date.today()
+        for equipment_id in ['E1', 'E2', 'E3', 'E4']:
+            Equipment.objects.create(id=equipment_id)
+
+    def create_calibration(self, equipment_id, days, state):
+        recalibration_time = self.today + datetime.timedelta(days=days) if days is not None else None
+        return EquipmentCalibrationInfo.objects.create(equipment_id=equipment_id, recalibration_time=recalibration_time,
+                                                       state=state)
+
+    def test_due_date(self):
+        self.assertEqual(self.create_calibration('E1', 45, '校验完成').due_date, '45')
+        self.assertEqual(self.create_calibration('E2', 29, '校验完成').due_date, 'Please perform calibration ASAP')
+        self.assertIsNone(self.create_calibration('E3', None, None).due_date)
+        maintain = EquipmentMaintainInfo.objects.create(equipment_id='E1', recalibration_time=self.today)
+        self.assertEqual(maintain.due_date, 'Please perform PM-Y and external Cal ASAP')
+
+    def test_refresh_state(self):
+        self.create_calibration('E1', 45, '校验完成')
+        self.create_calibration('E2', 10, '校验完成')
+        self.create_calibration('E3', 10, '已送检')
+        self.create_calibration('E4', None, None)
+        self.assertEqual(refresh_calibration_state(self.today), 1)
+        states = EquipmentCalibrationInfo.objects.order_by('equipment_id').values_list('state', flat=True)
+        self.assertEqual(list(states), ['校验完成', '待送检', '已送检', None])
+
+
+class RemindReturnTest(TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime.now()
+        self.project = Project.objects.create(name='P1')
+        Equipment.objects.create(id='E1', name='设备1')
+        User.objects.create(username='cc1', email='cc1@test.com', need_cc=True)
+        User.objects.create(username='cc2', need_cc=True)
+
+    def create_borrow(self, username, hours, **kwargs):
+        user = User.objects.create(username=username, email='{}@test.com'.format(username))
+        end_time = self.now + datetime.timedelta(hours=hours)
+        return EquipmentBorrowRecord.objects.create(
+            user=user, project=self.project, equipment_id='E1', start_time=self.now - datetime.timedelta(days=1),
+            end_time=end_time, is_approval=1, remind_at=get_remind_at(end_time), **kwargs)
+
+    def test_remind(self):
+        final = self.create_borrow('u1', 1)
+        overtime = self.create_borrow('u2', -1)
+        self.create_borrow('u3', 5)
+        self.create_borrow('u4', -1, is_return=2)
+        RemindReturnTask().begin_task()
+        self.assertEqual(sorted((m.to, m.cc) for m in mail.outbox),
+                         [(['u1@test.com'], []), (['u2@test.com'], ['cc1@test.com'])])
+        final.refresh_from_db()
+        overtime.refresh_from_db()
+        self.assertTrue(final.is_final_remind)
+        self.assertTrue(overtime.is_overtime_remind)
+        # 临期提醒后下次在到期时提醒超时, 超时提醒后不再提醒
+        self.assertEqual(final.remind_at, final.end_time)
+        self.assertIsNone(overtime.remind_at)
+        # 已提醒过的不再发送
+        RemindReturnTask().begin_task()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_failed_mail_retried(self):
+        self.create_borrow('u1', -1)
+        self.create_borrow('u2', -2)
+        send_messages = mail.get_connection().send_messages
+
+        def fail_u1(messages):
+            if messages[0].to == ['u1@test.com']:
+                raise ConnectionError('refused')
+            return send_messages(messages)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=fail_u1):
+            RemindReturnTask().begin_task()
+        self.assertEqual([m.to for m in mail.outbox], [['u2@test.com']])
+        reminded = EquipmentBorrowRecord.objects.filter(is_overtime_remind=True).values_list('user__username', flat=True)
+        self.assertEqual(list(reminded), ['u2'])
+
+
+    def test_reschedule_in_one_update(self):
+        stale_at = self.now - datetime.timedelta(minutes=1)
+        final_ls = [self.create_borrow('f{}'.format(i), 1 + i, is_final_remind=True) for i in range(3)]
+        done = self.create_borrow('d1', -1, is_final_remind=True, is_overtime_remind=True)
+        EquipmentBorrowRecord.objects.update(remind_at=stale_at)
+        with CaptureQueriesContext(connection) as queries:
+            RemindReturnTask().begin_task()
+        self.assertEqual(mail.outbox, [])
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        for borrow in final_ls:
+            borrow.refresh_from_db()
+            self.assertEqual(borrow.remind_at, borrow.end_time)
+        done.refresh_from_db()
+        self.assertIsNone(done.remind_at)
+
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='u1')
+        project = Project.objects.create(name='P1')
+        Equipment.objects.create(id='E1', name='设备1')
+        now = datetime.datetime.now()
+        for i in range(5):
+            EquipmentBorrowRecord.objects.create(user=self.user, project=project, equipment_id='E1', start_time=now,
+                                                 end_time=now)
+        # 同一时间创建的记录按id排序
+        EquipmentBorrowRecord.objects.update(create_time=now)
+
+    def get(self, params):
+        request = APIRequestFactory().get('/borrow', params)
+        force_authenticate(request, self.user)
+        return BorrowListGeneric.as_view()(request).data
+
+    def test_cursor_pages(self):
+        data = self.get({'cursor': '', 'size': 2, 'count': 1})
+        self.assertEqual(data['count'], 5)
+        ids = [item['id'] for item in data['results']]
+        while data['next_cursor']:
+            with mock.patch('django.db.models.query.QuerySet.count', side_effect=AssertionError):
+                data = self.get({'cursor': data['next_cursor'], 'size': 2, 'count': 1})  # 总数取自缓存
+            self.assertEqual(data['count'], 5)
+            ids.extend(item['id'] for item in data['results'])
+        self.assertEqual(ids, sorted(EquipmentBorrowRecord.objects.values_list('id', flat=True), reverse=True))
+        self.assertNotIn('count', self.get({'cursor': '', 'size': 2}))
+        self.assertEqual(len(self.get({'page': 3, 'size': 2})['results']), 1)
@@ -23,11 +23,14 @@ from equipments.models import Project, Equipment, EquipmentDepreciationRecord
 from equipments.models import EquipmentBorrowRecord, EquipmentReturnRecord, EquipmentBrokenInfo, \
     EquipmentCalibrationInfo, EquipmentMaintenanceRecord, EquipmentMaintainInfo, EquipmentCalibrationCertificate
 from equipments.serializers import CalibrationCertificateSerializer
-from equipments.ext_utils import analysis_equipment_data, create_excel_resp, \
-    analysis_calibration, analysis_maintain, analysis_certificate
-from .ext_utils import VIEW_SUCCESS, VIEW_FAIL, execute_batch_sql, REST_FAIL, REST_SUCCESS
+from equipments.ext_utils import create_excel_resp, iter_excel_rows, iter_chunks, columns_map, \
+    calibration_columns_map, certificate_columns_map, maintain_columns_map, clean_equipment_row, \
+    clean_calibration_row, clean_certificate_row, clean_maintain_row
+from .ext_utils import VIEW_SUCCESS, VIEW_FAIL, execute_batch_sql, upsert_rows, REST_FAIL, REST_SUCCESS
 from utils.log_utils import set_create_log, set_update_log, set_delete_log, get_differ, save_operateLog
 from utils.pagination import MyPagePagination
+from reports.usage_utils import refresh_borrow_usage
+from task_tools.task_remind_return import get_remind_at
 from utils.timedelta_utls import calculate_datediff, get_holiday, calculate_end_time, calculate_due_date, \
     calculate_recalibration_time, calculate_pm_time
 
@@ -132,110 +135,48 @@ def get_upload_template(request):
     return create_excel_resp(file_path, file_name)
 
 
+# 导入设备信息时更新和新增的字段
+EQUIPMENT_UPDATE_COLUMNS = [column for column in columns_map.values() if column != 'id'] + ['update_time']
+EQUIPMENT_INSERT_COLUMNS = ['id'] + EQUIPMENT_UPDATE_COLUMNS + ['create_time', 'is_delete']
+
+
 # 批量导入附件设备信息
 @api_view(['POST'])
 def post_EquipmentData(request):
     try:
-        try:
-            file = request.FILES.get('file', '')
-            if not file:
-                return VIEW_FAIL(msg='上传文件不能为空')
-            current_path = os.path.dirname(__file__)
-            file_dir_path = os.path.join(current_path, 'temporydata')
-            if not os.path.exists(file_dir_path):
-                os.mkdir(file_dir_path)
-            file_path = os.path.join(file_dir_path, 'UniIC_Equipment_Resource_Management_System_v1.xlsx')
-            with open(file_path, 'wb') as f:
-                for i in file.chunks():
-                    f.write(i)
-        except Exception as e:
-            logger.error('解析文件出错, error:{}'.format(str(e)))
-            return VIEW_FAIL(msg='解析文件出错, error:{}'.format(str(e)))
-
-        insert_equipment_sql = '''insert into equipment(id, name, number, serial_number, fixed_asset_code,
-                                        fixed_asset_category, custodian, equipment_state, service_type,specification,
-                                        performance, assort_material,deposit_position, install_date, manage_type,manager,
-                                        application_specialist, manufacturer, manufacture_date, origin_place,
-                                        create_time, update_time, is_delete)
-                                  values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                                                    %s, %s, %s, %s, %s, %s, %s, %s)'''
-
-        update_equipment_sql = '''update equipment set name=%s,number=%s,serial_number=%s,fixed_asset_code=%s,
-                                        fixed_asset_category=%s,custodian=%s,equipment_state=%s,service_type=%s,
-                                        specification=%s,performance=%s,assort_material=%s,deposit_position=%s,
-                                        install_date=%s,manage_type=%s,manager=%s,application_specialist=%s,
-                                        manufacturer=%s, manufacture_date=%s,origin_place=%s,update_time=%s where id=%s'''
-
-        # datas = req_dic.get('datas', [])
-        df = pd.read_excel(file_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        datas = analysis_equipment_data(datas)
-        count = 0
-        try:
-            insert_equipment_ls = []
-            update_equipment_ls = []
-            for data in datas:
-                now_ts = datetime.datetime.now()
-                count += 1
-                lineNo = count + 1
-                equipment_id = data.get('id')
-                if not equipment_id:
-                    return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
-                name = data.get('name')
-                number = data.get('number')
-                serial_number = data.get('serial_number')
-                fixed_asset_code = data.get('fixed_asset_code')
-                fixed_asset_category = data.get('fixed_asset_category')
-                custodian = data.get('custodian')
-                equipment_state = data.get('equipment_state')
-                service_type = data.get('service_type')
-                specification = data.get('specification')
-                performance = data.get('performance')
-                assort_material = data.get('assort_material')
-                deposit_position = data.get('deposit_position')
-                install_date = data.get('install_date')
-                manage_type = data.get('manage_type')
-                manager = data.get('manager')
-                application_specialist = data.get('application_specialist')
-                manufacturer = data.get('manufacturer')
-                manufacture_date = data.get('manufacture_date')
-                origin_place = data.get('origin_place')
-
-                existqs = Equipment.objects.filter(id=equipment_id)  # 判断设备是否存在，存在则更新
-                if existqs:
-                    update_equipment_args = (name, number, serial_number, fixed_asset_code, fixed_asset_category,
-                                             custodian, equipment_state, service_type, specification, performance,
-                                             assort_material, deposit_position, install_date, manage_type, manager,
-                                             application_specialist, manufacturer, manufacture_date, origin_place,
-                                             now_ts, equipment_id)
-                    update_equipment_ls.append(update_equipment_args)
+        # 直接解析上传文件, 小文件在内存中, 大文件是Django为本次请求生成的临时文件, 请求结束后自动删除
+        file = request.FILES.get('file', '')
+        if not file:
+            return VIEW_FAIL(msg='上传文件不能为空')
+
+        # 逐行读取整理, 按批写入, 整个文件在一个事务中导入
+        rows = ((lineNo, clean_equipment_row(data)) for lineNo, data in iter_excel_rows(file, columns_map))
+        close_old_connections()
+        with transaction.atomic():
+            save_id = transaction.savepoint()
+            try:
+                for chunk in iter_chunks(rows):
+                    now_ts = datetime.datetime.now()
+                    upsert_ls = []
+                    for lineNo, data in chunk:
+                        if not data.get('id'):
+                            transaction.savepoint_rollback(save_id)
+                            return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
+                        upsert_ls.append(dict(data, create_time=now_ts, update_time=now_ts, is_delete=False))
+                    # 设备存在则更新, 不存在则新增
+                    upsert_rows('equipment', ['id'], EQUIPMENT_INSERT_COLUMNS, EQUIPMENT_UPDATE_COLUMNS, upsert_ls)
+                transaction.savepoint_commit(save_id)
+            except Exception as e:
+                transaction.savepoint_rollback(save_id)
+                logger.error('设备信息插入数据库失败, error:{}'.format(str(e)))
+                error_code = e.args[0]
+                if error_code == 1111:
+                    msg = e.args[1]
+                    error = e.args[1]
                 else:
-                    insert_equipment_args = (equipment_id, name, number, serial_number, fixed_asset_code,
-                                             fixed_asset_category, custodian, equipment_state, service_type,
-                                             specification, performance, assort_material, deposit_position, install_date,
-                                             manage_type, manager, application_specialist, manufacturer, manufacture_date,
-                                             origin_place, now_ts, now_ts, False)
-                    insert_equipment_ls.append(insert_equipment_args)
-
-                if len(insert_equipment_ls) + len(update_equipment_ls) >= 10:
-                    execute_batch_sql(insert_equipment_sql, insert_equipment_ls)
-                    execute_batch_sql(update_equipment_sql, update_equipment_ls)
-                    insert_equipment_ls = []
-                    update_equipment_ls = []
-
-            if len(insert_equipment_ls) + len(update_equipment_ls) > 0:
-                execute_batch_sql(insert_equipment_sql, insert_equipment_ls)
-                execute_batch_sql(update_equipment_sql, update_equipment_ls)
-        except Exception as e:
-            logger.error('设备信息插入数据库失败, error:{}'.format(str(e)))
-            error_code = e.args[0]
-            if error_code == 1111:
-                msg = e.args[1]
-                error = e.args[1]
-            else:
-                msg = '保存失败'
-                error = str(e)
-            return VIEW_FAIL(msg=msg, data={'error': error})
+                    msg = '保存失败'
+                    error = str(e)
+                return VIEW_FAIL(msg=msg, data={'error': error})
         return VIEW_SUCCESS(msg='导入成功')
     except Exception as e:
         logger.error('设备信息导入失败, error:{}'.format(str(e)))
@@ -380,7 +321,6 @@ class EquipmentDetail(APIView):
             if equipment_state != equipment.equipment_state and int(equipment_state) == 4:
                 EquipmentMaintainInfo.objects.filter(equipment_id=equipment_id).update(calibration_time=None,
                                                                                        recalibration_time=None,
-                                                                                       due_date=None,
                                                                                        pm_q1=None,
                                                                                        pm_q2=None,
                                                                                        pm_q3=None,
@@ -676,6 +616,7 @@ class OperateBorrowRecordGeneric(generics.RetrieveUpdateDestroyAPIView):
             data.update({'actual_end_time': actual_end_time})
         if return_confirm_state is not None and old_confirm_state is None:
             data.update({'is_return': 2})
+            data.update({'remind_at': None})
             actual_end_time = data.get('actual_end_time')
             actual_usage_time = calculate_datediff(start_time, actual_end_time)
             data.update({'actual_usage_time': actual_usage_time})
@@ -697,6 +638,7 @@ class OperateBorrowRecordGeneric(generics.RetrieveUpdateDestroyAPIView):
                                          update_time=datetime.datetime.now())
                     serializer.validated_data.update(data)
                     self.perform_update(serializer)
+                    refresh_borrow_usage(serializer.instance)
 
                     if return_confirm_state == '正常':
                         # TODO 通知下一个预约用户可借用了
@@ -712,6 +654,12 @@ class OperateBorrowRecordGeneric(generics.RetrieveUpdateDestroyAPIView):
                     logger.error('归还信息存储失败,error:{}'.format(str(e)))
                     raise serializers.ValidationError('归还信息存储失败')
         else:
+            # 已批准未归还的借用记录按结束时间计算下次提醒时间, 提醒任务按该时间的索引查询
+            if data.get('is_approval', old_is_approval) == 1 and data.get('is_return', old_is_return) == 0:
+                data.update({'remind_at': get_remind_at(data.get('end_time') or instance.end_time,
+                                                        instance.is_final_remind, instance.is_overtime_remind)})
+            else:
+                data.update({'remind_at': None})
             with transaction.atomic():
                 save_id = transaction.savepoint()
                 try:
@@ -736,6 +684,8 @@ class OperateBorrowRecordGeneric(generics.RetrieveUpdateDestroyAPIView):
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         self.perform_destroy(instance)
+        if instance.is_return == 2:
+            refresh_borrow_usage(instance)
         return REST_SUCCESS({'msg': '删除成功'})
 
 
@@ -873,6 +823,7 @@ class OperateReturnApplyGeneric(generics.RetrieveUpdateAPIView):
                 try:
                     # 更新借用记录
                     borrow_obj.update(is_return=2,
+                                      remind_at=None,
                                       is_interrupted=is_interrupted,
                                       actual_end_time=actual_end_time,
                                       actual_usage_time=actual_usage_time,
@@ -884,6 +835,7 @@ class OperateReturnApplyGeneric(generics.RetrieveUpdateAPIView):
                                          update_time=datetime.datetime.now())
                     serializer.validated_data.update(data)
                     self.perform_update(serializer)
+                    refresh_borrow_usage(borrow_obj.first())
 
                     if confirm_state == '正常':
                         # TODO 通知下一个预约用户可借用了
@@ -997,95 +949,65 @@ class OperateBrokenInfoGeneric(generics.RetrieveUpdateAPIView):
         return Response(serializer.data)
 
 
+# 导入校准规范时更新和新增的字段
+CALIBRATION_UPDATE_COLUMNS = ['specification', 'environment', 'calibration_cycle', 'calibration_time',
+                              'recalibration_time', 'update_time', 'state']
+CALIBRATION_INSERT_COLUMNS = CALIBRATION_UPDATE_COLUMNS + ['create_time', 'equipment_id']
+
+
 # 批量导入校准规范
 @api_view(['POST'])
 def post_calibration(request):
     try:
-        try:
-            file = request.FILES.get('file', '')
-            if not file:
-                return VIEW_FAIL(msg='上传文件不能为空')
-            current_path = os.path.dirname(__file__)
-            file_dir_path = os.path.join(current_path, 'temporydata')
-            if not os.path.exists(file_dir_path):
-                os.mkdir(file_dir_path)
-            file_path = os.path.join(file_dir_path, 'UniIC_Equipment_Calibration.xlsx')
-            with open(file_path, 'wb') as f:
-                for i in file.chunks():
-                    f.write(i)
-        except Exception as e:
-            logger.error('解析文件出错, error:{}'.format(str(e)))
-            return VIEW_FAIL(msg='解析文件出错, error:{}'.format(str(e)))
-
-        insert_calibration_sql = '''insert into equipment_calibration_info(specification, environment, calibration_cycle,
-                                                    calibration_time, recalibration_time, due_date, 
-                                                    create_time, update_time, equipment_id, state)
-                                      values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
-
-        update_calibration_sql = '''update equipment_calibration_info set specification=%s,environment=%s,
-                                            calibration_cycle=%s,calibration_time=%s,recalibration_time=%s,
-                                            due_date=%s,update_time=%s,state=%s where equipment_id=%s'''
-        df = pd.read_excel(file_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        datas = analysis_calibration(datas)
-        count = 0
-        try:
-            insert_calibration_ls = []
-            update_calibration_ls = []
-            for data in datas:
-                now_ts = datetime.datetime.now()
-                count += 1
-                lineNo = count + 1
-                equipment_id = data.get('equipment_id')
-                if not equipment_id:
-                    return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
-                specification = data.get('specification')
-                environment = data.get('environment')
-                calibration_cycle = data.get('calibration_cycle')
-                calibration_time = data.get('calibration_time')
-                if calibration_cycle and calibration_time:
-                    recalibration_time = calculate_recalibration_time(calibration_time, calibration_cycle)
-                    due_date = calculate_due_date(recalibration_time, 'calibration')
-                    try:
-                        due_date = str(int(due_date))
-                        calibration_state = '校验完成'
-                    except:
-                        calibration_state = '待送检'
-                else:
-                    calibration_time = None
-                    recalibration_time = None
-                    due_date = None
-                    calibration_state = None
-                calibration_qs = EquipmentCalibrationInfo.objects.filter(equipment_id=equipment_id)
-                if calibration_qs:
-                    update_calibration_args = (specification, environment, calibration_cycle, calibration_time,
-                                               recalibration_time, due_date, now_ts, calibration_state, equipment_id)
-                    update_calibration_ls.append(update_calibration_args)
+        # 直接解析上传文件, 小文件在内存中, 大文件是Django为本次请求生成的临时文件, 请求结束后自动删除
+        file = request.FILES.get('file', '')
+        if not file:
+            return VIEW_FAIL(msg='上传文件不能为空')
+
+        rows = ((lineNo, clean_calibration_row(data)) for lineNo, data in iter_excel_rows(file, calibration_columns_map))
+        close_old_connections()
+        with transaction.atomic():
+            save_id = transaction.savepoint()
+            try:
+                for chunk in iter_chunks(rows):
+                    now_ts = datetime.datetime.now()
+                    upsert_ls = []
+                    for lineNo, data in chunk:
+                        equipment_id = data.get('equipment_id')
+                        if not equipment_id:
+                            transaction.savepoint_rollback(save_id)
+                            return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
+                        calibration_cycle = data.get('calibration_cycle')
+                        calibration_time = data.get('calibration_time')
+                        if calibration_cycle and calibration_time:
+                            recalibration_time = calculate_recalibration_time(calibration_time, calibration_cycle)
+                            if calculate_due_date(recalibration_time, 'calibration').isdigit():
+                                calibration_state = '校验完成'
+                            else:
+                                calibration_state = '待送检'
+                        else:
+                            calibration_time = None
+                            recalibration_time = None
+                            calibration_state = None
+                        upsert_ls.append({'equipment_id': equipment_id, 'specification': data.get('specification'),
+                                          'environment': data.get('environment'),
+                                          'calibration_cycle': calibration_cycle, 'calibration_time': calibration_time,
+                                          'recalibration_time': recalibration_time, 'state': calibration_state,
+                                          'create_time': now_ts, 'update_time': now_ts})
+                    upsert_rows('equipment_calibration_info', ['equipment_id'], CALIBRATION_INSERT_COLUMNS,
+                                CALIBRATION_UPDATE_COLUMNS, upsert_ls)
+                transaction.savepoint_commit(save_id)
+            except Exception as e:
+                transaction.savepoint_rollback(save_id)
+                logger.error('校准要求插入数据库失败, error:{}'.format(str(e)))
+                error_code = e.args[0]
+                if error_code == 1111:
+                    msg = e.args[1]
+                    error = e.args[1]
                 else:
-                    insert_calibration_args = (specification, environment, calibration_cycle,
-                                               calibration_time, recalibration_time, due_date,
-                                               now_ts, now_ts, equipment_id, calibration_state)
-                    insert_calibration_ls.append(insert_calibration_args)
-
-                if len(insert_calibration_ls) + len(update_calibration_ls) >= 10:
-                    execute_batch_sql(insert_calibration_sql, insert_calibration_ls)
-                    execute_batch_sql(update_calibration_sql, update_calibration_ls)
-                    insert_calibration_ls = []
-                    update_calibration_ls = []
-
-            if len(insert_calibration_ls) + len(update_calibration_ls) > 0:
-                execute_batch_sql(insert_calibration_sql, insert_calibration_ls)
-                execute_batch_sql(update_calibration_sql, update_calibration_ls)
-        except Exception as e:
-            logger.error('校准要求插入数据库失败, error:{}'.format(str(e)))
-            error_code = e.args[0]
-            if error_code == 1111:
-                msg = e.args[1]
-                error = e.args[1]
-            else:
-                msg = '保存失败'
-                error = str(e)
-            return VIEW_FAIL(msg=msg, data={'error': error})
+                    msg = '保存失败'
+                    error = str(e)
+                return VIEW_FAIL(msg=msg, data={'error': error})
         return VIEW_SUCCESS(msg='导入成功')
     except Exception as e:
         logger.error('校准要求导入失败, error:{}'.format(str(e)))
@@ -1149,8 +1071,6 @@ class CalibrationInfoGeneric(generics.ListCreateAPIView):
         elif state == '校验完成':
             if equipment.equipment_state == 3:
                 Equipment.objects.filter(id=equipment.id).update(equipment_state=1)
-        due_date = calculate_due_date(recalibration_time, 'calibration')
-        data.update({'due_date': due_date})
         serializer.validated_data.update(data)
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
@@ -1185,8 +1105,6 @@ class OperateCalibrationInfoGeneric(generics.RetrieveUpdateDestroyAPIView):
         elif state == '校验完成' and old_state == '已送检':
             if equipment.equipment_state == 3:
                 Equipment.objects.filter(id=equipment.id).update(equipment_state=1)
-        due_date = calculate_due_date(recalibration_time, 'calibration')
-        data.update({'due_date': due_date})
         serializer.validated_data.update(data)
         self.perform_update(serializer)
 
@@ -1204,86 +1122,76 @@ class OperateCalibrationInfoGeneric(generics.RetrieveUpdateDestroyAPIView):
         return REST_SUCCESS({'msg': '删除成功'})
 
 
-# 插入校准报告数据
+# 导入校准报告时更新和新增的字段, 按设备和校准年份匹配已有记录
+CERTIFICATE_UPDATE_COLUMNS = ['certificate', 'update_time']
+CERTIFICATE_INSERT_COLUMNS = CERTIFICATE_UPDATE_COLUMNS + ['create_time', 'equipment_id', 'certificate_year']
+
+
+# 插入校准报告数据, 需在调用方的事务中执行
 def insert_certificate(datas):
-    insert_certificate_sql = '''insert into equipment_calibration_certificate(certificate_year, certificate, 
-                                    create_time, update_time, equipment_id)
-                                    values(%s, %s, %s, %s, %s)'''
     update_certificate_sql = '''update equipment_calibration_certificate set certificate_year=%s,certificate=%s,
                                     update_time=%s where id=%s'''
-    insert_certificate_ls = []
-    update_certificate_ls = []
     count = 0
-    for data in datas:
+    for chunk in iter_chunks(datas):
         now_ts = datetime.datetime.now()
-        count += 1
-        lineNo = count + 1
-        equipment_id = data.get('equipment_id')
-        if not equipment_id:
-            return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
-        certificate_year = data.get('certificate_year')
-        if not certificate_year:
-            return VIEW_FAIL(msg='校准年份不能为空, 空值所在行: {}'.format(lineNo))
-        certificate = data.get('certificate')
-        id = data.get('id', '')
-        if id:
-            certificate_qs = EquipmentCalibrationCertificate.objects.filter(id=id)
-        else:
-            certificate_qs = EquipmentCalibrationCertificate.objects.filter(equipment_id=equipment_id,
-                                                                            certificate_year=certificate_year.strip())
-        if certificate_qs:
-            update_certificate_args = (certificate_year, certificate, now_ts, certificate_qs.first().id)
-            update_certificate_ls.append(update_certificate_args)
-        else:
-            insert_certificate_args = (certificate_year, certificate, now_ts, now_ts, equipment_id)
-            insert_certificate_ls.append(insert_certificate_args)
-
-        if len(insert_certificate_ls) + len(update_certificate_ls) >= 10:
-            execute_batch_sql(insert_certificate_sql, insert_certificate_ls)
-            execute_batch_sql(update_certificate_sql, update_certificate_ls)
-            insert_certificate_ls = []
-            update_certificate_ls = []
-
-    if len(insert_certificate_ls) + len(update_certificate_ls) > 0:
-        execute_batch_sql(insert_certificate_sql, insert_certificate_ls)
+        # 带id的行只有id存在时才按id更新, 不存在的与不带id的行一样按设备和年份新增或更新
+        ids = [data['id'] for data in chunk if data.get('id')]
+        exist_ids = {str(id) for id in EquipmentCalibrationCertificate.objects.filter(id__in=ids).values_list(
+            'id', flat=True)} if ids else set()
+        update_certificate_ls = []
+        upsert_ls = []
+        for data in chunk:
+            count += 1
+            lineNo = count + 1
+            equipment_id = data.get('equipment_id')
+            if not equipment_id:
+                return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
+            certificate_year = data.get('certificate_year')
+            if not certificate_year:
+                return VIEW_FAIL(msg='校准年份不能为空, 空值所在行: {}'.format(lineNo))
+            certificate_year = certificate_year.strip()
+            certificate = data.get('certificate')
+            id = data.get('id', '')
+            if id and str(id) in exist_ids:
+                update_certificate_ls.append((certificate_year, certificate, now_ts, id))
+            else:
+                upsert_ls.append({'equipment_id': equipment_id, 'certificate_year': certificate_year,
+                                  'certificate': certificate, 'create_time': now_ts, 'update_time': now_ts})
         execute_batch_sql(update_certificate_sql, update_certificate_ls)
+        upsert_rows('equipment_calibration_certificate', ['equipment_id', 'certificate_year'],
+                    CERTIFICATE_INSERT_COLUMNS, CERTIFICATE_UPDATE_COLUMNS, upsert_ls)
 
 
 # 批量导入校准报告
 @api_view(['POST'])
 def post_batch_certificate(request):
     try:
-        try:
-            file = request.FILES.get('file', '')
-            if not file:
-                return VIEW_FAIL(msg='上传文件不能为空')
-            current_path = os.path.dirname(__file__)
-            file_dir_path = os.path.join(current_path, 'temporydata')
-            if not os.path.exists(file_dir_path):
-                os.mkdir(file_dir_path)
-            file_path = os.path.join(file_dir_path, 'UniIC_Calibration_Certificate.xlsx')
-            with open(file_path, 'wb') as f:
-                for i in file.chunks():
-                    f.write(i)
-        except Exception as e:
-            logger.error('解析文件出错, error:{}'.format(str(e)))
-            return VIEW_FAIL(msg='解析文件出错, error:{}'.format(str(e)))
+        # 直接解析上传文件, 小文件在内存中, 大文件是Django为本次请求生成的临时文件, 请求结束后自动删除
+        file = request.FILES.get('file', '')
+        if not file:
+            return VIEW_FAIL(msg='上传文件不能为空')
 
-        df = pd.read_excel(file_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        datas = analysis_certificate(datas)
-        try:
-            insert_certificate(datas)
-        except Exception as e:
-            logger.error('校准记录插入数据库失败, error:{}'.format(str(e)))
-            error_code = e.args[0]
-            if error_code == 1111:
-                msg = e.args[1]
-                error = e.args[1]
-            else:
-                msg = '保存失败'
-                error = str(e)
-            return VIEW_FAIL(msg=msg, data={'error': error})
+        rows = iter_excel_rows(file, certificate_columns_map)
+        close_old_connections()
+        with transaction.atomic():
+            save_id = transaction.savepoint()
+            try:
+                fail_resp = insert_certificate(clean_certificate_row(data) for _, data in rows)
+                if fail_resp:
+                    transaction.savepoint_rollback(save_id)
+                    return fail_resp
+                transaction.savepoint_commit(save_id)
+            except Exception as e:
+                transaction.savepoint_rollback(save_id)
+                logger.error('校准记录插入数据库失败, error:{}'.format(str(e)))
+                error_code = e.args[0]
+                if error_code == 1111:
+                    msg = e.args[1]
+                    error = e.args[1]
+                else:
+                    msg = '保存失败'
+                    error = str(e)
+                return VIEW_FAIL(msg=msg, data={'error': error})
         return VIEW_SUCCESS(msg='导入成功')
     except Exception as e:
         logger.error('校准记录导入失败, error:{}'.format(str(e)))
@@ -1308,7 +1216,10 @@ def add_certificate(request):
             try:
                 if del_ls:
                     EquipmentCalibrationCertificate.objects.filter(id__in=del_ls).delete()
-                insert_certificate(certificate_ls)
+                fail_resp = insert_certificate(certificate_ls)
+                if fail_resp:
+                    transaction.savepoint_rollback(save_id)
+                    return fail_resp
                 transaction.savepoint_commit(save_id)
             except Exception as e:
                 transaction.savepoint_rollback(save_id)
@@ -1460,88 +1371,59 @@ class OperateMaintenanceGeneric(generics.RetrieveUpdateDestroyAPIView):
         return REST_SUCCESS({'msg': '删除成功'})
 
 
+# 导入维护日期时更新和新增的字段
+MAINTAIN_UPDATE_COLUMNS = ['calibration_time', 'recalibration_time', 'pm_q1', 'pm_q2', 'pm_q3', 'pm_q4', 'update_time']
+MAINTAIN_INSERT_COLUMNS = MAINTAIN_UPDATE_COLUMNS + ['create_time', 'equipment_id']
+
+
 # 批量导入维护日期
 @api_view(['POST'])
 def post_maintain(request):
     try:
-        try:
-            file = request.FILES.get('file', '')
-            if not file:
-                return VIEW_FAIL(msg='上传文件不能为空')
-            current_path = os.path.dirname(__file__)
-            file_dir_path = os.path.join(current_path, 'temporydata')
-            if not os.path.exists(file_dir_path):
-                os.mkdir(file_dir_path)
-            file_path = os.path.join(file_dir_path, 'UniIC_Equipment_Maintain.xlsx')
-            with open(file_path, 'wb') as f:
-                for i in file.chunks():
-                    f.write(i)
-        except Exception as e:
-            logger.error('解析文件出错, error:{}'.format(str(e)))
-            return VIEW_FAIL(msg='解析文件出错, error:{}'.format(str(e)))
-
-        insert_maintain_sql = '''insert into equipment_maintain_info(calibration_time, recalibration_time, due_date, 
-                                                    pm_q1, pm_q2, pm_q3, pm_q4,
-                                                    create_time, update_time, equipment_id)
-                                      values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
-
-        update_maintain_sql = '''update equipment_maintain_info set calibration_time=%s,recalibration_time=%s,
-                                            due_date=%s,pm_q1=%s,pm_q2=%s,pm_q3=%s,pm_q4=%s,
-                                            update_time=%s where equipment_id=%s'''
-        df = pd.read_excel(file_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        datas = analysis_maintain(datas)
-        count = 0
-        try:
-            insert_maintain_ls = []
-            update_maintain_ls = []
-            for data in datas:
-                now_ts = datetime.datetime.now()
-                count += 1
-                lineNo = count + 1
-                equipment_id = data.get('equipment_id')
-                if not equipment_id:
-                    return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
-                calibration_time = data.get('calibration_time')
-                recalibration_time = data.get('recalibration_time')
-                if calibration_time and recalibration_time:
-                    due_date = calculate_due_date(recalibration_time, 'maintain')
-                    pm_q1, pm_q2, pm_q3, pm_q4 = calculate_pm_time(recalibration_time)
-                else:
-                    calibration_time = None
-                    recalibration_time = None
-                    due_date = None
-                    pm_q1, pm_q2, pm_q3, pm_q4 = None, None, None, None
-                maintain_qs = EquipmentMaintainInfo.objects.filter(equipment_id=equipment_id)
-                if maintain_qs:
-                    update_maintain_args = (calibration_time, recalibration_time, due_date,
-                                            pm_q1, pm_q2, pm_q3, pm_q4, now_ts, equipment_id)
-                    update_maintain_ls.append(update_maintain_args)
+        # 直接解析上传文件, 小文件在内存中, 大文件是Django为本次请求生成的临时文件, 请求结束后自动删除
+        file = request.FILES.get('file', '')
+        if not file:
+            return VIEW_FAIL(msg='上传文件不能为空')
+
+        rows = ((lineNo, clean_maintain_row(data)) for lineNo, data in iter_excel_rows(file, maintain_columns_map))
+        close_old_connections()
+        with transaction.atomic():
+            save_id = transaction.savepoint()
+            try:
+                for chunk in iter_chunks(rows):
+                    now_ts = datetime.datetime.now()
+                    upsert_ls = []
+                    for lineNo, data in chunk:
+                        equipment_id = data.get('equipment_id')
+                        if not equipment_id:
+                            transaction.savepoint_rollback(save_id)
+                            return VIEW_FAIL(msg='ID不能为空, 空值所在行: {}'.format(lineNo))
+                        calibration_time = data.get('calibration_time')
+                        recalibration_time = data.get('recalibration_time')
+                        if calibration_time and recalibration_time:
+                            pm_q1, pm_q2, pm_q3, pm_q4 = calculate_pm_time(recalibration_time)
+                        else:
+                            calibration_time = None
+                            recalibration_time = None
+                            pm_q1, pm_q2, pm_q3, pm_q4 = None, None, None, None
+                        upsert_ls.append({'equipment_id': equipment_id, 'calibration_time': calibration_time,
+                                          'recalibration_time': recalibration_time,
+                                          'pm_q1': pm_q1, 'pm_q2': pm_q2, 'pm_q3': pm_q3, 'pm_q4': pm_q4,
+                                          'create_time': now_ts, 'update_time': now_ts})
+                    upsert_rows('equipment_maintain_info', ['equipment_id'], MAINTAIN_INSERT_COLUMNS,
+                                MAINTAIN_UPDATE_COLUMNS, upsert_ls)
+                transaction.savepoint_commit(save_id)
+            except Exception as e:
+                transaction.savepoint_rollback(save_id)
+                logger.error('维护信息插入数据库失败, error:{}'.format(str(e)))
+                error_code = e.args[0]
+                if error_code == 1111:
+                    msg = e.args[1]
+                    error = e.args[1]
                 else:
-                    insert_maintain_args = (calibration_time, recalibration_time, due_date,
-                                            pm_q1, pm_q2, pm_q3, pm_q4,
-                                            now_ts, now_ts, equipment_id)
-                    insert_maintain_ls.append(insert_maintain_args)
-
-                if len(insert_maintain_ls) + len(update_maintain_ls) >= 10:
-                    execute_batch_sql(insert_maintain_sql, insert_maintain_ls)
-                    execute_batch_sql(update_maintain_sql, update_maintain_ls)
-                    insert_maintain_ls = []
-                    update_maintain_ls = []
-
-            if len(insert_maintain_ls) + len(update_maintain_ls) > 0:
-                execute_batch_sql(insert_maintain_sql, insert_maintain_ls)
-                execute_batch_sql(update_maintain_sql, update_maintain_ls)
-        except Exception as e:
-            logger.error('维护信息插入数据库失败, error:{}'.format(str(e)))
-            error_code = e.args[0]
-            if error_code == 1111:
-                msg = e.args[1]
-                error = e.args[1]
-            else:
-                msg = '保存失败'
-                error = str(e)
-            return VIEW_FAIL(msg=msg, data={'error': error})
+                    msg = '保存失败'
+                    error = str(e)
+                return VIEW_FAIL(msg=msg, data={'error': error})
         return VIEW_SUCCESS(msg='导入成功')
     except Exception as e:
         logger.error('维护信息导入失败, error:{}'.format(str(e)))
@@ -1590,8 +1472,6 @@ class MaintainInfoGeneric(generics.ListCreateAPIView):
         data = serializer.validated_data.copy()
         recalibration_time = data.get('recalibration_time')
         if recalibration_time:
-            due_date = calculate_due_date(recalibration_time, 'maintain')
-            data.update({'due_date': due_date})
             pm_q1, pm_q2, pm_q3, pm_q4 = calculate_pm_time(recalibration_time)
             data.update({'pm_q1': pm_q1})
             data.update({'pm_q2': pm_q2})
@@ -1620,8 +1500,6 @@ class OperateMaintainInfoGeneric(generics.RetrieveUpdateDestroyAPIView):
         data = serializer.validated_data.copy()
         recalibration_time = data.get('recalibration_time')
         if recalibration_time:
-            due_date = calculate_due_date(recalibration_time, 'maintain')
-            data.update({'due_date': due_date})
             pm_q1, pm_q2, pm_q3, pm_q4 = calculate_pm_time(recalibration_time)
             data.update({'pm_q1': pm_q1})
             data.update({'pm_q2': pm_q2})
@@ -10,9 +10,11 @@ from fba_estimate.serializers import FirstServiceSerializer, SecondServiceSerial
 from fba_estimate.serializers import EstimateMonthDetailSerializer, EstimateMonthFutureSerializer
 from fba_estimate.models import FirstService, SecondService, Company, EstimateOption, CapitalSurplus
 from fba_estimate.models import EstimateMonthDetail, EstimateMonthFuture
-from equipments.ext_utils import REST_FAIL, REST_SUCCESS, create_excel_resp, dictfetchall
+from users.role_utils import get_role_codes
+from equipments.ext_utils import REST_FAIL, REST_SUCCESS, create_excel_buffer, create_excel_resp, dictfetchall
+from reports.export_jobs import export_task
 from utils.log_utils import set_create_log, set_update_log, set_delete_log
-from fba_estimate.ext_utils import get_last_month, get_file_path
+from fba_estimate.ext_utils import get_last_month
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from openpyxl import load_workbook
@@ -435,8 +437,7 @@ class MonthDetailList(generics.ListCreateAPIView):
         now_date = datetime.datetime.now()
         queryset = queryset.filter(create_time__year=now_date.year, create_time__month=now_date.month)
         req_user = request.user
-        user_roles = req_user.role_set.values('id', 'role_code')
-        user_roles = [item['role_code'] for item in list(user_roles)]
+        user_roles = get_role_codes(req_user)
         if list(set(['developer', 'fbaManager']) & set(user_roles)):
             pass
         elif 'fbaCsManager' in user_roles:
@@ -551,8 +552,7 @@ class MonthFutureList(generics.ListCreateAPIView):
         now_date = datetime.datetime.now()
         queryset = queryset.filter(create_time__year=now_date.year, create_time__month=now_date.month)
         req_user = request.user
-        user_roles = req_user.role_set.values('id', 'role_code')
-        user_roles = [item['role_code'] for item in list(user_roles)]
+        user_roles = get_role_codes(req_user)
         if list(set(['developer', 'fbaManager']) & set(user_roles)):
             pass
         elif 'fbaCsManager' in user_roles:
@@ -658,8 +658,7 @@ class MonthFutureOperate(generics.RetrieveUpdateDestroyAPIView):
 
 
 def get_service_filter(req_user):
-    user_roles = req_user.role_set.values('id', 'role_code')
-    user_roles = [item['role_code'] for item in list(user_roles)]
+    user_roles = get_role_codes(req_user)
     if list(set(['developer', 'fbaManager']) & set(user_roles)):
         return None
     elif 'fbaCsManager' in user_roles:
@@ -722,6 +721,7 @@ def get_base_data(export_month, service_filter, username, export_type):
 
 # 导出资金预估汇总表
 @api_view(['GET'])
+@export_task('month_detail')
 def export_month_detail(request):
     try:
         export_month = request.GET.get('exportMonth')
@@ -806,9 +806,9 @@ def export_month_detail(request):
                 cell.fill = copy(template_cell.fill)
                 cell.number_format = copy(template_cell.number_format)
                 cell.alignment = copy(template_cell.alignment)
-        save_path = get_file_path('detail', 'export_files')
-        wb.save(save_path)
-        return create_excel_resp(save_path, title)
+        excel_file = create_excel_buffer()
+        wb.save(excel_file)
+        return create_excel_resp(excel_file, title)
     except Exception as e:
         logger.error('导出失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '导出失败, error: {}'.format(str(e))})
@@ -857,6 +857,7 @@ first_service_opt = [
 
 
 @api_view(['GET'])
+@export_task('month_monitor')
 def export_month_monitor(request):
     try:
         export_month = request.GET.get('exportMonth')
@@ -937,9 +938,9 @@ def export_month_monitor(request):
                         ws.cell(row=z, column=write_col).value = data['out']
                         write_col += 1
                 a += 1
-        save_path = get_file_path('monitor', 'export_files')
-        wb.save(save_path)
-        return create_excel_resp(save_path, title)
+        excel_file = create_excel_buffer()
+        wb.save(excel_file)
+        return create_excel_resp(excel_file, title)
     except Exception as e:
         logger.error('导出失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '导出失败, error: {}'.format(str(e))})
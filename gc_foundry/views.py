@@ -10,7 +10,8 @@ from gc_foundry.serializers import CurrencySerializer, FactorySerializer, Foundr
     FoundryToolingSerializer, MachineModelSerializer, FoundryTransferSerializer
 from gc_foundry.models import Currency, Factory, FoundryEquipment, FoundryTooling, MachineModel, FoundryTransfer
 from equipments.models import Project
-from equipments.ext_utils import REST_FAIL, REST_SUCCESS, get_file_path, create_excel_resp
+from equipments.ext_utils import REST_FAIL, REST_SUCCESS, create_excel_buffer, create_excel_resp
+from reports.export_jobs import export_task
 from utils.log_utils import set_create_log, set_update_log, set_delete_log
 from lab_system_backend.settings import MEDIA_ROOT, MEDIA_URL, BASE_DIR
 from decimal import Decimal
@@ -564,6 +565,7 @@ class FoundryTransferDetail(generics.RetrieveUpdateAPIView):
 
 # 导出机台信息
 @api_view(['GET'])
+@export_task('equipment_list')
 def export_equipment_list(request):
     try:
         obj = FoundryEquipment.objects
@@ -640,8 +642,8 @@ def export_equipment_list(request):
             'fixed_asset_code': '固定资产编号'
         }
         ndf.rename(rename_maps, axis=1, inplace=True)
-        file_path = get_file_path('detail', 'export_files')
-        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        excel_file = create_excel_buffer()
+        writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
         workbook = writer.book
         fmt = workbook.add_format({'font_size': 10, 'text_wrap': True, 'valign': 'vcenter'})
         center_fmt = workbook.add_format({'font_size': 10, 'text_wrap': True, 'valign': 'vcenter', 'align': 'center'})
@@ -676,7 +678,7 @@ def export_equipment_list(request):
         worksheet.conditional_format('A1:N%d' % total_no, {'type': 'blanks', 'format': border_format})
         worksheet.conditional_format('A1:N%d' % total_no, {'type': 'no_blanks', 'format': border_format})
         writer.save()
-        return create_excel_resp(file_path, '机台信息表')
+        return create_excel_resp(excel_file, '机台信息表')
     except Exception as e:
         logger.error('查询失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '查询失败, error: {}'.format(str(e))})
@@ -684,6 +686,7 @@ def export_equipment_list(request):
 
 # 导出器材信息
 @api_view(['GET'])
+@export_task('tooling_list')
 def export_tooling_list(request):
     try:
         obj = FoundryTooling.objects
@@ -767,8 +770,8 @@ def export_tooling_list(request):
             'fixed_asset_code': '固定资产编号'
         }
         ndf.rename(rename_maps, axis=1, inplace=True)
-        file_path = get_file_path('detail', 'export_files')
-        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        excel_file = create_excel_buffer()
+        writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
         workbook = writer.book
         fmt = workbook.add_format({'font_size': 10, 'text_wrap': True, 'valign': 'vcenter'})
         center_fmt = workbook.add_format({'font_size': 10, 'text_wrap': True, 'valign': 'vcenter', 'align': 'center'})
@@ -803,7 +806,7 @@ def export_tooling_list(request):
         worksheet.conditional_format('A1:N%d' % total_no, {'type': 'blanks', 'format': border_format})
         worksheet.conditional_format('A1:N%d' % total_no, {'type': 'no_blanks', 'format': border_format})
         writer.save()
-        return create_excel_resp(file_path, '设备器材表')
+        return create_excel_resp(excel_file, '设备器材表')
     except Exception as e:
         logger.error('查询失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '查询失败, error: {}'.format(str(e))})
@@ -29,6 +29,8 @@ DEBUG = True
 ALLOWED_HOSTS = ['*']
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760 * 10    # 设置为最大10M
+# 上传文件不超过5M时直接在内存中解析, 超过时由Django写入不重名的临时文件, 请求结束后自动删除
+FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024 * 5
 
 # Application definition
 
@@ -224,6 +226,31 @@ CRON_DATE = {
 ERROR_WAIT = 0.5  # 异常周期
 # -------------------------------------------------------------------------
 
+# 运行时生成的文件(导入会话、导出文件、日志落盘、缓存等)放在代码目录之外, 可通过环境变量指定
+DATA_DIR = os.environ.get('LAB_SYSTEM_DATA_DIR', os.path.join(os.path.dirname(BASE_DIR), 'lab_system_data'))
+UPLOAD_SESSION_DIR = os.path.join(DATA_DIR, 'upload_sessions')  # pwm_cost导入会话
+EXPORT_JOB_DIR = os.path.join(DATA_DIR, 'export_jobs')  # 后台导出任务生成的文件
+REPORT_CHART_DIR = os.path.join(DATA_DIR, 'report_images')  # 使用率图缓存
+
+# 操作日志异步批量写库, 写库前先落盘到该目录, 进程重启后由其他进程补写
+OPERATION_LOG_ASYNC = True
+OPERATION_LOG_SPOOL_DIR = os.path.join(DATA_DIR, 'log_spool')
+# 超过保留天数的操作日志由archive_operation_log命令按月归档为压缩文件后从库中删除
+OPERATION_LOG_KEEP_DAYS = 180
+OPERATION_LOG_ARCHIVE_DIR = os.path.join(DATA_DIR, 'log_archive')
+
+# 用户角色权限缓存: 多个uwsgi进程共用文件缓存, 角色或用户变化时由信号清除
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'permission': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(DATA_DIR, 'cache', 'permission'),
+        'TIMEOUT': 24 * 3600,
+    }
+}
+
 
 LOG_PATH = os.path.join(BASE_DIR, 'error.log')
 LOGGING = {
@@ -0,0 +1,71 @@
+from pwm_cost.models import GrainBom
+
+import numpy as np
+import pandas as pd
+
+
+class BomCycleError(ValueError):
+    """BOM中存在循环引用"""
+    pass
+
+
+def load_grain_bom():
+    """一次查出所有有bom的颗粒的组成明细"""
+    edge_qs = GrainBom.objects.filter(belong_grain__has_bom=True, belong_grain__is_delete=False).values(
+        'belong_grain_id', 'grain_source_id', 'count')
+    return pd.DataFrame(list(edge_qs), columns=['belong_grain_id', 'grain_source_id', 'count'])
+
+
+def get_bom_levels(bom_ids, edge_df):
+    """
+    按依赖关系把有bom的颗粒分层, 每层只依赖更低层的颗粒, 同层之间互不依赖
+    返回[[第0层颗粒], [第1层颗粒], ...], 存在循环引用时抛出BomCycleError
+    """
+    bom_ids = set(bom_ids)
+    dep_df = edge_df[edge_df['belong_grain_id'].isin(bom_ids) & edge_df['grain_source_id'].isin(bom_ids)]
+    levels = []
+    remaining = bom_ids
+    while remaining:
+        blocked_df = dep_df[dep_df['belong_grain_id'].isin(remaining) & dep_df['grain_source_id'].isin(remaining)]
+        blocked = set(blocked_df['belong_grain_id'])
+        ready = remaining - blocked
+        if not ready:
+            raise BomCycleError('BOM存在循环引用: {}'.format(', '.join(sorted(str(i) for i in remaining))))
+        levels.append(sorted(ready))
+        remaining = blocked
+    return levels
+
+
+def rollup_grain_price(pdf, edge_df):
+    """
+    自底向上计算有bom的颗粒的成本
+    采购单价为各来源颗粒ic_up * 数量之和, wafer成本为各来源wafer成本之和, 再按本身的测试费重新计算ic_up/die_up/ft_up
+    来源颗粒取无bom的颗粒及已算好的下层有bom的颗粒, 不在本次数据中的来源按0计
+    """
+    bom_mask = pdf['has_bom'] == True
+    if not bom_mask.any():
+        return pdf
+    pdf = pdf.copy()
+    source_df = pdf.loc[pdf['has_bom'] == False, ['grain_id', 'wafer_price', 'ic_up']]
+    for level_ids in get_bom_levels(pdf.loc[bom_mask, 'grain_id'], edge_df):
+        level_edge_df = edge_df[edge_df['belong_grain_id'].isin(level_ids)]
+        bom_df = pd.merge(level_edge_df, source_df.rename(columns={'grain_id': 'grain_source_id'}),
+                          how='left', on='grain_source_id')
+        bom_df['purchase_price_sum'] = bom_df['ic_up'] * bom_df['count']
+        sum_df = bom_df.groupby('belong_grain_id')[['wafer_price', 'purchase_price_sum']].sum()
+
+        level_mask = bom_mask & pdf['grain_id'].isin(level_ids)
+        level_df = pdf.loc[level_mask]
+        wafer_price = level_df['grain_id'].map(sum_df['wafer_price']).fillna(0).round(2)
+        purchase_price = level_df['grain_id'].map(sum_df['purchase_price_sum']).fillna(0).round(2)
+        total_yld = level_df['wafer_yld'] * level_df['ft_yld'] * level_df['gross_die']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pdf.loc[level_mask, 'wafer_price'] = wafer_price
+            pdf.loc[level_mask, 'purchase_price'] = purchase_price
+            pdf.loc[level_mask, 'ic_up'] = (purchase_price + (wafer_price + level_df['wafer_amt'] +
+                                                              level_df['ft_amt']) / total_yld).round(2)
+            pdf.loc[level_mask, 'die_up'] = (purchase_price + (wafer_price + level_df['wafer_amt']) /
+                                             total_yld).round(2)
+            pdf.loc[level_mask, 'ft_up'] = (level_df['ft_amt'] / total_yld).round(2)
+        source_df = pd.concat([source_df, pdf.loc[level_mask, ['grain_id', 'wafer_price', 'ic_up']]], axis=0)
+    return pdf
@@ -0,0 +1,71 @@
+from django.db import connection
+
+import time
+
+BULK_BATCH_ROWS = 2000  # 初始每批行数
+BULK_MIN_ROWS = 200
+BULK_MAX_ROWS = 20000
+BULK_BATCH_SECONDS = 1.0  # 每批目标耗时, 按实际耗时调整下一批的行数
+
+
+def get_raw_cursor(cursor):
+    """取出Django及数据库后端包装下的原始pyodbc cursor"""
+    while hasattr(cursor, 'cursor'):
+        cursor = cursor.cursor
+    return cursor
+
+
+def adapt_batch_size(batch_size, elapsed):
+    if elapsed < BULK_BATCH_SECONDS / 2:
+        return min(batch_size * 2, BULK_MAX_ROWS)
+    if elapsed > BULK_BATCH_SECONDS * 2:
+        return max(batch_size // 2, BULK_MIN_ROWS)
+    return batch_size
+
+
+def insert_with_executemany(model, columns, rows):
+    """SQL Server: 开启pyodbc的fast_executemany, 每批参数数组一次发送"""
+    table = connection.ops.quote_name(model._meta.db_table)
+    column_sql = ', '.join(connection.ops.quote_name(model._meta.get_field(name).column) for name in columns)
+    sql = 'insert into {}({}) values({})'.format(table, column_sql, ', '.join(['%s'] * len(columns)))
+    batch_size = BULK_BATCH_ROWS
+    start = 0
+    with connection.cursor() as cursor:
+        raw_cursor = get_raw_cursor(cursor)
+        raw_cursor.fast_executemany = True
+        try:
+            while start < len(rows):
+                batch = [tuple(row[name] for name in columns) for row in rows[start:start + batch_size]]
+                begin = time.time()
+                cursor.executemany(sql, batch)
+                start += len(batch)
+                batch_size = adapt_batch_size(batch_size, time.time() - begin)
+        finally:
+            raw_cursor.fast_executemany = False
+
+
+def insert_with_bulk_create(model, rows):
+    """其他数据库: bulk_create, 单条语句的行数由数据库参数上限决定"""
+    batch_size = BULK_BATCH_ROWS
+    start = 0
+    while start < len(rows):
+        objs = [model(**row) for row in rows[start:start + batch_size]]
+        begin = time.time()
+        model.objects.bulk_create(objs)
+        start += len(objs)
+        batch_size = adapt_batch_size(batch_size, time.time() - begin)
+
+
+def bulk_insert(model, rows):
+    """
+    批量写入model对应的表, rows为{字段名(外键用xxx_id): 值}的列表, 各行字段需一致
+    需在调用方的事务中执行
+    """
+    if not rows:
+        return 0
+    columns = list(rows[0].keys())
+    if connection.vendor == 'microsoft':
+        insert_with_executemany(model, columns, rows)
+    else:
+        insert_with_bulk_create(model, rows)
+    return len(rows)
@@ -3,12 +3,18 @@ from pandas._libs.tslibs.timestamps import Timestamp
 
 import time
 import os
-import pandas as pd
-import numpy as np
 import re
 import datetime
 
 
+QUERY_CHUNK_SIZE = 1000  # SQL Server单条语句最多2100个参数, in查询按此分批
+
+
+def chunked(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 def create_suffix():
     ts = time.time()
@@ -56,17 +62,14 @@ wafer_price_map = {
 }
 
 
-def analysis_wafer_price(datas):
-    if not datas:
-        return pd.DataFrame([])
-    df = pd.DataFrame(datas)
-    df = df[list(wafer_price_map.keys())]
-    df.rename(columns=wafer_price_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    ndf['order_date'] = ndf['order_date'].apply(trans_time, args=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'))
-    ndf['purchase_price'] = ndf['purchase_price'].map(lambda x: float(x) if x else x)
-    return ndf
+def clean_wafer_price_row(data):
+    """整理导入的一行wafer成本"""
+    purchase_price = data['purchase_price']
+    return dict(
+        data,
+        order_date=trans_time(data['order_date'], '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'),
+        purchase_price=float(purchase_price) if purchase_price else purchase_price,
+    )
 
 
 grain_yield_map = {
@@ -86,17 +89,6 @@ grain_yield_map = {
 }
 
 
-def analysis_grain_yield(datas):
-    if not datas:
-        return pd.DataFrame([])
-    df = pd.DataFrame(datas)
-    df = df[list(grain_yield_map.keys())]
-    df.rename(columns=grain_yield_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    return ndf
-
-
 grain_price_map = {
     'PN': 'grain_id',
     '采购单价': 'purchase_price',
@@ -114,14 +106,3 @@ grain_price_map = {
     'FT6 U/P': 'ft6_up',
     'MSP U/P': 'msp_up'
 }
-
-
-def analysis_grain_price(datas):
-    if not datas:
-        return pd.DataFrame([])
-    df = pd.DataFrame(datas)
-    df = df[list(grain_price_map.keys())]
-    df.rename(columns=grain_price_map, inplace=True)
-    df = df.replace({np.nan: None})
-    ndf = df.copy()
-    return ndf
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from pwm_cost.price_utils import rebuild_latest_wafer_price
+
+
+class Command(BaseCommand):
+    help = '根据wafer成本记录重建每个wafer的最新成本表'
+
+    def handle(self, *args, **options):
+        total = rebuild_latest_wafer_price()
+        self.stdout.write('重建完成, 共{}个wafer'.format(total))
@@ -122,6 +122,7 @@ class WaferPrice(models.Model):
         db_table = 'pwm_cost_wafer_price'
         verbose_name = 'wafer单价维护记录'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def project_name(self):
@@ -171,6 +172,22 @@ class WaferPrice(models.Model):
         return 'delete success'
 
 
+class WaferLatestPrice(models.Model):
+    """
+    每个wafer最新一条有效的成本记录, 在wafer成本增删改时维护, 供颗粒测试费测算直接查询
+    """
+    wafer = models.OneToOneField(WaferInfo, verbose_name='wafer', on_delete=models.CASCADE, primary_key=True,
+                                 related_name='latest_price')
+    price = models.ForeignKey(WaferPrice, verbose_name='成本记录', on_delete=models.CASCADE)
+    wafer_price = models.DecimalField(verbose_name='Wafer U/P', max_digits=12, decimal_places=2, null=True)
+    create_time = models.DateTimeField(verbose_name='提交时间')
+
+    class Meta:
+        db_table = 'pwm_cost_wafer_latest_price'
+        verbose_name = 'wafer最新成本'
+        verbose_name_plural = verbose_name
+
+
 class GrainInfo(models.Model):
     general_type = (
         ('颗粒', '颗粒'),
@@ -274,6 +291,7 @@ class GrainYield(models.Model):
         db_table = 'pwm_cost_grain_yld'
         verbose_name = '良率维护记录'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def user_name(self):
@@ -341,6 +359,7 @@ class GrainUnitPrice(models.Model):
         db_table = 'pwm_cost_grain_price'
         verbose_name = '加工费维护记录'
         verbose_name_plural = verbose_name
+        indexes = [models.Index(fields=['create_time', 'id'])]  # 列表按(create_time, id)游标分页
 
     @property
     def user_name(self):
@@ -0,0 +1,43 @@
+from django.db import transaction
+from django.db.models import Max
+
+from pwm_cost.ext_utils import chunked
+from pwm_cost.models import GrainInfo, WaferPrice, WaferLatestPrice
+
+
+def refresh_latest_wafer_price(wafer_ids):
+    """重新计算wafer的最新有效成本记录, wafer成本新增、修改、删除后调用"""
+    wafer_ids = {wafer_id for wafer_id in wafer_ids if wafer_id}
+    for chunk in chunked(wafer_ids):
+        latest_ids = WaferPrice.objects.filter(wafer_id__in=chunk).values('wafer_id').annotate(
+            max_id=Max('id')).values_list('max_id', flat=True)
+        latest_objs = [WaferLatestPrice(wafer_id=item['wafer_id'], price_id=item['id'],
+                                        wafer_price=item['wafer_price'], create_time=item['create_time'])
+                       for item in WaferPrice.objects.filter(id__in=list(latest_ids)).values(
+                           'id', 'wafer_id', 'wafer_price', 'create_time')]
+        with transaction.atomic():
+            WaferLatestPrice.objects.filter(wafer_id__in=chunk).delete()
+            WaferLatestPrice.objects.bulk_create(latest_objs, batch_size=500)
+
+
+def rebuild_latest_wafer_price():
+    """根据所有wafer成本记录重建最新成本表"""
+    wafer_ids = WaferPrice.objects.values_list('wafer_id', flat=True).distinct()
+    stale_ids = WaferLatestPrice.objects.exclude(wafer_id__in=wafer_ids).values_list('wafer_id', flat=True)
+    for chunk in chunked(stale_ids):
+        WaferLatestPrice.objects.filter(wafer_id__in=chunk).delete()
+    wafer_ids = list(wafer_ids)
+    refresh_latest_wafer_price(wafer_ids)
+    return len(wafer_ids)
+
+
+def query_wafer_price(ids):
+    """查询颗粒关联wafer的最新成本, 颗粒较多时分批查询"""
+    datas = []
+    for chunk in chunked(ids):
+        qs = GrainInfo.objects.filter(id__in=chunk, wafer__latest_price__isnull=False).values(
+            'wafer_id', 'id', 'wafer__latest_price__wafer_price', 'wafer__latest_price__create_time')
+        datas.extend({'wafer_id': item['wafer_id'], 'grain_id': item['id'],
+                      'wafer_price': item['wafer__latest_price__wafer_price'],
+                      'create_time': item['wafer__latest_price__create_time']} for item in qs)
+    return datas
@@ -1,3 +1,175 @@
 from django.test import TestCase
+from pandas.testing import assert_frame_equal
+from unittest import mock
 
-# Create your tests here.
+from pwm_cost import bulk_utils, upload_sessions
+from pwm_cost.bom_utils import BomCycleError, get_bom_levels
+from pwm_cost.models import WaferInfo, WaferBom, WaferPrice, GrainInfo
+from pwm_cost.views import calculate_wafer_price, calculate_yield, WAFER_YIELD_COLUMNS, FT_YIELD_COLUMNS
+
+import numpy as np
+import pandas as pd
+import tempfile
+
+
+class CalculateWaferPriceTest(TestCase):
+
+    def upload_df(self, prices):
+        wafer_ids = list(prices.keys())
+        return pd.DataFrame({
+            'wafer_id': wafer_ids,
+            'price_source': ['报价'] * len(wafer_ids),
+            'supplier': ['供应商'] * len(wafer_ids),
+            'purchase_price': list(prices.values()),
+            'order_date': ['2022-01-01'] * len(wafer_ids),
+        })
+
+    def create_bom_wafers(self, count, start=0):
+        """每个合成wafer由S1 x1, S2 x2, 以及一个不在上传数据中的S3组成"""
+        for i in range(start, start + count):
+            bom_id = 'BOM{}'.format(i)
+            WaferInfo.objects.create(id=bom_id, has_bom=True)
+            WaferBom.objects.create(belong_wafer_id=bom_id, wafer_source_id='S1', count=1)
+            WaferBom.objects.create(belong_wafer_id=bom_id, wafer_source_id='S2', count=2)
+            WaferBom.objects.create(belong_wafer_id=bom_id, wafer_source_id='S3', count=3)
+
+    def setUp(self):
+        for wafer_id in ['S1', 'S2', 'S3']:
+            WaferInfo.objects.create(id=wafer_id)
+        WaferInfo.objects.create(id='DEL', has_bom=True, is_delete=True)
+        WaferBom.objects.create(belong_wafer_id='DEL', wafer_source_id='S1', count=1)
+
+    def test_bom_price(self):
+        self.create_bom_wafers(2)
+        datas = calculate_wafer_price(self.upload_df({'S1': 10.5, 'S2': 100.123}))
+        prices = {d['wafer_id']: d['wafer_price'] for d in datas}
+        self.assertEqual(prices, {'S1': 10.5, 'S2': 100.123, 'BOM0': 210.75, 'BOM1': 210.75})
+        self.assertEqual([d['wafer_id'] for d in datas], ['S1', 'S2', 'BOM0', 'BOM1'])
+
+    def test_bom_without_source_price(self):
+        WaferInfo.objects.create(id='EMPTY', has_bom=True)
+        WaferBom.objects.create(belong_wafer_id='EMPTY', wafer_source_id='S3', count=1)
+        self.create_bom_wafers(1)
+        datas = calculate_wafer_price(self.upload_df({'S1': 1, 'S2': None}))
+        prices = {d['wafer_id']: d['wafer_price'] for d in datas}
+        # S3不在上传数据中, EMPTY没有可用的来源价格不返回; S2没有价格按0计
+        self.assertEqual(prices, {'S1': 1, 'S2': None, 'BOM0': 1})
+
+    def test_query_count_is_constant(self):
+        self.create_bom_wafers(1)
+        with self.assertNumQueries(3):
+            calculate_wafer_price(self.upload_df({'S1': 1, 'S2': 2}))
+        self.create_bom_wafers(50, start=1)
+        with self.assertNumQueries(3):
+            datas = calculate_wafer_price(self.upload_df({'S1': 1, 'S2': 2}))
+        self.assertEqual(len(datas), 53)
+
+
+class BomLevelTest(TestCase):
+
+    def edge_df(self, edges):
+        return pd.DataFrame(edges, columns=['belong_grain_id', 'grain_source_id', 'count'])
+
+    def test_levels(self):
+        # PKG由MCP和裸片D1组成, MCP由D1/D2组成
+        edge_df = self.edge_df([('PKG', 'MCP', 1), ('PKG', 'D1', 1), ('MCP', 'D1', 2), ('MCP', 'D2', 1),
+                                ('OTHER', 'D2', 4)])
+        self.assertEqual(get_bom_levels(['PKG', 'MCP', 'OTHER'], edge_df), [['MCP', 'OTHER'], ['PKG']])
+
+    def test_cycle(self):
+        edge_df = self.edge_df([('A', 'B', 1), ('B', 'C', 1), ('C', 'A', 1), ('D', 'A', 1), ('E', 'X', 1)])
+        with self.assertRaises(BomCycleError):
+            get_bom_levels(['A', 'B', 'C', 'D', 'E'], edge_df)
+
+
+class BulkInsertTest(TestCase):
+
+    def test_insert_in_batches(self):
+        WaferInfo.objects.create(id='W1')
+        rows = [{'wafer_id': 'W1', 'purchase_price': i, 'maintain_period': '2022-01'} for i in range(2500)]
+        with mock.patch.object(bulk_utils, 'BULK_BATCH_ROWS', 300):
+            self.assertEqual(bulk_utils.bulk_insert(WaferPrice, rows), 2500)
+        self.assertEqual(WaferPrice.objects.count(), 2500)
+        self.assertEqual(sorted(WaferPrice.objects.values_list('purchase_price', flat=True)), list(range(2500)))
+        self.assertEqual(bulk_utils.bulk_insert(WaferPrice, []), 0)
+
+    def test_adapt_batch_size(self):
+        self.assertEqual(bulk_utils.adapt_batch_size(1000, 0.1), 2000)
+        self.assertEqual(bulk_utils.adapt_batch_size(1000, 1), 1000)
+        self.assertEqual(bulk_utils.adapt_batch_size(1000, 5), 500)
+        self.assertEqual(bulk_utils.adapt_batch_size(bulk_utils.BULK_MAX_ROWS, 0.1), bulk_utils.BULK_MAX_ROWS)
+        self.assertEqual(bulk_utils.adapt_batch_size(bulk_utils.BULK_MIN_ROWS, 5), bulk_utils.BULK_MIN_ROWS)
+
+
+class UploadSessionTest(TestCase):
+
+    def test_apply_changes(self):
+        df = pd.DataFrame({'grain_id': ['A', 'B', 'B', 'C'], 'ap_yld': [0.9, 0.8, 0.8, 0.7], 'bi_yld': [1, 1, 1, 1]})
+        changed = [{'grain_id': 'B', 'ap_yld': 0.5}, {'grain_id': 'D', 'ap_yld': 0.6, 'bi_yld': 0.9}]
+        ndf = upload_sessions.apply_changes(df, 'grain_id', changed, ['C'])
+        self.assertEqual(list(ndf['grain_id']), ['A', 'B', 'B', 'D'])
+        self.assertEqual(list(ndf['ap_yld']), [0.9, 0.5, 0.5, 0.6])
+        self.assertEqual(list(ndf['bi_yld']), [1, 1, 1, 0.9])
+
+    def test_session_frames(self):
+        with tempfile.TemporaryDirectory() as session_dir, \
+                mock.patch.object(upload_sessions, 'SESSION_DIR', session_dir):
+            session_id = upload_sessions.create_upload_session()
+            df = pd.DataFrame({'wafer_id': ['W1', 'W2'], 'purchase_price': [1.5, None]})
+            upload_sessions.save_session_frame(session_id, 'wafer_input', df)
+            self.assertTrue(upload_sessions.load_session_frame(session_id, 'wafer_input').equals(df))
+            self.assertFalse(upload_sessions.has_session_frame(session_id, 'wafer_result'))
+            upload_sessions.remove_upload_session(session_id)
+            with self.assertRaises(upload_sessions.UploadSessionError):
+                upload_sessions.load_session_frame(session_id, 'wafer_input')
+            with self.assertRaises(upload_sessions.UploadSessionError):
+                upload_sessions.load_session_frame('../' + session_id, 'wafer_input')
+
+
+# 原逐颗粒设置bom良率的实现, 作为calculate_yield的对照
+def legacy_calculate_yield(ydf):
+    ydf.fillna(1, inplace=True)
+    ydf['wafer_yld'] = round(ydf['hb_yld'] * ydf['cp_yld'] * ydf['rdl_yld'] * ydf['bp_yld'], 4)
+    ydf['ft_yld'] = round(ydf['ap_yld'] * ydf['bi_yld'] * ydf['ft1_yld'] * ydf['ft2_yld']
+                          * ydf['ft3_yld'] * ydf['ft4_yld'] * ydf['ft5_yld'] * ydf['ft6_yld'], 4)
+    grain_id_ls = list(ydf['grain_id'].unique())
+    grain_qs = GrainInfo.objects.filter(id__in=grain_id_ls, is_delete=False).values('id', 'wafer_id', 'has_bom')
+    info_df = pd.DataFrame(list(grain_qs))
+    info_df.rename(columns={'id': 'grain_id'}, inplace=True)
+    ydf = pd.merge(ydf, info_df, how='outer', on='grain_id')
+    y_datas = ydf.to_dict('records')
+    for d in y_datas:
+        if d['has_bom']:
+            ydf.loc[ydf['grain_id'] == d['grain_id'], ['hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'wafer_yld']] = 1
+    ydf[ydf.columns.difference(['grain_id', 'has_bom', 'wafer_id'])] \
+        = round(ydf[ydf.columns.difference(['grain_id', 'has_bom', 'wafer_id'])], 4)
+    return ydf.to_dict('records')
+
+
+class CalculateYieldTest(TestCase):
+
+    def setUp(self):
+        GrainInfo.objects.bulk_create([GrainInfo(id='G{}'.format(i), has_bom=bool(i % 2)) for i in range(200)])
+        GrainInfo.objects.filter(id='G10').update(is_delete=True)
+
+    def yield_df(self, count, grain_count):
+        rng = np.random.RandomState(count)
+        values = rng.uniform(0.9, 1, (count, len(WAFER_YIELD_COLUMNS + FT_YIELD_COLUMNS)))
+        values[rng.rand(*values.shape) < 0.1] = np.nan
+        ydf = pd.DataFrame(values, columns=WAFER_YIELD_COLUMNS + FT_YIELD_COLUMNS)
+        ydf.insert(0, 'grain_id', ['G{}'.format(i) for i in rng.randint(0, grain_count, count)])
+        return ydf
+
+    def test_same_as_legacy(self):
+        # 包含重复颗粒、已删除颗粒(G10)和未登记的颗粒(G200之后)
+        ydf = self.yield_df(60, 220)
+        ydf.loc[0, 'grain_id'] = 'G10'
+        expected = pd.DataFrame(legacy_calculate_yield(ydf.copy()))
+        result = pd.DataFrame(calculate_yield(ydf.copy()))
+        assert_frame_equal(expected, result, check_dtype=False)
+
+    def test_query_count_is_constant(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(calculate_yield(self.yield_df(10, 200))), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(calculate_yield(self.yield_df(5000, 200))), 5000)
@@ -0,0 +1,141 @@
+from django.conf import settings
+
+import pandas as pd
+
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+import uuid
+import logging
+
+logger = logging.getLogger('django')
+
+# 导入数据解析后按会话保存在本地磁盘, 重新测算和保存时只需提交会话id和修改的行
+SESSION_DIR = settings.UPLOAD_SESSION_DIR
+SESSION_MAX_AGE = 4 * 3600  # 超过该时长未使用的会话会被清理(秒)
+SESSION_MAX_BYTES = 500 * 1024 * 1024  # 会话目录最大占用
+
+evict_lock = threading.Lock()
+
+
+class UploadSessionError(ValueError):
+    """导入会话不存在或已过期"""
+    pass
+
+
+def get_session_dir(session_id):
+    if not isinstance(session_id, str) or not re.fullmatch(r'[0-9a-f]{32}', session_id):
+        raise UploadSessionError('导入会话无效, 请重新上传')
+    return os.path.join(SESSION_DIR, session_id)
+
+
+def get_dir_size(path):
+    total_size = 0
+    for name in os.listdir(path):
+        try:
+            total_size += os.stat(os.path.join(path, name)).st_size
+        except FileNotFoundError:
+            continue
+    return total_size
+
+
+def evict_upload_sessions():
+    """清理超过时长未使用的会话, 并按最近使用时间把会话目录控制在限定大小内"""
+    if not evict_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        sessions = []
+        for name in os.listdir(SESSION_DIR):
+            path = os.path.join(SESSION_DIR, name)
+            try:
+                sessions.append((os.stat(path).st_mtime, get_dir_size(path), path))
+            except FileNotFoundError:
+                continue
+        sessions.sort()
+        total_size = sum(size for _, size, _ in sessions)
+        for mtime, size, path in sessions:
+            if now - mtime <= SESSION_MAX_AGE and total_size <= SESSION_MAX_BYTES:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+    except Exception:
+        logger.error('清理导入会话失败, error: {}'.format(traceback.format_exc()))
+    finally:
+        evict_lock.release()
+
+
+def create_upload_session():
+    """新建导入会话, 返回会话id"""
+    if os.path.exists(SESSION_DIR):
+        evict_upload_sessions()
+    session_id = uuid.uuid4().hex
+    os.makedirs(get_session_dir(session_id), exist_ok=True)
+    return session_id
+
+
+def save_session_frame(session_id, name, df):
+    """保存会话中的一份数据, 先写临时文件再替换, 避免其他进程读到写了一半的文件"""
+    session_dir = get_session_dir(session_id)
+    if not os.path.exists(session_dir):
+        raise UploadSessionError('导入数据已过期, 请重新上传')
+    file_path = os.path.join(session_dir, '{}.pkl'.format(name))
+    temp_path = '{}.{}.{}.tmp'.format(file_path, os.getpid(), threading.get_ident())
+    df.to_pickle(temp_path)
+    os.replace(temp_path, file_path)
+    os.utime(session_dir)
+
+
+def load_session_frame(session_id, name):
+    session_dir = get_session_dir(session_id)
+    try:
+        df = pd.read_pickle(os.path.join(session_dir, '{}.pkl'.format(name)))
+    except FileNotFoundError:
+        raise UploadSessionError('导入数据已过期, 请重新上传')
+    os.utime(session_dir)
+    return df
+
+
+def has_session_frame(session_id, name):
+    return os.path.exists(os.path.join(get_session_dir(session_id), '{}.pkl'.format(name)))
+
+
+def remove_upload_session(session_id):
+    """数据保存后删除导入会话"""
+    shutil.rmtree(get_session_dir(session_id), ignore_errors=True)
+
+
+def apply_changes(df, key, changed=None, deleted=None):
+    """
+    按key合并前端修改的数据: changed中已有key的行更新提交的列, 新的key追加到末尾; deleted中的key删除
+    """
+    if deleted:
+        df = df[~df[key].isin(deleted)]
+    if not changed:
+        return df.reset_index(drop=True)
+    df = df.reset_index(drop=True)
+    exist_keys = set(df[key])
+    columns = []
+    for row in changed:
+        columns.extend(column for column in row if column not in columns)
+    # 只更新每行实际提交的列
+    for column in columns:
+        values = {row[key]: row[column] for row in changed if column in row and row[key] in exist_keys}
+        if not values:
+            continue
+        if column not in df.columns:
+            df[column] = None
+        mask = df[key].isin(list(values.keys()))
+        df.loc[mask, column] = df.loc[mask, key].map(values)
+    new_rows = {row[key]: row for row in changed if row[key] not in exist_keys}
+    if not new_rows:
+        return df
+    return pd.concat([df, pd.DataFrame(list(new_rows.values()))], axis=0, sort=False).reset_index(drop=True)
+
+
+def frame_records(df):
+    """DataFrame转为记录列表, 空值转为None"""
+    return df.astype(object).where(pd.notnull(df), None).to_dict('records')
@@ -5,7 +5,7 @@ from rest_framework import filters, status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.db import connection, close_old_connections, transaction
+from django.db import close_old_connections, transaction
 from utils.pagination import MyPagePagination
 
 from pwm_cost.serializers import WaferInfoSerializer, WaferBomSerializer, GrainBomSerializer, GrainInfoSerializer, \
@@ -13,9 +13,16 @@ from pwm_cost.serializers import WaferInfoSerializer, WaferBomSerializer, GrainB
 from pwm_cost.models import WaferInfo, WaferBom, GrainInfo, GrainBom, UploadRecord, WaferPrice, GrainYield, \
     GrainUnitPrice
 from equipments.ext_utils import REST_FAIL, REST_SUCCESS, VIEW_FAIL, VIEW_SUCCESS, \
-    create_excel_resp, execute_batch_sql, dictfetchall
+    create_excel_buffer, create_excel_resp, iter_excel_rows
+from reports.export_jobs import export_task
 from utils.log_utils import set_create_log, set_update_log, set_delete_log
-from pwm_cost.ext_utils import get_file_path, analysis_wafer_price, analysis_grain_yield, analysis_grain_price
+from pwm_cost.ext_utils import get_file_path, chunked, clean_wafer_price_row, wafer_price_map, grain_yield_map, \
+    grain_price_map
+from pwm_cost.bom_utils import load_grain_bom, rollup_grain_price
+from pwm_cost.price_utils import query_wafer_price, refresh_latest_wafer_price
+from pwm_cost.bulk_utils import bulk_insert
+from pwm_cost.upload_sessions import UploadSessionError, create_upload_session, save_session_frame, \
+    load_session_frame, has_session_frame, remove_upload_session, apply_changes, frame_records
 from decimal import Decimal
 from users.models import User
 
@@ -439,7 +446,10 @@ class UploadRecordOperate(generics.DestroyAPIView):
             save_id = transaction.savepoint()
             try:
                 if data_type == 1:
-                    WaferPrice.objects.filter(upload_id=del_id).delete()
+                    wafer_price_qs = WaferPrice.objects.filter(upload_id=del_id)
+                    wafer_ids = list(wafer_price_qs.values_list('wafer_id', flat=True).distinct())
+                    wafer_price_qs.delete()
+                    refresh_latest_wafer_price(wafer_ids)
                 elif data_type == 2:
                     GrainYield.objects.filter(upload_id=del_id).delete()
                 elif data_type == 3:
@@ -493,6 +503,7 @@ class WaferPriceGeneric(generics.ListCreateAPIView):
         data.update({'user': request.user})
         serializer.validated_data.update(data)
         self.perform_create(serializer)
+        refresh_latest_wafer_price([serializer.instance.wafer_id])
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
@@ -504,10 +515,16 @@ class WaferPriceOperate(generics.RetrieveUpdateDestroyAPIView):
     table_name = model._meta.db_table
     verbose_name = model._meta.verbose_name
 
+    def perform_update(self, serializer):
+        old_wafer_id = serializer.instance.wafer_id
+        serializer.save()
+        refresh_latest_wafer_price([old_wafer_id, serializer.instance.wafer_id])
+
     @set_delete_log
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         self.perform_destroy(instance)
+        refresh_latest_wafer_price([instance.wafer_id])
         return REST_SUCCESS({'msg': '删除成功'})
 
 
@@ -539,22 +556,21 @@ def calculate_wafer_price(ndf):
     info_df.rename(columns={'id': 'wafer_id', 'project__name': 'project_name'}, inplace=True)
     ndf = pd.merge(ndf, info_df, how='outer', on='wafer_id')
     mdf = ndf.replace({np.nan: None})
-    datas = mdf.to_dict('records')
-    final_datas = []
-    for d in datas:
-        if d['has_bom']:
-            wafer_obj = WaferInfo.objects.get(id=d['wafer_id']).belong_wafer.values('wafer_source_id', 'count')
-            source_df = pd.DataFrame(list(wafer_obj))
-            source_df.rename(columns={'wafer_source_id': 'wafer_id'}, inplace=True)
-            bom_df = pd.merge(source_df, mdf, how='inner', on='wafer_id')
-            if not bom_df.empty:
-                bom_df['sum'] = bom_df['purchase_price'] * bom_df['count']
-                d['wafer_price'] = round(bom_df['sum'].sum(), 2)
-                final_datas.append(d)
-        else:
-            d['wafer_price'] = d['purchase_price']
-            final_datas.append(d)
-    return final_datas
+    # 一次查出所有有bom的wafer的组成明细, 按来源wafer的采购单价汇总
+    edge_qs = WaferBom.objects.filter(belong_wafer__has_bom=True, belong_wafer__is_delete=False).values(
+        'belong_wafer_id', 'wafer_source_id', 'count')
+    edge_df = pd.DataFrame(list(edge_qs), columns=['belong_wafer_id', 'wafer_source_id', 'count'])
+    source_df = mdf[['wafer_id', 'purchase_price']].rename(columns={'wafer_id': 'wafer_source_id'})
+    bom_df = pd.merge(edge_df, source_df, how='inner', on='wafer_source_id')
+    bom_df['sum'] = bom_df['purchase_price'].astype(float) * bom_df['count']
+    bom_price = bom_df.groupby('belong_wafer_id')['sum'].sum()
+
+    mdf['wafer_price'] = mdf['purchase_price']
+    bom_mask = mdf['has_bom'] == True
+    mdf.loc[bom_mask, 'wafer_price'] = mdf.loc[bom_mask, 'wafer_id'].map(bom_price).round(2)
+    # 有bom但找不到任何来源wafer价格的不返回
+    mdf = mdf[~bom_mask | mdf['wafer_id'].isin(bom_price.index)]
+    return mdf.to_dict('records')
 
 
 # 导入wafer成本
@@ -573,19 +589,37 @@ def upload_wafer_price(request):
             logger.error('文件解析出错, error:{}'.format(str(e)))
             return VIEW_FAIL(msg='文件解析出错, error:{}'.format(str(e)))
         res_data = {'upload_file_name': file_name}
-        df = pd.read_excel(upload_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        ndf = analysis_wafer_price(datas)
+        # 逐行读取整理后直接生成DataFrame
+        rows = [clean_wafer_price_row(data) for _, data in iter_excel_rows(upload_path, wafer_price_map)]
+        ndf = pd.DataFrame(rows, columns=list(wafer_price_map.values()))
         if ndf.empty:
             res_data['datas'] = []
             return VIEW_SUCCESS(msg='导入成功', data=res_data)
-        res_data['datas'] = calculate_wafer_price(ndf)
+        datas = calculate_wafer_price(ndf.copy())
+        # 解析结果保存在导入会话中, 重新测算和保存时只需提交修改的行
+        session_id = create_upload_session()
+        save_session_frame(session_id, 'wafer_input', ndf)
+        save_session_frame(session_id, 'wafer_result', pd.DataFrame(datas))
+        res_data['session_id'] = session_id
+        res_data['datas'] = datas
         return VIEW_SUCCESS(msg='导入成功', data=res_data)
     except Exception as e:
         logger.error('文件解析出错, error:{}'.format(str(e)))
         return VIEW_FAIL(msg='文件解析出错, 请按照导入模板导入数据', data={'error': str(e)})
 
 
+WAFER_INPUT_COLUMNS = ['wafer_id', 'price_source', 'supplier', 'purchase_price', 'order_date']
+
+
+# 整理重新测算提交的wafer成本
+def prepare_wafer_input(ndf):
+    base_df = pd.DataFrame(columns=WAFER_INPUT_COLUMNS, dtype=object)
+    ndf = pd.concat([base_df, ndf], axis=0)
+    ndf = ndf[WAFER_INPUT_COLUMNS]
+    ndf['purchase_price'] = ndf['purchase_price'].map(lambda x: float(x) if x else x)
+    return ndf
+
+
 # 重新测算成本
 @api_view(['POST'])
 def recalculate_wafer_price(request):
@@ -594,22 +628,32 @@ def recalculate_wafer_price(request):
             req_dic = json.loads(request.body)
         except Exception as e:
             return REST_FAIL({'msg': '请求参数解析错误,请确认格式正确后上传', 'error': str(e)})
-        datas = req_dic.get('datas', [])
-        if not datas:
+        session_id = req_dic.get('session_id')
+        if session_id:
+            # 导入会话中的数据合并本次修改的行
+            ndf = apply_changes(load_session_frame(session_id, 'wafer_input'), 'wafer_id',
+                                req_dic.get('changed'), req_dic.get('deleted'))
+        else:
+            ndf = pd.DataFrame(req_dic.get('datas', []))
+        if ndf.empty:
             return REST_FAIL({'msg': '提交数据不能为空'})
-        ndf = pd.DataFrame(datas)
-        base_df = pd.DataFrame(columns=['wafer_id', 'price_source', 'supplier', 'purchase_price', 'order_date'],
-                               dtype=object)
-        ndf = pd.concat([base_df, ndf], axis=0)
-        ndf = ndf[['wafer_id', 'price_source', 'supplier', 'purchase_price', 'order_date']]
-        ndf['purchase_price'] = ndf['purchase_price'].map(lambda x: float(x) if x else x)
-        datas = calculate_wafer_price(ndf)
+        ndf = prepare_wafer_input(ndf)
+        datas = calculate_wafer_price(ndf.copy())
+        if session_id:
+            save_session_frame(session_id, 'wafer_input', ndf)
+            save_session_frame(session_id, 'wafer_result', pd.DataFrame(datas))
         return REST_SUCCESS(data=datas)
+    except UploadSessionError as e:
+        return REST_FAIL({'msg': str(e)})
     except Exception as e:
         logger.error('测算出错, error:{}'.format(str(e)))
         return REST_FAIL({'msg': '测算出错', 'error': str(e)})
 
 
+# 导入wafer成本时从提交数据中取值的字段
+WAFER_PRICE_FIELDS = ['wafer_id', 'price_source', 'supplier', 'purchase_price', 'order_date', 'wafer_price']
+
+
 # 保存导入的数据
 @api_view(['POST'])
 def save_upload_wafer_price(request):
@@ -621,12 +665,20 @@ def save_upload_wafer_price(request):
         user = request.user
         file_path = req_dic.get('upload_file_name')
         maintain_period = datetime.datetime.now().strftime('%Y-%m')
-        datas = req_dic.get('datas', [])
+        session_id = req_dic.get('session_id')
+        if session_id:
+            datas = frame_records(apply_changes(load_session_frame(session_id, 'wafer_result'), 'wafer_id',
+                                                req_dic.get('changed'), req_dic.get('deleted')))
+        else:
+            datas = req_dic.get('datas', [])
         if not datas:
             return REST_FAIL({'msg': '提交数据不能为空'})
-        insert_sql = '''insert into pwm_cost_wafer_price(price_source, supplier, purchase_price, order_date,wafer_price, 
-                                    maintain_period, create_time, update_time, is_delete, upload_id, wafer_id, user_id)
-                                    values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
+        insert_ls = []
+        for count, data in enumerate(datas, 1):
+            wafer_id = data.get('wafer_id')
+            if not wafer_id:
+                return REST_SUCCESS({'msg': 'wafer型号不能为空, 空值所在行: {}'.format(count)})
+            insert_ls.append({field: data.get(field) for field in WAFER_PRICE_FIELDS})
         close_old_connections()
         with transaction.atomic():
             save_id = transaction.savepoint()
@@ -636,29 +688,22 @@ def save_upload_wafer_price(request):
                     upload_id = upload_obj.id
                 else:
                     upload_id = None
-                count = 0
                 now_ts = datetime.datetime.now()
-                insert_ls = []
-                for data in datas:
-                    count += 1
-                    wafer_id = data.get('wafer_id')
-                    if not wafer_id:
-                        return REST_SUCCESS({'msg': 'wafer型号不能为空, 空值所在行: {}'.format(count)})
-                    insert_args = (data.get('price_source'), data.get('supplier'), data.get('purchase_price'),
-                                   data.get('order_date'), data.get('wafer_price'), maintain_period, now_ts, now_ts,
-                                   False, upload_id, wafer_id, user.id)
-                    insert_ls.append(insert_args)
-                    if len(insert_ls) >= 50:
-                        execute_batch_sql(insert_sql, insert_ls)
-                        insert_ls = []
-                if len(insert_ls) > 0:
-                    execute_batch_sql(insert_sql, insert_ls)
+                for insert_dic in insert_ls:
+                    insert_dic.update(maintain_period=maintain_period, create_time=now_ts, update_time=now_ts,
+                                      is_delete=False, upload_id=upload_id, user_id=user.id)
+                bulk_insert(WaferPrice, insert_ls)
+                refresh_latest_wafer_price([data.get('wafer_id') for data in datas])
                 transaction.savepoint_commit(save_id)
             except Exception as e:
                 transaction.savepoint_rollback(save_id)
                 logger.error('wafer价格数据保存失败, error:{}'.format(str(e)))
                 return REST_FAIL({'msg': '数据保存失败', 'error': str(e)})
+        if session_id:
+            remove_upload_session(session_id)
         return REST_SUCCESS({'msg': '提交成功'})
+    except UploadSessionError as e:
+        return REST_FAIL({'msg': str(e)})
     except Exception as e:
         logger.error('wafer价格数据保存失败, error:{}'.format(str(e)))
         return REST_FAIL({'msg': '数据保存失败', 'error': str(e)})
@@ -666,6 +711,7 @@ def save_upload_wafer_price(request):
 
 # 导出wafer成本信息
 @api_view(['GET'])
+@export_task('wafer_price')
 def export_wafer_price(request):
     try:
         queryset = WaferPrice.objects
@@ -713,8 +759,8 @@ def export_wafer_price(request):
             'user__username': '提交人'
         }
         ndf.rename(rename_maps, axis=1, inplace=True)
-        file_path, file_name = get_file_path('wafer', 'export_files')
-        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        excel_file = create_excel_buffer()
+        writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
         workbook = writer.book
         fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True, 'valign': 'vcenter'})
         center_fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True,
@@ -747,7 +793,7 @@ def export_wafer_price(request):
         worksheet.conditional_format('A1:M%d' % l_end, {'type': 'blanks', 'format': border_format})
         worksheet.conditional_format('A1:M%d' % l_end, {'type': 'no_blanks', 'format': border_format})
         writer.save()
-        return create_excel_resp(file_path, 'Wafer成本信息')
+        return create_excel_resp(excel_file, 'Wafer成本信息')
     except Exception as e:
         logger.error('导出失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '导出失败, error: {}'.format(str(e))})
@@ -873,21 +919,38 @@ def exist_wafer_price(request):
     return REST_SUCCESS(data={'exist_tag': exist_tag})
 
 
+WAFER_YIELD_COLUMNS = ['hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld']
+FT_YIELD_COLUMNS = ['ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld', 'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld']
+
+
+# 按列顺序连乘各段良率, 保留4位小数
+def multiply_yield(ydf, columns):
+    values = ydf[columns].values.astype(float)
+    result = values[:, 0].copy()
+    for i in range(1, len(columns)):
+        result *= values[:, i]
+    return np.round(result, 4)
+
+
+# 测算成本时使用的良率列
+GRAIN_YIELD_RESULT_COLUMNS = ['grain_id', 'wafer_yld', 'ft_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld', 'ft3_yld',
+                              'ft4_yld', 'ft5_yld', 'ft6_yld']
+
+
 # 计算良率
 def calculate_yield(ydf):
     ydf.fillna(1, inplace=True)
-    ydf['wafer_yld'] = round(ydf['hb_yld'] * ydf['cp_yld'] * ydf['rdl_yld'] * ydf['bp_yld'], 4)
-    ydf['ft_yld'] = round(ydf['ap_yld'] * ydf['bi_yld'] * ydf['ft1_yld'] * ydf['ft2_yld']
-                          * ydf['ft3_yld'] * ydf['ft4_yld'] * ydf['ft5_yld'] * ydf['ft6_yld'], 4)
-    grain_id_ls = list(ydf['grain_id'].unique())
-    grain_qs = GrainInfo.objects.filter(id__in=grain_id_ls, is_delete=False).values('id', 'wafer_id', 'has_bom')
-    info_df = pd.DataFrame(list(grain_qs))
+    ydf['wafer_yld'] = multiply_yield(ydf, WAFER_YIELD_COLUMNS)
+    ydf['ft_yld'] = multiply_yield(ydf, FT_YIELD_COLUMNS)
+    info_ls = []
+    for chunk in chunked(ydf['grain_id'].unique()):
+        info_ls.extend(GrainInfo.objects.filter(id__in=chunk, is_delete=False).values('id', 'wafer_id', 'has_bom'))
+    info_df = pd.DataFrame(info_ls, columns=['id', 'wafer_id', 'has_bom'])
     info_df.rename(columns={'id': 'grain_id'}, inplace=True)
     ydf = pd.merge(ydf, info_df, how='outer', on='grain_id')
-    y_datas = ydf.to_dict('records')
-    for d in y_datas:
-        if d['has_bom']:
-            ydf.loc[ydf['grain_id'] == d['grain_id'], ['hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'wafer_yld']] = 1
+    # 有bom的颗粒前段良率按1计, 未登记的颗粒(has_bom为空)同样处理
+    bom_mask = ydf['has_bom'].fillna(True).astype(bool)
+    ydf.loc[bom_mask, WAFER_YIELD_COLUMNS + ['wafer_yld']] = 1
     ydf[ydf.columns.difference(['grain_id', 'has_bom', 'wafer_id'])] \
         = round(ydf[ydf.columns.difference(['grain_id', 'has_bom', 'wafer_id'])], 4)
     return ydf.to_dict('records')
@@ -909,38 +972,24 @@ def upload_grain_yield(request):
             logger.error('文件解析出错, error:{}'.format(str(e)))
             return VIEW_FAIL(msg='文件解析出错, error:{}'.format(str(e)))
         res_data = {'upload_file_name': file_name}
-        df = pd.read_excel(upload_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        ndf = analysis_grain_yield(datas)
+        rows = [data for _, data in iter_excel_rows(upload_path, grain_yield_map)]
+        ndf = pd.DataFrame(rows, columns=list(grain_yield_map.values()))
         if ndf.empty:
             res_data['datas'] = []
             return VIEW_SUCCESS(msg='导入成功', data=res_data)
-        res_data['datas'] = calculate_yield(ndf)
+        datas = calculate_yield(ndf.copy())
+        # 解析结果保存在导入会话中, 导入测试费、重新测算和保存时只需提交会话id
+        session_id = create_upload_session()
+        save_session_frame(session_id, 'yield_input', ndf)
+        save_session_frame(session_id, 'yield_result', pd.DataFrame(datas))
+        res_data['session_id'] = session_id
+        res_data['datas'] = datas
         return VIEW_SUCCESS(msg='导入成功', data=res_data)
     except Exception as e:
         logger.error('文件解析出错, error:{}'.format(str(e)))
         return VIEW_FAIL(msg='文件解析出错, 请按照导入模板导入数据', data={'error': str(e)})
 
 
-# 查询wafer最新成本
-def query_wafer_price(ids):
-    sql = '''select a.wafer_id, b.id as grain_id, a.wafer_price, a.create_time
-                from (select * from pwm_cost_wafer_price wp inner join
-                        (select max(id) as max_id from pwm_cost_wafer_price
-                          where is_delete=0 group by wafer_id) as w_max
-                      on w_max.max_id=wp.id) a
-                inner join pwm_cost_grain_info b on a.wafer_id = b.wafer_id
-                where b.id {}'''
-    if len(ids) == 1:
-        fmt = "= '{}'".format(ids[0])
-    else:
-        fmt = 'in {}'.format(tuple(ids))
-    with connection.cursor() as cursor:
-        cursor.execute(sql.format(fmt))
-        qs = dictfetchall(cursor)
-    return qs
-
-
 # 计算测试费
 def calculate_grain_price(pdf, ydf):
     grain_id_ls = list(pdf['grain_id'].unique())
@@ -987,30 +1036,11 @@ def calculate_grain_price(pdf, ydf):
     pdf['die_up'] = round(pdf['purchase_price'] + ((pdf['wafer_price'] + pdf['wafer_amt']) /
                                                    (pdf['wafer_yld'] * pdf['ft_yld'] * pdf['gross_die'])), 2)
     pdf['ft_up'] = round(pdf['ft_amt'] / (pdf['wafer_yld'] * pdf['ft_yld'] * pdf['gross_die']), 2)
+    # 按bom层级自底向上计算有bom的颗粒成本
+    pdf = rollup_grain_price(pdf, load_grain_bom())
     nb_df = pdf[pdf['has_bom'] == False]  # 无bom
     eb_df = pdf[pdf['has_bom'] == True]  # 有bom
-    eb_datas = eb_df.to_dict('records')
-    # 计算有bom的颗粒的采购单价
-    for d in eb_datas:
-        grain_obj = GrainInfo.objects.get(id=d['grain_id']).belong_grain.values('grain_source_id', 'count')
-        source_df = pd.DataFrame(list(grain_obj))
-        source_df.rename(columns={'grain_source_id': 'grain_id'}, inplace=True)
-        nb_df_ = nb_df.copy()
-        bom_df = pd.merge(source_df, nb_df_, how='left', on='grain_id')
-        bom_df = bom_df[['grain_id', 'wafer_price', 'ic_up', 'count']]
-        bom_df['wafer_price_sum'] = bom_df['wafer_price'] * bom_df['count']
-        bom_df['purchase_price_sum'] = bom_df['ic_up'] * bom_df['count']
-        d['wafer_price'] = round(bom_df['wafer_price'].sum(), 2)
-        d['purchase_price'] = round(bom_df['purchase_price_sum'].sum(), 2)
-        d['ft_amt'] = d['ap_amt'] + d['bi_amt'] + d['ft1_amt'] + d['ft2_amt'] + \
-                      d['ft3_amt'] + d['ft4_amt'] + d['ft5_amt'] + d['ft6_amt'] + d['msp_amt']
-        d['ic_up'] = round(d['purchase_price'] + ((d['wafer_price'] + d['wafer_amt'] + d['ft_amt']) /
-                                                  (d['wafer_yld'] * d['ft_yld'] * d['gross_die'])), 2)
-        d['die_up'] = round(d['purchase_price'] + ((d['wafer_price'] + d['wafer_amt']) /
-                                                   (d['wafer_yld'] * d['ft_yld'] * d['gross_die'])), 2)
-        d['ft_up'] = round(d['ft_amt'] / (d['wafer_yld'] * d['ft_yld'] * d['gross_die']), 2)
-    f_eb_df = pd.DataFrame(eb_datas)
-    f_df = pd.concat([nb_df, f_eb_df], axis=0)
+    f_df = pd.concat([nb_df, eb_df], axis=0)
     left_df = ydf[['grain_id']]
     f_df = pd.merge(left_df, f_df, how='outer', on='grain_id')
     return f_df.to_dict('records')
@@ -1032,25 +1062,60 @@ def upload_grain_price(request):
             logger.error('文件解析出错, error:{}'.format(str(e)))
             return VIEW_FAIL(msg='文件解析出错, error:{}'.format(str(e)))
         res_data = {'upload_file_name': file_name}
+        session_id = request.POST.get('session_id')
         yield_data = request.POST.get('yield_data')
-        df = pd.read_excel(upload_path, sheet_name='Sheet1')
-        datas = df.to_dict('records')
-        ndf = analysis_grain_price(datas)
+        rows = [data for _, data in iter_excel_rows(upload_path, grain_price_map)]
+        ndf = pd.DataFrame(rows, columns=list(grain_price_map.values()))
         if ndf.empty:
             res_data['datas'] = []
             return VIEW_SUCCESS(msg='导入成功', data=res_data)
         ndf.fillna(0, inplace=True)  # 无加工费默认0
         pdf = ndf.copy()
-        ydf = pd.DataFrame(json.loads(yield_data))  # 良率
-        ydf = ydf[['grain_id', 'wafer_yld', 'ft_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld', 'ft3_yld', 'ft4_yld',
-                   'ft5_yld', 'ft6_yld']]
-        res_data['datas'] = calculate_grain_price(pdf, ydf)
+        # 良率
+        if session_id:
+            ydf = load_session_frame(session_id, 'yield_result')
+        else:
+            ydf = pd.DataFrame(json.loads(yield_data))
+        ydf = ydf[GRAIN_YIELD_RESULT_COLUMNS]
+        datas = calculate_grain_price(pdf, ydf)
+        if session_id:
+            save_session_frame(session_id, 'price_input', ndf)
+            save_session_frame(session_id, 'price_result', pd.DataFrame(datas))
+        res_data['datas'] = datas
         return VIEW_SUCCESS(msg='导入成功', data=res_data)
+    except UploadSessionError as e:
+        return VIEW_FAIL(msg=str(e))
     except Exception as e:
         logger.error('文件解析出错, error:{}'.format(str(e)))
         return VIEW_FAIL(msg='文件解析出错, 请按照导入模板导入数据', data={'error': str(e)})
 
 
+GRAIN_YIELD_INPUT_COLUMNS = ['grain_id', 'hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'ap_yld', 'bi_yld', 'ft1_yld',
+                             'ft2_yld', 'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld']
+GRAIN_PRICE_INPUT_COLUMNS = ['grain_id', 'purchase_price', 'hb_up', 'cp_up', 'rdl_up', 'bp_up', 'ap_up', 'bi_up',
+                             'ft1_up', 'ft2_up', 'ft3_up', 'ft4_up', 'ft5_up', 'ft6_up', 'msp_up']
+
+
+# 整理重新测算提交的良率
+def prepare_yield_input(ydf):
+    y_base_df = pd.DataFrame(columns=GRAIN_YIELD_INPUT_COLUMNS, dtype=object)
+    ydf = pd.concat([y_base_df, ydf], axis=0)
+    ydf = ydf[GRAIN_YIELD_INPUT_COLUMNS]
+    ydf.fillna(1, inplace=True)
+    ydf[GRAIN_YIELD_INPUT_COLUMNS[1:]] = ydf[GRAIN_YIELD_INPUT_COLUMNS[1:]].astype(float)
+    return ydf
+
+
+# 整理重新测算提交的测试费
+def prepare_price_input(pdf):
+    p_base_df = pd.DataFrame(columns=GRAIN_PRICE_INPUT_COLUMNS, dtype=object)
+    pdf = pd.concat([p_base_df, pdf], axis=0)
+    pdf = pdf[GRAIN_PRICE_INPUT_COLUMNS]
+    pdf.fillna(0, inplace=True)
+    pdf[GRAIN_PRICE_INPUT_COLUMNS[2:]] = pdf[GRAIN_PRICE_INPUT_COLUMNS[2:]].astype(float)
+    return pdf
+
+
 # 重新测算数据
 @api_view(['POST'])
 def recalculate_grain_data(request):
@@ -1059,50 +1124,57 @@ def recalculate_grain_data(request):
             req_dic = json.loads(request.body)
         except Exception as e:
             return REST_FAIL({'msg': '请求参数解析错误,请确认格式正确后上传', 'error': str(e)})
-        yield_data = req_dic.get('yield_data')
-        if not yield_data:
+        session_id = req_dic.get('session_id')
+        if session_id:
+            # 导入会话中的数据合并本次修改的行
+            ydf = apply_changes(load_session_frame(session_id, 'yield_input'), 'grain_id',
+                                req_dic.get('yield_changed'), req_dic.get('yield_deleted'))
+            pdf = None
+            if has_session_frame(session_id, 'price_input'):
+                pdf = apply_changes(load_session_frame(session_id, 'price_input'), 'grain_id',
+                                    req_dic.get('price_changed'), req_dic.get('price_deleted'))
+        else:
+            ydf = pd.DataFrame(req_dic.get('yield_data') or [])
+            price_data = req_dic.get('price_data', [])
+            pdf = pd.DataFrame(price_data) if price_data else None
+        if ydf.empty:
             return REST_FAIL({'msg': '良率数据不能为空'})
-        price_data = req_dic.get('price_data', [])
         res_data = {}
         # 重新测算良率
-        ydf = pd.DataFrame(yield_data)
-        y_base_df = pd.DataFrame(columns=['grain_id', 'hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'ap_yld', 'bi_yld',
-                                          'ft1_yld', 'ft2_yld', 'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld'], dtype=object)
-        ydf = pd.concat([y_base_df, ydf], axis=0)
-        ydf = ydf[['grain_id', 'hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld',
-                   'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld']]
-        ydf.fillna(1, inplace=True)
-        ydf[['hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld',
-            'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld']] = \
-            ydf[['hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld',
-                'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld']].astype(float)
-        yield_data = calculate_yield(ydf)
+        ydf = prepare_yield_input(ydf)
+        yield_data = calculate_yield(ydf.copy())
         res_data['yield_data'] = yield_data
+        if session_id:
+            save_session_frame(session_id, 'yield_input', ydf)
+            save_session_frame(session_id, 'yield_result', pd.DataFrame(yield_data))
         # 重新测算成本
-        if price_data:
+        price_data = []
+        if pdf is not None and not pdf.empty:
             ydf = pd.DataFrame(yield_data)
-            ydf = ydf[['grain_id', 'wafer_yld', 'ft_yld', 'ap_yld', 'bi_yld', 'ft1_yld', 'ft2_yld', 'ft3_yld', 'ft4_yld',
-                       'ft5_yld', 'ft6_yld']]
-            pdf = pd.DataFrame(price_data)
-            p_base_df = pd.DataFrame(columns=['grain_id', 'purchase_price', 'hb_up', 'cp_up', 'rdl_up', 'bp_up', 'ap_up',
-                                              'bi_up', 'ft1_up', 'ft2_up', 'ft3_up', 'ft4_up', 'ft5_up', 'ft6_up',
-                                              'msp_up'], dtype=object)
-            pdf = pd.concat([p_base_df, pdf], axis=0)
-            pdf = pdf[['grain_id', 'purchase_price', 'hb_up', 'cp_up', 'rdl_up', 'bp_up', 'ap_up',
-                       'bi_up', 'ft1_up', 'ft2_up', 'ft3_up', 'ft4_up', 'ft5_up', 'ft6_up', 'msp_up']]
-            pdf.fillna(0, inplace=True)
-            pdf[['hb_up', 'cp_up', 'rdl_up', 'bp_up', 'ap_up', 'bi_up', 'ft1_up',
-                 'ft2_up', 'ft3_up', 'ft4_up', 'ft5_up', 'ft6_up', 'msp_up']] = \
-                pdf[['hb_up', 'cp_up', 'rdl_up', 'bp_up', 'ap_up', 'bi_up', 'ft1_up',
-                     'ft2_up', 'ft3_up', 'ft4_up', 'ft5_up', 'ft6_up', 'msp_up']].astype(float)
-            price_data = calculate_grain_price(pdf, ydf)
+            ydf = ydf[GRAIN_YIELD_RESULT_COLUMNS]
+            pdf = prepare_price_input(pdf)
+            price_data = calculate_grain_price(pdf.copy(), ydf)
+            if session_id:
+                save_session_frame(session_id, 'price_input', pdf)
+                save_session_frame(session_id, 'price_result', pd.DataFrame(price_data))
         res_data['price_data'] = price_data
         return REST_SUCCESS(data=res_data)
+    except UploadSessionError as e:
+        return REST_FAIL({'msg': str(e)})
     except Exception as e:
         logger.error('测算出错, error:{}'.format(str(e)))
         return REST_FAIL({'msg': '测算出错', 'error': str(e)})
 
 
+# 导入颗粒良率、测试费时从提交数据中取值的字段
+GRAIN_YIELD_FIELDS = ['grain_id', 'wafer_id', 'hb_yld', 'cp_yld', 'rdl_yld', 'bp_yld', 'wafer_yld', 'ap_yld', 'bi_yld',
+                      'ft1_yld', 'ft2_yld', 'ft3_yld', 'ft4_yld', 'ft5_yld', 'ft6_yld', 'ft_yld']
+GRAIN_PRICE_FIELDS = ['grain_id', 'wafer_id', 'wafer_price', 'purchase_price', 'hb_up', 'cp_up', 'rdl_up', 'bp_up',
+                      'wafer_amt', 'ap_up', 'ap_amt', 'bi_up', 'bi_amt', 'ft1_up', 'ft1_amt', 'ft2_up', 'ft2_amt',
+                      'ft3_up', 'ft3_amt', 'ft4_up', 'ft4_amt', 'ft5_up', 'ft5_amt', 'ft6_up', 'ft6_amt', 'msp_up',
+                      'msp_amt', 'ft_amt', 'ic_up', 'die_up', 'ft_up']
+
+
 # 保存导入的颗粒测算信息
 @api_view(['POST'])
 def save_upload_grain_data(request):
@@ -1113,22 +1185,29 @@ def save_upload_grain_data(request):
             return REST_FAIL({'msg': '请求参数解析错误,请确认格式正确后上传', 'error': str(e)})
         user = request.user
         yield_file_name = req_dic.get('yield_file_name')
-        yield_data = req_dic.get('yield_data', [])
         price_file_name = req_dic.get('price_file_name')
-        price_data = req_dic.get('price_data', [])
+        session_id = req_dic.get('session_id')
+        if session_id:
+            yield_data = frame_records(apply_changes(load_session_frame(session_id, 'yield_result'), 'grain_id',
+                                                     req_dic.get('yield_changed'), req_dic.get('yield_deleted')))
+            price_data = frame_records(apply_changes(load_session_frame(session_id, 'price_result'), 'grain_id',
+                                                     req_dic.get('price_changed'), req_dic.get('price_deleted')))
+        else:
+            yield_data = req_dic.get('yield_data', [])
+            price_data = req_dic.get('price_data', [])
         if not yield_data or not price_data:
             return REST_FAIL({'msg': '良率或成本不能为空'})
-        yield_sql = '''insert into pwm_cost_grain_yld(hb_yld, cp_yld, rdl_yld, bp_yld, wafer_yld, ap_yld, bi_yld, 
-                                ft1_yld, ft2_yld, ft3_yld,ft4_yld, ft5_yld, ft6_yld, ft_yld, period, create_time, 
-                                update_time,is_delete, grain_id, upload_id, user_id, wafer_id)
-                      values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
-        price_sql = '''insert into pwm_cost_grain_price(wafer_price, purchase_price, hb_up, cp_up, rdl_up, bp_up, wafer_amt, 
-                                 ap_up, ap_amt, bi_up, bi_amt, ft1_up, ft1_amt, ft2_up, ft2_amt, ft3_up, 
-                                 ft3_amt, ft4_up, ft4_amt, ft5_up, ft5_amt, ft6_up, ft6_amt, msp_up, msp_amt, 
-                                 ft_amt, ic_up, die_up, ft_up, period, create_time, update_time, 
-                                 is_delete, grain_id, upload_id, user_id, wafer_id)
-                            values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                             %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
+        # 先校验全部数据, 避免部分数据写入后才发现错误
+        yield_ls = []
+        for count, d in enumerate(yield_data, 1):
+            if not d.get('grain_id'):
+                return REST_SUCCESS({'msg': '良率数据中料号不能为空, 空值所在行: {}'.format(count)})
+            yield_ls.append({field: d.get(field) for field in GRAIN_YIELD_FIELDS})
+        price_ls = []
+        for count, d in enumerate(price_data, 1):
+            if not d.get('grain_id'):
+                return REST_SUCCESS({'msg': '测试费数据中料号不能为空, 空值所在行: {}'.format(count)})
+            price_ls.append({field: d.get(field) for field in GRAIN_PRICE_FIELDS})
         period = datetime.datetime.now().strftime('%Y-%m')
         close_old_connections()
         with transaction.atomic():
@@ -1141,55 +1220,30 @@ def save_upload_grain_data(request):
                     yield_upload_id = yield_upload_obj.id
                 else:
                     yield_upload_id = None
-                yield_count = 0
-                yield_ls = []
-                for d in yield_data:
-                    yield_count += 1
-                    grain_id = d.get('grain_id')
-                    if not grain_id:
-                        return REST_SUCCESS({'msg': '良率数据中料号不能为空, 空值所在行: {}'.format(yield_count)})
-                    args = (d.get('hb_yld'), d.get('cp_yld'), d.get('rdl_yld'), d.get('bp_yld'), d.get('wafer_yld'),
-                            d.get('ap_yld'), d.get('bi_yld'), d.get('ft1_yld'), d.get('ft2_yld'), d.get('ft3_yld'),
-                            d.get('ft4_yld'), d.get('ft5_yld'), d.get('ft6_yld'), d.get('ft_yld'), period,
-                            now_ts, now_ts, False, grain_id, yield_upload_id, user.id, d.get('wafer_id'))
-                    yield_ls.append(args)
-                    if len(yield_ls) >= 50:
-                        execute_batch_sql(yield_sql, yield_ls)
-                        yield_ls = []
-                if len(yield_ls) > 0:
-                    execute_batch_sql(yield_sql, yield_ls)
+                for yield_dic in yield_ls:
+                    yield_dic.update(period=period, create_time=now_ts, update_time=now_ts, is_delete=False,
+                                     upload_id=yield_upload_id, user_id=user.id)
+                bulk_insert(GrainYield, yield_ls)
                 # 保存测试费数据
                 if price_file_name:
                     price_upload_obj = UploadRecord.objects.create(user=user, data_type=3, file_path=price_file_name)
                     price_upload_id = price_upload_obj.id
                 else:
                     price_upload_id = None
-                price_count = 0
-                price_ls = []
-                for d in price_data:
-                    price_count += 1
-                    grain_id = d.get('grain_id')
-                    if not grain_id:
-                        return REST_SUCCESS({'msg': '测试费数据中料号不能为空, 空值所在行: {}'.format(yield_count)})
-                    args = (d.get('wafer_price'), d.get('purchase_price'), d.get('hb_up'), d.get('cp_up'), d.get('rdl_up'),
-                            d.get('bp_up'), d.get('wafer_amt'), d.get('ap_up'), d.get('ap_amt'), d.get('bi_up'),
-                            d.get('bi_amt'), d.get('ft1_up'), d.get('ft1_amt'), d.get('ft2_up'), d.get('ft2_amt'),
-                            d.get('ft3_up'), d.get('ft3_amt'), d.get('ft4_up'), d.get('ft4_amt'), d.get('ft5_up'),
-                            d.get('ft5_amt'), d.get('ft6_up'), d.get('ft6_amt'), d.get('msp_up'), d.get('msp_amt'),
-                            d.get('ft_amt'), d.get('ic_up'), d.get('die_up'), d.get('ft_up'), period,
-                            now_ts, now_ts, False, grain_id, price_upload_id, user.id, d.get('wafer_id'))
-                    price_ls.append(args)
-                    if len(price_ls) >= 50:
-                        execute_batch_sql(price_sql, price_ls)
-                        price_ls = []
-                if len(price_ls) > 0:
-                    execute_batch_sql(price_sql, price_ls)
+                for price_dic in price_ls:
+                    price_dic.update(period=period, create_time=now_ts, update_time=now_ts, is_delete=False,
+                                     upload_id=price_upload_id, user_id=user.id)
+                bulk_insert(GrainUnitPrice, price_ls)
                 transaction.savepoint_commit(save_id)
             except Exception as e:
                 transaction.savepoint_rollback(save_id)
                 logger.error('grain测算数据保存失败, error:{}'.format(str(e)))
                 return REST_FAIL({'msg': '数据保存失败', 'error': str(e)})
+        if session_id:
+            remove_upload_session(session_id)
         return REST_SUCCESS({'msg': '提交成功'})
+    except UploadSessionError as e:
+        return REST_FAIL({'msg': str(e)})
     except Exception as e:
         logger.error('grain测算数据保存失败, error:{}'.format(str(e)))
         return REST_FAIL({'msg': '数据保存失败', 'error': str(e)})
@@ -1197,6 +1251,7 @@ def save_upload_grain_data(request):
 
 # 导出颗粒良率
 @api_view(['GET'])
+@export_task('grain_yield')
 def export_grain_yield(request):
     try:
         queryset = GrainYield.objects
@@ -1261,8 +1316,8 @@ def export_grain_yield(request):
             'user__username': '提交人'
         }
         ndf.rename(rename_maps, axis=1, inplace=True)
-        file_path, file_name = get_file_path('yield', 'export_files')
-        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        excel_file = create_excel_buffer()
+        writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
         workbook = writer.book
         fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True, 'valign': 'vcenter'})
         center_fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True,
@@ -1297,7 +1352,7 @@ def export_grain_yield(request):
         worksheet.conditional_format('A1:AB%d' % l_end, {'type': 'blanks', 'format': border_format})
         worksheet.conditional_format('A1:AB%d' % l_end, {'type': 'no_blanks', 'format': border_format})
         writer.save()
-        return create_excel_resp(file_path, '颗粒良率数据')
+        return create_excel_resp(excel_file, '颗粒良率数据')
     except Exception as e:
         logger.error('良率导出失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '良率导出失败, error: {}'.format(str(e))})
@@ -1305,6 +1360,7 @@ def export_grain_yield(request):
 
 # 导出颗粒测试费
 @api_view(['GET'])
+@export_task('grain_price')
 def export_grain_price(request):
     try:
         queryset = GrainUnitPrice.objects
@@ -1390,8 +1446,8 @@ def export_grain_price(request):
             'user__username': '提交人'
         }
         ndf.rename(rename_maps, axis=1, inplace=True)
-        file_path, file_name = get_file_path('price', 'export_files')
-        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        excel_file = create_excel_buffer()
+        writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
         workbook = writer.book
         fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True, 'valign': 'vcenter'})
         center_fmt = workbook.add_format({'font_size': 10, 'font_name': 'Arial Unicode MS', 'text_wrap': True,
@@ -1428,7 +1484,7 @@ def export_grain_price(request):
         worksheet.conditional_format('A1:AQ%d' % l_end, {'type': 'blanks', 'format': border_format})
         worksheet.conditional_format('A1:AQ%d' % l_end, {'type': 'no_blanks', 'format': border_format})
         writer.save()
-        return create_excel_resp(file_path, '颗粒测试费数据')
+        return create_excel_resp(excel_file, '颗粒测试费数据')
     except Exception as e:
         logger.error('测试费导出失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '测试费导出失败, error: {}'.format(str(e))})
@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import matplotlib
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import traceback
+import logging
+
+logger = logging.getLogger('django')
+
+matplotlib.rcParams['font.sans-serif'] = ['SimHei']  # 用来正常显示中文标签
+matplotlib.rcParams['axes.unicode_minus'] = False  # 用来正常显示负号
+
+CHART_DIR = settings.REPORT_CHART_DIR
+CHART_VERSION = 1  # 修改图表样式后加1, 使旧缓存失效
+CHART_CACHE_MAX_BYTES = 200 * 1024 * 1024  # 缓存目录最大占用
+CHART_CACHE_MAX_AGE = 7 * 24 * 3600  # 超过该时长未使用的图片会被清理(秒)
+
+# 图表在后台线程绘制, Figure对象不共享pyplot的全局状态, 可并发绘制
+chart_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='report-chart')
+evict_lock = threading.Lock()
+
+
+def get_chart_key(total_df, total_weekday):
+    """根据汇总数据生成图表的缓存key, 数据相同则图片相同"""
+    content = json.dumps({
+        'version': CHART_VERSION,
+        'equipment_id': [str(equipment_id) for equipment_id in total_df['equipment_id']],
+        'usage_time': [float(usage_time) for usage_time in total_df['usage_time']],
+        'total_weekday': float(total_weekday),
+    }, sort_keys=True)
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def draw_usage_chart(total_df, total_weekday, image_file):
+    """绘制设备使用时长与总工时的柱状图"""
+    total_width, n = 0.4, 2
+    width = total_width / n
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.grid(axis='y', alpha=0.2)
+    x = [i + width for i in range(len(total_df.index))]
+    total_weekday_label = 'Total Weekday({}H)'.format(total_weekday)
+    t1 = ax.bar(x, total_df['usage_time'], width=width, tick_label=total_df['equipment_id'],
+                label='Total Usage Time(H)', fc='b')
+    x = [i + width for i in x]
+    t2 = ax.bar(x, total_df['total_weekday'], width=width, label=total_weekday_label, fc='r')
+    # 显示柱状上的数值
+    for rect in list(t1) + list(t2):
+        height = rect.get_height()
+        ax.text(rect.get_x() + rect.get_width() / n - 0.1, height + 1, '%s' % float(height))
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend(bbox_to_anchor=(1.0, 0.7), prop={'size': 12})
+    fig.savefig(image_file, format='png', dpi=150, bbox_inches='tight')
+
+
+def evict_chart_cache():
+    """清理超过时长未使用的图片, 并按最近使用时间把缓存目录控制在限定大小内"""
+    if not evict_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        files = []
+        for name in os.listdir(CHART_DIR):
+            path = os.path.join(CHART_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total_size = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            if now - mtime <= CHART_CACHE_MAX_AGE and total_size <= CHART_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+    except Exception:
+        logger.error('清理统计图缓存失败, error: {}'.format(traceback.format_exc()))
+    finally:
+        evict_lock.release()
+
+
+def render_usage_chart(total_df, total_weekday):
+    """获取使用率统计图的png数据, 相同数据直接读取缓存"""
+    if not os.path.exists(CHART_DIR):
+        os.makedirs(CHART_DIR, exist_ok=True)
+    image_path = os.path.join(CHART_DIR, get_chart_key(total_df, total_weekday) + '.png')
+    try:
+        with open(image_path, 'rb') as f:
+            image_data = f.read()
+        os.utime(image_path)
+        return io.BytesIO(image_data)
+    except FileNotFoundError:
+        pass
+
+    buffer = io.BytesIO()
+    draw_usage_chart(total_df, total_weekday, buffer)
+    # 先写临时文件再替换, 避免其他进程读到写了一半的图片
+    temp_path = '{}.{}.{}.tmp'.format(image_path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wb') as f:
+        f.write(buffer.getvalue())
+    os.replace(temp_path, image_path)
+    evict_chart_cache()
+    buffer.seek(0)
+    return buffer
+
+
+def submit_usage_chart(total_df, total_weekday):
+    """提交后台绘图任务, 返回Future, result()为png数据"""
+    return chart_executor.submit(render_usage_chart, total_df.copy(), total_weekday)
@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction, IntegrityError
+from django.db.models import F
+from django.http import FileResponse, HttpRequest, QueryDict
+from django.urls import get_resolver
+from django.utils.http import urlunquote
+from rest_framework.request import Request
+
+from reports.models import ExportJob
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+import logging
+
+logger = logging.getLogger('django')
+
+EXPORT_JOB_DIR = settings.EXPORT_JOB_DIR
+EXPORT_JOB_TIMEOUT = datetime.timedelta(hours=1)  # 提交后超过该时长仍未完成的任务视为失败
+EXPORT_JOB_KEEP = datetime.timedelta(days=1)  # 任务及导出文件的保留时长
+EXPORT_WORKERS = 2  # 每个进程的工作线程数
+EXPORT_POLL_SECONDS = 5  # 工作线程查询排队任务的间隔, 本进程提交的任务会立即唤醒
+EXPORT_HEARTBEAT_SECONDS = 15  # 更新执行中任务心跳的间隔
+EXPORT_STALE_SECONDS = 120  # 心跳超过该时长未更新, 视为执行进程已退出
+EXPORT_MAX_ATTEMPTS = 3  # 执行次数上限, 避免导致进程退出的任务反复执行
+
+# 可后台导出的函数, {导出类型: (未经api_view包装的视图函数, 固定参数)}
+EXPORT_TASKS = {}
+
+
+def export_task(export_name, **fixed_params):
+    """
+    注册可后台导出的视图函数, 需放在api_view之下
+    fixed_params为导出时固定追加的查询参数, 如operate='export'
+    """
+    def decorator(func):
+        EXPORT_TASKS[export_name] = (func, fixed_params)
+        return func
+    return decorator
+
+
+def get_job_key(export_name, params, user_id):
+    content = json.dumps({'export_name': export_name, 'params': params, 'user': user_id}, sort_keys=True)
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def expire_stale_jobs():
+    """超时未完成的任务标记为失败, 并删除超过保留时长的任务及文件"""
+    now = datetime.datetime.now()
+    ExportJob.objects.filter(status__in=[0, 1], create_time__lt=now - EXPORT_JOB_TIMEOUT).update(
+        status=3, active_key=None, msg='导出超时')
+    expired_qs = ExportJob.objects.filter(create_time__lt=now - EXPORT_JOB_KEEP)
+    for file_path in expired_qs.exclude(file_path=None).values_list('file_path', flat=True):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+    expired_qs.delete()
+
+
+def submit_export_job(export_name, params, user):
+    """提交导出任务, 相同用户相同参数的任务未完成时直接返回该任务"""
+    if export_name not in EXPORT_TASKS:
+        raise ValueError('不支持的导出类型: {}'.format(export_name))
+    expire_stale_jobs()
+    job_key = get_job_key(export_name, params, user.id)
+    for _ in range(3):
+        job = ExportJob.objects.filter(active_key=job_key).first()
+        if job:
+            return job
+        try:
+            with transaction.atomic():
+                job = ExportJob.objects.create(job_key=job_key, active_key=job_key, export_name=export_name,
+                                               user=user, params=json.dumps(params, ensure_ascii=False))
+        except IntegrityError:
+            # 其他进程同时提交了相同参数的任务, 重新查询该任务
+            continue
+        export_worker.notify()
+        return job
+    raise ValueError('提交导出任务失败, 请稍后重试')
+
+
+def build_request(params, user):
+    """根据保存的参数构造导出视图需要的GET请求"""
+    query_dict = QueryDict(mutable=True)
+    for key, value in params.items():
+        if isinstance(value, list):
+            query_dict.setlist(key, [str(item) for item in value])
+        else:
+            query_dict[key] = str(value)
+    http_request = HttpRequest()
+    http_request.method = 'GET'
+    http_request.GET = query_dict
+    request = Request(http_request)
+    request.user = user
+    return request
+
+
+def get_response_file_name(response):
+    """从Content-Disposition中取出下载文件名(不含扩展名)"""
+    match = re.search(r'filename="(.*)\.xlsx"', response.get('Content-Disposition', ''))
+    return urlunquote(match.group(1)) if match else 'export'
+
+
+def run_export_job(job_id, worker_id):
+    """工作线程中生成导出文件, 任务已由worker_id认领; 任务被重新排队后不再更新其状态"""
+    job_qs = ExportJob.objects.filter(id=job_id, status=1, worker=worker_id)
+    try:
+        job = ExportJob.objects.select_related('user').get(id=job_id)
+        if job.export_name not in EXPORT_TASKS:
+            # 视图模块在加载url配置时才注册导出函数
+            get_resolver().url_patterns
+        func, fixed_params = EXPORT_TASKS[job.export_name]
+        params = json.loads(job.params)
+        params.update(fixed_params)
+        response = func(build_request(params, job.user))
+        if not isinstance(response, FileResponse):
+            data = getattr(response, 'data', None)
+            msg = data.get('msg', str(data)) if isinstance(data, dict) else str(data)
+            job_qs.update(status=3, active_key=None, msg=msg or '没有可导出的数据')
+            return
+        if not os.path.exists(EXPORT_JOB_DIR):
+            os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+        file_path = os.path.join(EXPORT_JOB_DIR, '{}.xlsx'.format(job_id))
+        try:
+            with open(file_path, 'wb') as f:
+                shutil.copyfileobj(response.file_to_stream, f)
+        finally:
+            response.close()
+        job_qs.update(status=2, active_key=None, file_path=file_path, file_name=get_response_file_name(response))
+    except Exception as e:
+        logger.error('导出任务{}失败, error: {}'.format(job_id, traceback.format_exc()))
+        job_qs.update(status=3, active_key=None, msg=str(e))
+
+
+class ExportWorker(object):
+    """
+    export_job表即任务队列: 每个进程启动若干工作线程, 认领排队中的任务执行
+    另有一个线程定期更新本进程执行中任务的心跳, 并把心跳超时(执行进程已退出)的任务重新排队
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.worker_id = None
+        self.wakeup = threading.Event()
+
+    def ensure_started(self):
+        # uwsgi在加载应用后fork出工作进程, 线程需在各自进程中启动
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.worker_id = '{}-{}-{}'.format(socket.gethostname(), self.pid, uuid.uuid4().hex[:8])
+            self.wakeup = threading.Event()
+            for i in range(EXPORT_WORKERS):
+                threading.Thread(target=self.run, name='export-job-{}'.format(i), daemon=True).start()
+            threading.Thread(target=self.monitor, name='export-job-monitor', daemon=True).start()
+
+    def notify(self):
+        """有新任务提交, 唤醒本进程的工作线程"""
+        self.ensure_started()
+        self.wakeup.set()
+
+    def claim(self):
+        """认领最早排队的任务, 多个进程同时认领同一任务时只有一个能更新成功"""
+        job_ids = ExportJob.objects.filter(status=0).order_by('id').values_list('id', flat=True)[:EXPORT_WORKERS * 5]
+        for job_id in job_ids:
+            if ExportJob.objects.filter(id=job_id, status=0).update(
+                    status=1, worker=self.worker_id, heartbeat=datetime.datetime.now(), attempts=F('attempts') + 1):
+                return job_id
+        return None
+
+    def run_pending(self):
+        """依次执行排队中的任务, 返回执行的任务数"""
+        count = 0
+        while True:
+            job_id = self.claim()
+            if job_id is None:
+                return count
+            run_export_job(job_id, self.worker_id)
+            count += 1
+
+    def recover(self):
+        """更新本进程执行中任务的心跳; 其他进程心跳超时的任务重新排队, 超过执行次数上限的标记为失败"""
+        now = datetime.datetime.now()
+        ExportJob.objects.filter(status=1, worker=self.worker_id).update(heartbeat=now)
+        stale_qs = ExportJob.objects.filter(status=1, heartbeat__lt=now - datetime.timedelta(
+            seconds=EXPORT_STALE_SECONDS)).exclude(worker=self.worker_id)
+        stale_qs.filter(attempts__gte=EXPORT_MAX_ATTEMPTS).update(status=3, active_key=None, msg='导出进程异常退出')
+        count = stale_qs.update(status=0, worker=None, heartbeat=None)
+        if count:
+            self.wakeup.set()
+        return count
+
+    def run(self):
+        while True:
+            self.wakeup.wait(EXPORT_POLL_SECONDS)
+            self.wakeup.clear()
+            try:
+                close_old_connections()
+                self.run_pending()
+            except Exception:
+                logger.error('执行导出任务失败, error: {}'.format(traceback.format_exc()))
+
+    def monitor(self):
+        while True:
+            time.sleep(EXPORT_HEARTBEAT_SECONDS)
+            try:
+                close_old_connections()
+                self.recover()
+            except Exception:
+                logger.error('更新导出任务心跳失败, error: {}'.format(traceback.format_exc()))
+
+
+export_worker = ExportWorker()
+
+
+def get_job_info(job):
+    return {
+        'id': job.id,
+        'export_name': job.export_name,
+        'status': job.status,
+        'status_name': job.get_status_display(),
+        'file_name': job.file_name,
+        'msg': job.msg,
+        'create_time': job.create_time.strftime('%Y-%m-%d %H:%M:%S')
+    }
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min, Max
+
+from equipments.models import EquipmentBorrowRecord
+from reports.usage_utils import refresh_usage_daily
+
+import datetime
+
+
+class Command(BaseCommand):
+    help = '根据已归还的借用记录重建设备每日使用汇总表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='开始日期, 如: 2022-01-01')
+        parser.add_argument('--end', help='结束日期, 如: 2022-12-31')
+        parser.add_argument('--equipment', help='只重建某个设备')
+
+    def handle(self, *args, **options):
+        try:
+            start = datetime.datetime.strptime(options['start'], '%Y-%m-%d').date() if options['start'] else None
+            end = datetime.datetime.strptime(options['end'], '%Y-%m-%d').date() if options['end'] else None
+        except ValueError:
+            raise CommandError('日期格式应为: YYYY-mm-dd')
+        queryset = EquipmentBorrowRecord.objects.filter(is_approval=1, is_return=2)
+        if options['equipment']:
+            queryset = queryset.filter(equipment_id=options['equipment'])
+        ranges = queryset.values('equipment_id').annotate(first_time=Min('start_time'),
+                                                          last_time=Max('actual_end_time'))
+        total = 0
+        for item in ranges:
+            if not item['first_time'] or not item['last_time']:
+                continue
+            first_day = item['first_time'].date()
+            last_day = item['last_time'].date()
+            if start:
+                first_day = max(first_day, start)
+            if end:
+                last_day = min(last_day, end)
+            if first_day > last_day:
+                continue
+            total += refresh_usage_daily(item['equipment_id'], first_day, last_day)
+        self.stdout.write('重建完成, 共生成{}条每日使用汇总'.format(total))
@@ -1,3 +1,63 @@
 from django.db import models
+from users.models import User
+from equipments.models import Project, Equipment
 
-# Create your models here.
+
+class EquipmentUsageDaily(models.Model):
+    """
+    设备每日使用汇总, 借用记录归还后按天拆分工作时长累计
+    """
+    usage_date = models.DateField(verbose_name='使用日期')
+    equipment = models.ForeignKey(Equipment, on_delete=models.CASCADE, verbose_name='设备')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='借用人')
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, verbose_name='项目')
+    usage_seconds = models.IntegerField(verbose_name='工作时长(秒)', default=0)
+    record_count = models.IntegerField(verbose_name='借用记录数', default=0)
+    update_time = models.DateTimeField(verbose_name='更新时间', auto_now=True, auto_now_add=False)
+
+    class Meta:
+        unique_together = (
+            ('usage_date', 'equipment', 'user', 'project')
+        )
+        indexes = [
+            models.Index(fields=['equipment', 'usage_date']),
+        ]
+        db_table = 'equipment_usage_daily'
+        verbose_name = '设备每日使用汇总表'
+        verbose_name_plural = verbose_name
+
+
+class ExportJob(models.Model):
+    """
+    后台导出任务, 同时作为任务队列: 各进程的工作线程从表中认领排队中的任务生成excel文件, 完成后通过任务id下载
+    """
+    job_states = (
+        (0, '排队中'),
+        (1, '生成中'),
+        (2, '已完成'),
+        (3, '失败')
+    )
+    job_key = models.CharField(max_length=32, verbose_name='任务参数摘要')
+    # 排队或生成中的任务才有值, 唯一约束保证多个进程同时提交相同参数时只创建一个任务
+    active_key = models.CharField(max_length=32, verbose_name='进行中任务摘要', null=True, unique=True)
+    export_name = models.CharField(max_length=50, verbose_name='导出类型')
+    params = models.TextField(verbose_name='导出参数')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='提交人')
+    status = models.IntegerField(verbose_name='任务状态', choices=job_states, default=0)
+    file_name = models.CharField(max_length=100, verbose_name='文件名称', null=True, blank=True)
+    file_path = models.CharField(max_length=255, verbose_name='文件路径', null=True, blank=True)
+    msg = models.TextField(verbose_name='失败原因', null=True, blank=True)
+    worker = models.CharField(max_length=100, verbose_name='执行进程', null=True, blank=True)
+    heartbeat = models.DateTimeField(verbose_name='执行进程心跳时间', null=True, blank=True)
+    attempts = models.IntegerField(verbose_name='执行次数', default=0)
+    create_time = models.DateTimeField(verbose_name='提交时间', auto_now_add=True)
+    update_time = models.DateTimeField(verbose_name='更新时间', auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['job_key', 'status']),
+            models.Index(fields=['status', 'id']),
+        ]
+        db_table = 'export_job'
+        verbose_name = '导出任务表'
+        verbose_name_plural = verbose_name
@@ -1,3 +1,430 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import tempfile
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase
+from openpyxl import load_workbook
+from pandas.testing import assert_frame_equal
+from rest_framework.test import APIRequestFactory, force_authenticate
+from unittest import mock
+
+from equipments.ext_utils import create_excel_buffer, create_excel_resp
+from equipments.models import Equipment, EquipmentBorrowRecord, Project
+from reports import export_jobs
+from reports.models import ExportJob
+from reports import chart_utils
+from reports.usage_utils import refresh_usage_daily
+from reports.views import insert_subtotal, get_usage_rate, get_equipment_fee, get_usagetime
+from users.models import User, Section
+from utils.timedelta_utls import working_calendar, calculate_datediff, calculate_datediff_array, calculate_end_time
+
+
+# 原逐组拼接的合计实现，作为新实现的对照
+def legacy_subtotal(df, group_col, sum_col, total_label):
+    group_ls = [group for group in list(df[group_col].unique())]
+    group_ls.sort()
+    final_df = pd.DataFrame(columns=list(df.columns), dtype=object)
+    for group in group_ls:
+        ldf = df[df[group_col] == group]
+        ldf.loc[total_label] = ldf[[sum_col]].apply(lambda x: x.sum())
+        ldf.fillna('', inplace=True)
+        final_df = pd.concat([final_df, ldf], axis=0)
+    return final_df
+
+
+# 原逐条截取的使用时长计算，作为get_usagetime的对照
+def legacy_usagetime(ndf, start_time, end_time):
+    last_ls = list(ndf.loc[ndf['start_time'] < start_time].index)
+    for index in last_ls:
+        usage_time = calculate_datediff(start_time, ndf['end_time'].iloc[index].to_pydatetime())
+        ndf['usage_time'].iloc[index] = usage_time
+        if 'total_amount' in ndf:
+            ndf['total_amount'].iloc[index] = ndf['per_hour_price'].iloc[index] * usage_time
+        ndf['start_time'].iloc[index] = start_time
+    next_ls = list(ndf.loc[ndf['end_time'] > end_time].index)
+    for index in next_ls:
+        usage_time = calculate_datediff(ndf['start_time'].iloc[index].to_pydatetime(), end_time)
+        ndf['usage_time'].iloc[index] = usage_time
+        if 'total_amount' in ndf:
+            ndf['total_amount'].iloc[index] = ndf['per_hour_price'].iloc[index] * usage_time
+        ndf['end_time'].iloc[index] = end_time
+    return ndf
+
+
+def format_time(x):
+    # 新版pandas中fillna不会把时间列的NaT转为空字符串
+    return x.strftime('%Y-%m-%d %H:%M:%S') if pd.notna(x) and x != '' else ''
+
+
+def format_usage(final_df):
+    final_df['start_time'] = final_df['start_time'].map(format_time)
+    final_df['end_time'] = final_df['end_time'].map(format_time)
+    final_df['usage_time'] = final_df['usage_time'].map(lambda x: round(x, 2))
+    return final_df
+
+
+class InsertSubtotalTest(SimpleTestCase):
+    size = 50000
+
+    def setUp(self):
+        self.rng = np.random.RandomState(20220101)
+
+    def usage_df(self):
+        rng = self.rng
+        start = datetime.datetime(2022, 1, 1) + pd.to_timedelta(rng.randint(0, 365 * 24 * 60, self.size), unit='m')
+        mdf = pd.DataFrame({
+            'equipment_id': ['EQ%04d' % i for i in rng.randint(0, 500, self.size)],
+            'equipment_name': np.where(rng.rand(self.size) < 0.1, None, 'tester'),
+            'user_name': ['user%d' % i for i in rng.randint(0, 50, self.size)],
+            'start_time': start,
+            'end_time': start + pd.to_timedelta(rng.randint(1, 72 * 60, self.size), unit='m'),
+            'usage_time': rng.rand(self.size) * 50,
+        }, index=rng.permutation(self.size))
+        mdf.sort_values('start_time', inplace=True)
+        return mdf
+
+    def fee_df(self):
+        rng = self.rng
+        tdf = pd.DataFrame({
+            'project_name': np.where(rng.rand(self.size) < 0.05, '', ['项目%d' % i for i in rng.randint(0, 300, self.size)]),
+            'section_name': ['部门%d' % i for i in rng.randint(0, 20, self.size)],
+            'equipment_id': ['EQ%04d' % i for i in rng.randint(0, 500, self.size)],
+            'equipment_name': ['tester'] * self.size,
+            'total_amount': rng.rand(self.size) * 1000,
+        })
+        return tdf.groupby(['project_name', 'section_name', 'equipment_id', 'equipment_name']).sum().reset_index()
+
+    def assert_same_output(self, expected, result):
+        self.assertEqual(expected.to_dict('records'), result.to_dict('records'))
+        assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True), check_dtype=False)
+        self.assertEqual(list(expected.index), list(result.index))
+
+    def test_usage_detail(self):
+        mdf = self.usage_df()
+        expected = format_usage(legacy_subtotal(mdf, 'equipment_id', 'usage_time', 'total'))
+        result = format_usage(insert_subtotal(mdf, 'equipment_id', 'usage_time', 'total'))
+        self.assert_same_output(expected, result)
+
+    def test_equipment_fee(self):
+        tdf = self.fee_df()
+        expected = legacy_subtotal(tdf, 'project_name', 'total_amount', '总计')
+        expected['total_amount'] = expected['total_amount'].map(lambda x: round(x, 2))
+        result = insert_subtotal(tdf, 'project_name', 'total_amount', '总计')
+        result['total_amount'] = result['total_amount'].map(lambda x: round(x, 2))
+        self.assert_same_output(expected, result)
+
+
+class WorkingCalendarTest(SimpleTestCase):
+    D = datetime.datetime
+    # 节假日、调休和跨年的工时, 期望值为原逐日判断节假日的实现的结果
+    datediff_cases = [
+        (D(2022, 1, 28, 10), D(2022, 2, 8, 12), 42.0),  # 春节, 1月29、30日调休上班
+        (D(2021, 12, 31, 15), D(2022, 1, 4, 11), 6.0),  # 跨年, 元旦假期
+        (D(2022, 9, 30, 18), D(2022, 10, 8, 10), 2.0),  # 国庆, 10月8日调休上班
+        (D(2022, 10, 1, 10), D(2022, 10, 3, 12), 0),  # 全在假期中
+        (D(2022, 6, 2, 20), D(2022, 6, 6, 8), 0),  # 下班后开始、上班前结束, 中间为端午假期
+        (D(2021, 12, 30, 8), D(2022, 1, 1, 12), 20.0),
+    ]
+    end_time_cases = [
+        (D(2022, 1, 28, 15), 8, D(2022, 1, 29, 13)),
+        (D(2022, 1, 28, 15), 25, D(2022, 1, 31, 10)),
+        (D(2021, 12, 31, 10), 30, D(2022, 1, 6, 10)),
+        (D(2021, 12, 30, 16), 20, D(2022, 1, 1, 16)),
+        (D(2022, 9, 30, 17), 12.5, D(2022, 10, 9, 9, 30)),
+        (D(2022, 4, 29, 18), 15, D(2022, 5, 6, 13)),
+    ]
+
+    def test_calculate_datediff(self):
+        for start, end, hours in self.datediff_cases:
+            self.assertEqual(calculate_datediff(start, end), hours, (start, end))
+        starts = np.array([case[0] for case in self.datediff_cases], dtype='datetime64[s]')
+        ends = np.array([case[1] for case in self.datediff_cases], dtype='datetime64[s]')
+        self.assertEqual(list(calculate_datediff_array(starts, ends)), [case[2] for case in self.datediff_cases])
+
+    def test_calculate_end_time(self):
+        for start, hours, end in self.end_time_cases:
+            self.assertEqual(calculate_end_time(start, hours), end, (start, hours))
+
+
+class GetUsagetimeTest(SimpleTestCase):
+    start_time = datetime.datetime(2022, 3, 1, 9)
+    end_time = datetime.datetime(2022, 3, 31, 19)
+    D = datetime.datetime
+    # 开始时间, 结束时间, 记录的使用时长, 单价; 截取后的开始时间, 结束时间, 使用时长, 金额(原逐条截取的结果)
+    cases = [
+        ('区间内', D(2022, 3, 2, 10), D(2022, 3, 2, 15), 5.0, 2.0,
+         D(2022, 3, 2, 10), D(2022, 3, 2, 15), 5.0, 10.0),
+        ('跨开始时间', D(2022, 2, 28, 10), D(2022, 3, 1, 12), 12.0, 3.0,
+         D(2022, 3, 1, 9), D(2022, 3, 1, 12), 3.0, 9.0),
+        ('跨结束时间', D(2022, 3, 31, 17), D(2022, 4, 1, 11), 4.0, 4.0,
+         D(2022, 3, 31, 17), D(2022, 3, 31, 19), 2.0, 8.0),
+        ('覆盖整个区间', D(2022, 2, 25, 10), D(2022, 4, 2, 10), 300.0, 5.0,
+         D(2022, 3, 1, 9), D(2022, 3, 31, 19), 230.0, 1150.0),
+        ('结束时间为空', D(2022, 3, 3, 10), None, None, 6.0,
+         D(2022, 3, 3, 10), None, None, None),
+        ('截取后为0', D(2022, 2, 27, 10), D(2022, 3, 1, 9), 0.0, 7.0,
+         D(2022, 3, 1, 9), D(2022, 3, 1, 9), 0.0, 0.0),
+    ]
+
+    def case_df(self):
+        df = pd.DataFrame([case[1:5] for case in self.cases],
+                          columns=['start_time', 'end_time', 'usage_time', 'per_hour_price'])
+        df['total_amount'] = df['per_hour_price'] * df['usage_time']
+        return df
+
+    def test_boundary_cases(self):
+        result = get_usagetime(self.case_df(), self.start_time, self.end_time)
+        expected = pd.DataFrame([case[5:] for case in self.cases],
+                                columns=['start_time', 'end_time', 'usage_time', 'total_amount'])
+        for column in expected.columns:
+            for name, value, expected_value in zip([case[0] for case in self.cases], result[column],
+                                                   expected[column]):
+                if pd.isna(expected_value):
+                    self.assertTrue(pd.isna(value), '{} {}'.format(name, column))
+                else:
+                    self.assertEqual(value, expected_value, '{} {}'.format(name, column))
+        assert_frame_equal(result, legacy_usagetime(self.case_df(), self.start_time, self.end_time))
+
+
+class UsageRollupTest(TestCase):
+    start_time = datetime.datetime(2022, 3, 1, 12)
+    end_time = datetime.datetime(2022, 3, 20, 15, 30)
+
+    def setUp(self):
+        rng = np.random.RandomState(20220301)
+        self.user = User.objects.create(username='u1')
+        project = Project.objects.create(name='P1')
+        equipment_ids = ['EQ{}'.format(i) for i in range(4)]
+        for equipment_id in equipment_ids:
+            Equipment.objects.create(id=equipment_id)
+        records = []
+        for i in range(200):
+            start = datetime.datetime(2022, 2, 20) + datetime.timedelta(minutes=int(rng.randint(0, 40 * 24 * 60)))
+            end = start + datetime.timedelta(minutes=int(rng.randint(10, 6 * 24 * 60)))
+            records.append(EquipmentBorrowRecord(user=self.user, project=project,
+                                                 equipment_id=equipment_ids[i % 4], start_time=start,
+                                                 end_time=end, actual_end_time=end,
+                                                 actual_usage_time=working_calendar.working_hours(start, end),
+                                                 is_approval=1, is_return=2))
+        # 覆盖整个查询区间的记录, 单独放在一台设备上
+        Equipment.objects.create(id='EQ9')
+        span_start, span_end = datetime.datetime(2022, 2, 1), datetime.datetime(2022, 4, 1)
+        records.append(EquipmentBorrowRecord(user=self.user, project=project, equipment_id='EQ9',
+                                             start_time=span_start, end_time=span_end, actual_end_time=span_end,
+                                             actual_usage_time=working_calendar.working_hours(span_start, span_end),
+                                             is_approval=1, is_return=2))
+        EquipmentBorrowRecord.objects.bulk_create(records)
+        for equipment_id in equipment_ids + ['EQ9']:
+            refresh_usage_daily(equipment_id, datetime.date(2022, 2, 1), datetime.date(2022, 4, 30))
+
+    def get(self, **params):
+        params.update(start_time=self.start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                      end_time=self.end_time.strftime('%Y-%m-%d %H:%M:%S'))
+        request = APIRequestFactory().get('/usage-rate', params)
+        force_authenticate(request, self.user)
+        return get_usage_rate(request).data
+
+    def test_same_totals(self):
+        # 按借用记录直接截取计算的各设备工时
+        expected = {}
+        for record in EquipmentBorrowRecord.objects.all():
+            start = max(record.start_time, self.start_time)
+            end = min(record.actual_end_time, self.end_time)
+            seconds = working_calendar.working_seconds_array(np.datetime64(start), np.datetime64(end))
+            expected[record.equipment_id] = expected.get(record.equipment_id, 0) + int(seconds)
+        expected = {equipment_id: round(seconds / 3600, 2) for equipment_id, seconds in expected.items()}
+
+        summary = self.get(detail='0')
+        data = self.get()
+        self.assertEqual(summary['total_rate'], data['total_rate'])
+        self.assertEqual({item['equipment']: item['usage_time'] for item in data['total_rate']}, expected)
+        # 明细沿用原有的查询条件, 不包含覆盖整个区间的记录
+        detail_equipments = {item['equipment'] for item in data['usage_detail'] if item['equipment'] != ''}
+        self.assertEqual(detail_equipments, {'EQ0', 'EQ1', 'EQ2', 'EQ3'})
+
+
+class ReportOutputTest(TestCase):
+    """两个报表接口的JSON和excel输出, 与原接口逐条截取、逐组拼接合计得到的结果比较"""
+    size = 50000
+    params = {'start_time': '2022-03-01', 'end_time': '2022-10-31'}
+    start_time = datetime.datetime(2022, 3, 1, 9)
+    end_time = datetime.datetime(2022, 10, 31, 19)
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.RandomState(20220102)
+        sections = [Section.objects.create(name='部门{}'.format(i)) for i in range(5)]
+        cls.users = [User.objects.create(username='user{}'.format(i), section=sections[i % 5] if i % 7 else None)
+                     for i in range(20)]
+        projects = [Project.objects.create(name='项目{}'.format(i)) for i in range(300)]
+        Equipment.objects.bulk_create([Equipment(id='EQ{:03d}'.format(i), name='tester' if i % 10 else None)
+                                       for i in range(100)])
+        starts = np.datetime64('2022-01-01T00:00') + rng.randint(0, 360 * 24 * 60, cls.size).astype('timedelta64[m]')
+        ends = starts + rng.randint(10, 72 * 60, cls.size).astype('timedelta64[m]')
+        usage_times = working_calendar.working_hours_array(starts, ends)
+        prices = np.round(rng.rand(cls.size) * 100, 2)
+        records = []
+        for i, (start, end) in enumerate(zip(starts.astype(datetime.datetime), ends.astype(datetime.datetime))):
+            records.append(EquipmentBorrowRecord(
+                user=cls.users[i % 20], project=projects[rng.randint(0, 300)],
+                equipment_id='EQ{:03d}'.format(rng.randint(0, 100)), start_time=start, end_time=end,
+                actual_end_time=end, actual_usage_time=usage_times[i], per_hour_price=prices[i],
+                total_amount=round(usage_times[i] * prices[i], 2), is_approval=1, is_return=2))
+        EquipmentBorrowRecord.objects.bulk_create(records, batch_size=500)
+        call_command('rebuild_usage_daily', stdout=io.StringIO())
+
+    def setUp(self):
+        chart_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(chart_dir.cleanup)
+        patcher = mock.patch.object(chart_utils, 'CHART_DIR', chart_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, view, **params):
+        request = APIRequestFactory().get('/', dict(self.params, **params))
+        force_authenticate(request, self.users[0])
+        return view(request)
+
+    def read_export(self, response):
+        return load_workbook(io.BytesIO(b''.join(response.streaming_content)), read_only=True)
+
+    def sheet_rows(self, workbook, sheet_name):
+        """跳过标题行读取数据, 空单元格按空字符串比较"""
+        rows = workbook[sheet_name].iter_rows(min_row=3, values_only=True)
+        return [['' if value is None else value for value in row] for row in rows]
+
+    def legacy_records(self, *fields):
+        """原接口的查询条件: 区间内或与区间首尾相交的记录"""
+        qs = EquipmentBorrowRecord.objects.filter(
+            Q(start_time__gte=self.start_time, actual_end_time__lte=self.end_time) |
+            Q(start_time__range=[self.start_time, self.end_time]) |
+            Q(actual_end_time__range=[self.start_time, self.end_time]))
+        return pd.DataFrame(list(qs.values(*fields)))
+
+    def legacy_usage_detail(self):
+        """原get_usage_rate的明细: 记录的实际使用时长, 跨边界记录逐条截取, 逐组拼接合计"""
+        df = self.legacy_records('id', 'user_id', 'user__username', 'equipment_id', 'equipment__name',
+                                 'start_time', 'actual_end_time', 'actual_usage_time')
+        ndf = df.rename({'actual_end_time': 'end_time', 'actual_usage_time': 'usage_time',
+                         'user__username': 'user_name', 'equipment__name': 'equipment_name'}, axis=1)
+        ndf['usage_time'] = ndf['usage_time'].map(lambda x: float(x) if x else x)
+        ndf = legacy_usagetime(ndf, self.start_time, self.end_time)
+        ndf = ndf[ndf['usage_time'] > 0]
+        mdf = ndf[['equipment_id', 'equipment_name', 'user_name', 'start_time', 'end_time', 'usage_time']]
+        mdf = mdf.sort_values('start_time')
+        return format_usage(legacy_subtotal(mdf, 'equipment_id', 'usage_time', 'total'))
+
+    def legacy_equipment_fee(self):
+        """原get_equipment_fee的计算, 金额为0的Decimal同样转为float, 与修正后的接口一致"""
+        ndf = self.legacy_records('project__name', 'user__section__name', 'equipment_id', 'equipment__name',
+                                  'start_time', 'actual_end_time', 'actual_usage_time', 'per_hour_price',
+                                  'total_amount')
+        ndf = ndf.rename({'project__name': 'project_name', 'user__section__name': 'section_name',
+                          'equipment__name': 'equipment_name', 'actual_end_time': 'end_time',
+                          'actual_usage_time': 'usage_time'}, axis=1)
+        for column in ['usage_time', 'per_hour_price', 'total_amount']:
+            ndf[column] = ndf[column].map(lambda x: float(x) if x is not None else x)
+        ndf = legacy_usagetime(ndf, self.start_time, self.end_time)
+        columns = ['project_name', 'section_name', 'equipment_id', 'equipment_name']
+        tdf = ndf[columns + ['total_amount']].copy()
+        tdf[columns] = tdf[columns].replace({None: ''})
+        tdf = tdf.groupby(columns).sum().reset_index()
+        expected = legacy_subtotal(tdf, 'project_name', 'total_amount', '总计')
+        expected['total_amount'] = expected['total_amount'].map(lambda x: round(x, 2))
+        return expected
+
+    def test_usage_rate(self):
+        expected = self.legacy_usage_detail()
+        data = self.get(get_usage_rate).data
+        self.assertEqual(data['usage_detail'],
+                         expected.rename({'equipment_id': 'equipment'}, axis=1).to_dict('records'))
+        workbook = self.read_export(self.get(get_usage_rate, operate='export'))
+        self.assertEqual(self.sheet_rows(workbook, '使用明细'), expected.values.tolist())
+        self.assertEqual(self.sheet_rows(workbook, '使用率'), [list(item.values()) for item in data['total_rate']])
+
+    def test_equipment_fee(self):
+        expected = self.legacy_equipment_fee()
+        data = self.get(get_equipment_fee).data
+        self.assertEqual(data, expected.rename({'equipment_id': 'equipment'}, axis=1).to_dict('records'))
+        workbook = self.read_export(self.get(get_equipment_fee, operate='export'))
+        self.assertEqual(self.sheet_rows(workbook, '项目费用'), expected.values.tolist())
+
+
+def fake_export(request):
+    excel_file = create_excel_buffer()
+    excel_file.write(request.GET['content'].encode())
+    return create_excel_resp(excel_file, '测试导出')
+
+
+@mock.patch.dict(export_jobs.EXPORT_TASKS, {'fake': (fake_export, {})})
+@mock.patch.object(export_jobs.ExportWorker, 'notify', lambda self: None)
+class ExportJobQueueTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='u1')
+        job_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(job_dir.cleanup)
+        patcher = mock.patch.object(export_jobs, 'EXPORT_JOB_DIR', job_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def worker(self, worker_id):
+        worker = export_jobs.ExportWorker()
+        worker.worker_id = worker_id
+        return worker
+
+    def test_dedup_and_run(self):
+        job = export_jobs.submit_export_job('fake', {'content': 'a'}, self.user)
+        self.assertEqual(export_jobs.submit_export_job('fake', {'content': 'a'}, self.user).id, job.id)
+        # 另一进程在查询之后抢先创建了相同任务, 由唯一约束拦截后返回已有任务
+        real_filter = ExportJob.objects.filter
+        lookups = []
+
+        def racing_filter(*args, **kwargs):
+            if 'active_key' in kwargs and not lookups:
+                lookups.append(kwargs)
+                return ExportJob.objects.none()
+            return real_filter(*args, **kwargs)
+        with mock.patch.object(ExportJob.objects, 'filter', side_effect=racing_filter):
+            self.assertEqual(export_jobs.submit_export_job('fake', {'content': 'a'}, self.user).id, job.id)
+        self.assertEqual(ExportJob.objects.count(), 1)
+        self.assertEqual(self.worker('w1').run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.active_key, job.file_name), (2, None, '测试导出'))
+        with open(job.file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'a')
+        # 完成后相同参数可再次提交
+        self.assertNotEqual(export_jobs.submit_export_job('fake', {'content': 'a'}, self.user).id, job.id)
+
+    def test_requeue_dead_worker(self):
+        job = export_jobs.submit_export_job('fake', {'content': 'b'}, self.user)
+        dead = self.worker('dead')
+        self.assertEqual(dead.claim(), job.id)
+        live = self.worker('live')
+        self.assertEqual(live.recover(), 0)  # 心跳未超时
+        ExportJob.objects.filter(id=job.id).update(
+            heartbeat=datetime.datetime.now() - datetime.timedelta(seconds=export_jobs.EXPORT_STALE_SECONDS + 1))
+        self.assertEqual(live.recover(), 1)
+        self.assertEqual(live.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts), (2, 'live', 2))
+        # 已退出的进程不会再更新被重新认领的任务
+        with mock.patch.dict(export_jobs.EXPORT_TASKS, {'fake': (mock.Mock(side_effect=RuntimeError), {})}):
+            export_jobs.run_export_job(job.id, 'dead')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), (2, 'live'))
+        self.assertTrue(os.path.exists(job.file_path))
+
+    def test_give_up_after_attempts(self):
+        job = export_jobs.submit_export_job('fake', {'content': 'c'}, self.user)
+        stale_time = datetime.datetime.now() - datetime.timedelta(seconds=export_jobs.EXPORT_STALE_SECONDS + 1)
+        ExportJob.objects.filter(id=job.id).update(status=1, worker='dead', heartbeat=stale_time,
+                                                   attempts=export_jobs.EXPORT_MAX_ATTEMPTS)
+        self.worker('live').recover()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.active_key), (3, None))
@@ -7,4 +7,7 @@ urlpatterns = [
     url(r'^maintenance-time$', views.get_maintenance_time),
     url(r'^broken-record$', views.get_broken_record),
     url(r'^use-fee$', views.get_equipment_fee),
+    url(r'^export-job$', views.submit_export),
+    url(r'^export-job/(?P<pk>[0-9]+)$', views.get_export_job),
+    url(r'^export-job/(?P<pk>[0-9]+)/download$', views.download_export_job),
 ]
@@ -0,0 +1,133 @@
+from django.db import transaction
+from django.db.models import Sum
+
+from equipments.models import EquipmentBorrowRecord
+from reports.models import EquipmentUsageDaily
+from utils.timedelta_utls import working_calendar
+
+import datetime
+import numpy as np
+import pandas as pd
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+def split_daily_usage(records, first_day=None, last_day=None):
+    """
+    把借用记录按自然日拆分, 计算每天的工作时长(秒)
+    records需包含equipment_id, user_id, project_id, start_time, end_time
+    first_day/last_day限制只返回该日期区间内的数据
+    """
+    columns = ['usage_date', 'equipment_id', 'user_id', 'project_id', 'usage_seconds', 'record_count']
+    records = records[records['start_time'].notna() & records['end_time'].notna()]
+    if records.empty:
+        return pd.DataFrame(columns=columns)
+    starts = records['start_time'].values.astype('datetime64[s]')
+    ends = records['end_time'].values.astype('datetime64[s]')
+    start_days = starts.astype('datetime64[D]')
+    end_days = ends.astype('datetime64[D]')
+    if first_day is not None:
+        start_days = np.maximum(start_days, np.datetime64(first_day, 'D'))
+    if last_day is not None:
+        end_days = np.minimum(end_days, np.datetime64(last_day, 'D'))
+    day_counts = np.maximum((end_days - start_days).astype(np.int64) + 1, 0)
+    positions = np.repeat(np.arange(len(records)), day_counts)
+    # 每条记录内的天数偏移
+    offsets = np.arange(len(positions)) - np.repeat(np.cumsum(day_counts) - day_counts, day_counts)
+    days = start_days[positions] + offsets * ONE_DAY
+    piece_starts = np.maximum(starts[positions], days.astype('datetime64[s]'))
+    piece_ends = np.minimum(ends[positions], (days + ONE_DAY).astype('datetime64[s]'))
+    seconds = working_calendar.working_seconds_array(piece_starts, piece_ends)
+    pieces = pd.DataFrame({
+        'usage_date': days,
+        'equipment_id': records['equipment_id'].values[positions],
+        'user_id': records['user_id'].values[positions],
+        'project_id': records['project_id'].values[positions],
+        'usage_seconds': seconds,
+        'record_count': np.ones(len(positions), dtype=np.int64)
+    })
+    pieces = pieces[pieces['usage_seconds'] > 0]
+    if pieces.empty:
+        return pd.DataFrame(columns=columns)
+    return pieces.groupby(columns[:4], sort=False)[['usage_seconds', 'record_count']].sum().reset_index()
+
+
+def get_returned_records(queryset):
+    """查询已归还的借用记录, 转换成split_daily_usage需要的格式"""
+    qs = queryset.filter(is_approval=1, is_return=2).values('equipment_id', 'user_id', 'project_id',
+                                                            'start_time', 'actual_end_time')
+    df = pd.DataFrame(list(qs), columns=['equipment_id', 'user_id', 'project_id', 'start_time', 'actual_end_time'])
+    df.rename({'actual_end_time': 'end_time'}, axis=1, inplace=True)
+    df['start_time'] = pd.to_datetime(df['start_time'])
+    df['end_time'] = pd.to_datetime(df['end_time'])
+    return df
+
+
+def refresh_usage_daily(equipment_id, first_day, last_day):
+    """根据借用记录重新生成某个设备在日期区间内的每日使用汇总"""
+    day_start = datetime.datetime.combine(first_day, datetime.time())
+    day_end = datetime.datetime.combine(last_day, datetime.time()) + datetime.timedelta(days=1)
+    queryset = EquipmentBorrowRecord.objects.filter(equipment_id=equipment_id, start_time__lt=day_end,
+                                                    actual_end_time__gt=day_start)
+    daily_df = split_daily_usage(get_returned_records(queryset), first_day, last_day)
+    usage_objs = [EquipmentUsageDaily(usage_date=pd.Timestamp(row['usage_date']).date(),
+                                      equipment_id=row['equipment_id'],
+                                      user_id=row['user_id'],
+                                      project_id=row['project_id'],
+                                      usage_seconds=int(row['usage_seconds']),
+                                      record_count=int(row['record_count']))
+                  for row in daily_df.to_dict('records')]
+    with transaction.atomic():
+        EquipmentUsageDaily.objects.filter(equipment_id=equipment_id,
+                                           usage_date__range=[first_day, last_day]).delete()
+        EquipmentUsageDaily.objects.bulk_create(usage_objs, batch_size=500)
+    return len(usage_objs)
+
+
+def refresh_borrow_usage(borrow_record):
+    """借用记录归还或删除后, 刷新其覆盖日期的每日使用汇总"""
+    if not borrow_record.start_time or not borrow_record.actual_end_time:
+        return 0
+    return refresh_usage_daily(borrow_record.equipment_id, borrow_record.start_time.date(),
+                               borrow_record.actual_end_time.date())
+
+
+def clip_working_seconds(df, start_time, end_time):
+    """把记录的开始结束时间截取到区间内, 返回截取后的开始时间、结束时间及工作时长(秒)"""
+    clip_start = df['start_time'].where(df['start_time'] >= start_time, start_time)
+    clip_end = df['end_time'].where(df['end_time'] <= end_time, end_time)
+    seconds = working_calendar.working_seconds_array(clip_start.values, clip_end.values)
+    return clip_start, clip_end, seconds
+
+
+def get_usage_summary(filter_params, start_time, end_time):
+    """
+    区间内各设备的使用工时(秒)
+    中间的整天直接读取每日汇总, 首尾两天按借用记录精确计算
+    filter_params为同时适用于借用记录和每日汇总的过滤条件
+    """
+    first_day = start_time.date()
+    last_day = end_time.date()
+    first_day_end = datetime.datetime.combine(first_day, datetime.time()) + datetime.timedelta(days=1)
+    edges = [(start_time, min(end_time, first_day_end))]
+    if last_day > first_day:
+        edges.append((datetime.datetime.combine(last_day, datetime.time()), end_time))
+
+    usage = {}
+    for edge_start, edge_end in edges:
+        queryset = EquipmentBorrowRecord.objects.filter(start_time__lt=edge_end, actual_end_time__gt=edge_start,
+                                                        **filter_params)
+        df = get_returned_records(queryset)
+        if df.empty:
+            continue
+        _, _, seconds = clip_working_seconds(df, edge_start, edge_end)
+        for equipment_id, value in pd.Series(seconds).groupby(df['equipment_id'].values).sum().items():
+            usage[equipment_id] = usage.get(equipment_id, 0) + int(value)
+
+    if last_day - first_day > datetime.timedelta(days=1):
+        daily_qs = EquipmentUsageDaily.objects.filter(usage_date__gt=first_day, usage_date__lt=last_day,
+                                                      **filter_params)
+        daily_qs = daily_qs.values('equipment_id').annotate(usage_seconds=Sum('usage_seconds'))
+        for item in daily_qs:
+            usage[item['equipment_id']] = usage.get(item['equipment_id'], 0) + item['usage_seconds']
+    return {equipment_id: seconds for equipment_id, seconds in usage.items() if seconds > 0}
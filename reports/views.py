@@ -8,15 +8,17 @@ from rest_framework.response import Response
 
 from equipments.models import EquipmentBorrowRecord, EquipmentMaintenanceRecord, EquipmentBrokenInfo
 from reports.time_utils import get_start_end
-from utils.timedelta_utls import calculate_datediff
-from equipments.ext_utils import REST_SUCCESS, REST_FAIL, create_suffix, create_excel_resp, get_file_path
+from reports.chart_utils import submit_usage_chart
+from reports.export_jobs import ExportJob, export_task, submit_export_job, expire_stale_jobs, get_job_info, \
+    export_worker
+from reports.usage_utils import get_usage_summary
+from utils.timedelta_utls import calculate_datediff, calculate_datediff_array
+from equipments.ext_utils import REST_SUCCESS, REST_FAIL, create_suffix, create_excel_buffer, create_excel_resp
 from utils.permission import IsSuperUser
 
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 import datetime
-import time
-import hashlib
 import os
 import traceback
 import logging
@@ -26,39 +28,54 @@ logger = logging.getLogger('django')
 
 # 根据开始结束时间，得出记录在此区间内的使用时长
 def get_usagetime(ndf, start_time, end_time):
-    # 找出记录开始时间位于查询开始时间之前的记录
-    last_ls = list(ndf.loc[ndf['start_time'] < start_time].index)
-    for index in last_ls:
-        usage_time = calculate_datediff(start_time, ndf['end_time'].iloc[index].to_pydatetime())
-        ndf['usage_time'].iloc[index] = usage_time
-        if 'total_amount' in ndf:
-            ndf['total_amount'].iloc[index] = ndf['per_hour_price'].iloc[index] * usage_time
-        ndf['start_time'].iloc[index] = start_time
-    # 找出记录结束时间位于查询结束时间之后的记录
-    next_ls = list(ndf.loc[ndf['end_time'] > end_time].index)
-    for index in next_ls:
-        usage_time = calculate_datediff(ndf['start_time'].iloc[index].to_pydatetime(), end_time)
-        ndf['usage_time'].iloc[index] = usage_time
-        if 'total_amount' in ndf:
-            ndf['total_amount'].iloc[index] = ndf['per_hour_price'].iloc[index] * usage_time
-        ndf['end_time'].iloc[index] = end_time
+    # 找出开始时间位于查询开始时间之前、或结束时间位于查询结束时间之后的记录，截取到查询区间内整列重新计算
+    cross_mask = (ndf['start_time'] < start_time) | (ndf['end_time'] > end_time)
+    if not cross_mask.any():
+        return ndf
+    cross_df = ndf.loc[cross_mask]
+    clip_start = cross_df['start_time'].where(cross_df['start_time'] >= start_time, start_time)
+    clip_end = cross_df['end_time'].where(~(cross_df['end_time'] > end_time), end_time)
+    usage_time = calculate_datediff_array(clip_start.values, clip_end.values)
+    ndf.loc[cross_mask, 'usage_time'] = usage_time
+    if 'total_amount' in ndf:
+        ndf.loc[cross_mask, 'total_amount'] = cross_df['per_hour_price'].values * usage_time
+    ndf.loc[cross_mask, 'start_time'] = clip_start
+    ndf.loc[cross_mask, 'end_time'] = clip_end
     return ndf
 
 
+# 按分组列排序，并在每组明细之后插入一行合计，合计行除合计列外均为空字符串
+def insert_subtotal(df, group_col, sum_col, total_label):
+    df = df.sort_values(group_col, kind='mergesort')
+    grouped = df.groupby(group_col, sort=True)
+    # 逐组调用Series.sum, 与原先对每组明细求和的累加顺序一致, 避免合计在四舍五入时差一分
+    totals = grouped[sum_col].apply(lambda values: values.sum())
+    total_df = pd.DataFrame({sum_col: totals.values}, index=[total_label] * len(totals))
+    final_df = pd.concat([df, total_df], axis=0, sort=False)
+    # 先按组号、再按明细在前合计在后排列，组内明细保持原有顺序
+    group_no = np.concatenate([grouped.ngroup().values, np.arange(len(totals))])
+    is_total = np.concatenate([np.zeros(len(df), dtype=int), np.ones(len(totals), dtype=int)])
+    final_df = final_df.iloc[np.lexsort((is_total, group_no))]
+    return final_df.astype(object).fillna('')
+
+
 # 查询设备使用率
 @api_view(['GET'])
+@export_task('usage_rate', operate='export')
 def get_usage_rate(request):
     try:
-        obj = EquipmentBorrowRecord.objects.filter(is_approval=1, is_return=2)
+        # 同时适用于借用记录和每日使用汇总的过滤条件
+        filter_params = {}
         user_name = request.GET.get('user_name')
         if user_name:
-            obj = obj.filter(user__username__contains=user_name)
+            filter_params['user__username__contains'] = user_name
         equipment_id = request.GET.get('equipment')
         if equipment_id:
-            obj = obj.filter(equipment_id=equipment_id)
+            filter_params['equipment_id'] = equipment_id
         equipment_name = request.GET.get('equipment_name')
         if equipment_name:
-            obj = obj.filter(equipment__name__contains=equipment_name)
+            filter_params['equipment__name__contains'] = equipment_name
+        obj = EquipmentBorrowRecord.objects.filter(is_approval=1, is_return=2, **filter_params)
         start_time = request.GET.get('start_time')
         end_time = request.GET.get('end_time')
         if start_time and end_time:
@@ -78,13 +95,30 @@ def get_usage_rate(request):
             date_type = request.GET.get('date_type', 'week')  # week, month, year
             start_time, end_time = get_start_end(date_type)
             total_weekday = total_weekday_map[date_type]
+        operate = request.GET.get('operate', 'list')
+        # 使用率读取每日使用汇总, 只有首尾两天按借用记录精确计算
+        usage = get_usage_summary(filter_params, start_time, end_time)
+        if not usage:
+            return REST_SUCCESS({})
+        total_df = pd.DataFrame(sorted(usage.items()), columns=['equipment_id', 'usage_time'])
+        total_df['usage_time'] = total_df['usage_time'] / 3600
+        total_df['total_weekday'] = total_weekday
+        total_df['percentage'] = round(total_df['usage_time'] / total_df['total_weekday'], 4)
+        total_df['usage_time'] = total_df['usage_time'].map(lambda x: round(x, 2))
+        rate_df = total_df
+        if request.GET.get('detail') == '0' and operate != 'export':
+            # 只查询使用率时不再拉取借用记录明细
+            rate_df = rate_df.rename({'equipment_id': 'equipment'}, axis=1)
+            return REST_SUCCESS({'total_rate': rate_df.to_dict('records')})
+
+        # 明细仍按原条件取借用记录, 使用计费时记录的实际使用时长, 跨区间边界的记录截取后重新计算
         obj = obj.filter(Q(start_time__gte=start_time, actual_end_time__lte=end_time) |
                          Q(start_time__range=[start_time, end_time]) | Q(actual_end_time__range=[start_time, end_time]))
         borrow_record_qs = obj.values('id', 'user_id', 'user__username', 'equipment_id', 'equipment__name',
                                       'start_time', 'actual_end_time', 'actual_usage_time')
-        if not borrow_record_qs:
-            return REST_SUCCESS({})
-        df = pd.DataFrame(list(borrow_record_qs))
+        df = pd.DataFrame(list(borrow_record_qs), columns=['id', 'user_id', 'user__username', 'equipment_id',
+                                                           'equipment__name', 'start_time', 'actual_end_time',
+                                                           'actual_usage_time'])
         ndf = df.rename({'actual_end_time': 'end_time', 'actual_usage_time': 'usage_time',
                          'user__username': 'user_name', 'equipment__name': 'equipment_name'}, axis=1)
         ndf['usage_time'] = ndf['usage_time'].map(lambda x: float(x) if x else x)
@@ -93,69 +127,21 @@ def get_usage_rate(request):
 
         # 按设备统计明细
         mdf = ndf[['equipment_id', 'equipment_name', 'user_name', 'start_time', 'end_time', 'usage_time']]
-        mdf.sort_values('start_time', inplace=True)
-        equipment_id_ls = [equipment_id for equipment_id in list(mdf['equipment_id'].unique())]
-        equipment_id_ls.sort()
-
-        final_df = pd.DataFrame(columns=['equipment_id', 'equipment_name', 'user_name', 'start_time', 'end_time', 'usage_time'],
-                                dtype=object)
-        for equipment_id in equipment_id_ls:
-            ldf = mdf[mdf['equipment_id'] == equipment_id]
-            ldf.loc['total'] = ldf[['usage_time']].apply(lambda x: x.sum())
-            ldf.fillna('', inplace=True)
-            final_df = pd.concat([final_df, ldf], axis=0)
+        mdf = mdf.sort_values('start_time')
+        final_df = insert_subtotal(mdf, 'equipment_id', 'usage_time', 'total')
         final_df['start_time'] = final_df['start_time'].map(lambda x: x.strftime('%Y-%m-%d %H:%M:%S') if x else x)
         final_df['end_time'] = final_df['end_time'].map(lambda x: x.strftime('%Y-%m-%d %H:%M:%S') if x else x)
         final_df['usage_time'] = final_df['usage_time'].map(lambda x: round(x, 2))
         usage_df = final_df
 
-        # 计算使用率
-        total_df = ndf[['equipment_id', 'usage_time']]
-        total_df = total_df.groupby('equipment_id').sum().reset_index()
-        total_df['total_weekday'] = total_weekday
-        total_df['percentage'] = round(total_df['usage_time'] / total_df['total_weekday'], 4)
-        total_df['usage_time'] = total_df['usage_time'].map(lambda x: round(x, 2))
-        rate_df = total_df
-
-        operate = request.GET.get('operate', 'list')
         if operate == 'export':
-            # 绘制使用率图
-            def autolabel(rects):
-                """显示柱状上的数值"""
-                for rect in rects:
-                    height = rect.get_height()
-                    plt.text(rect.get_x() + rect.get_width() / n - 0.1, height + 1, '%s' % float(height))
-
-            total_width, n = 0.4, 2
-            width = total_width / n
-            plt.rcParams['font.sans-serif'] = ['SimHei']  # 用来正常显示中文标签
-            plt.rcParams['axes.unicode_minus'] = False  # 用来正常显示负号
-            x = total_df.index.tolist()
-            fig = plt.figure()
-            plt.grid(axis='y', alpha=0.2)
-            for i in range(len(x)):
-                x[i] = x[i] + width
+            # 后台绘制使用率图, 与生成excel并行
+            chart_future = submit_usage_chart(total_df, total_weekday)
             total_weekday_label = 'Total Weekday({}H)'.format(total_weekday)
-            t1 = plt.bar(x, total_df['usage_time'], width=width, tick_label=total_df['equipment_id'],
-                         label='Total Usage Time(H)', fc='b')
-            for i in range(len(x)):
-                x[i] = x[i] + width
-            t2 = plt.bar(x, total_df['total_weekday'], width=width, label=total_weekday_label, fc='r')
-            autolabel(t1)
-            autolabel(t2)
-            plt.xticks(rotation=45)
-            plt.legend(bbox_to_anchor=(1.0, 0.7), prop={'size': 12})
-            current_path = os.path.dirname(__file__)
-            image_dir = os.path.join(current_path, 'report_images')
-            if not os.path.exists(image_dir):
-                os.mkdir(image_dir)
-            image_name = hashlib.md5(str(time.time()).encode()).hexdigest() + '.jpg'
-            image_path = os.path.join(image_dir, image_name)
-            plt.savefig(image_path, dpi=150, bbox_inches='tight')
 
             # 保存成excel文件
-            file_path = get_file_path('usage')
-            writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+            excel_file = create_excel_buffer()
+            writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
             workbook = writer.book
             border_format = workbook.add_format({'border': 1})
             note_fmt = workbook.add_format({'bold': True, 'font_size': 10, 'font_color': 'red',
@@ -204,9 +190,9 @@ def get_usage_rate(request):
             worksheet1.conditional_format('A1:D%d' % l1_end, {'type': 'no_blanks', 'format': border_format})
             worksheet2 = writer.book.add_worksheet('统计图')
             worksheet2.merge_range('A1:G1', 'Begin: {}  End: {}'.format(start_time, end_time), note_fmt)
-            worksheet2.insert_image(1, 0, image_path)
+            worksheet2.insert_image(1, 0, 'usage_chart.png', {'image_data': chart_future.result()})
             writer.save()
-            return create_excel_resp(file_path, '设备使用率统计表')
+            return create_excel_resp(excel_file, '设备使用率统计表')
 
         data = {}
         # data['image_name'] = image_name
@@ -222,6 +208,7 @@ def get_usage_rate(request):
 
 # 查询设备使用记录
 @api_view(['GET'])
+@export_task('use_detail', operate='export')
 def get_use_detail(request):
     try:
         obj = EquipmentBorrowRecord.objects.filter(is_approval=1, is_return=2)
@@ -269,8 +256,8 @@ def get_use_detail(request):
         ndf = ndf[ndf['usage_time'] > 0]
         operate = request.GET.get('operate', 'list')
         if operate == 'export':
-            file_path = get_file_path('detail')
-            writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+            excel_file = create_excel_buffer()
+            writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
             workbook = writer.book
             fmt = workbook.add_format({'font_size': 11})
             border_format = workbook.add_format({'border': 1})
@@ -294,7 +281,7 @@ def get_use_detail(request):
             worksheet.set_column('G:G', 16, float_fmt)
             worksheet.conditional_format('A1:G%d' % l_end, {'type': 'no_blanks', 'format': border_format})
             writer.save()
-            return create_excel_resp(file_path, '使用记录表')
+            return create_excel_resp(excel_file, '使用记录表')
         ndf.rename({'equipment_id': 'equipment'}, axis=1, inplace=True)
         datas = ndf.to_dict('records')
         return REST_SUCCESS(datas)
@@ -305,6 +292,7 @@ def get_use_detail(request):
 
 # 查询设备维修时间
 @api_view(['GET'])
+@export_task('maintenance_time', operate='export')
 def get_maintenance_time(request):
     try:
         obj = EquipmentMaintenanceRecord.objects
@@ -346,8 +334,8 @@ def get_maintenance_time(request):
         total_df['maintenance_hours'] = total_df['maintenance_hours'].map(lambda x: round(x, 2))
         operate = request.GET.get('operate', 'list')
         if operate == 'export':
-            file_path = get_file_path('maintenance')
-            writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+            excel_file = create_excel_buffer()
+            writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
             workbook = writer.book
             fmt = workbook.add_format({'font_size': 11})
             border_format = workbook.add_format({'border': 1})
@@ -379,7 +367,7 @@ def get_maintenance_time(request):
                                                             'format': percent_fmt})
             worksheet.conditional_format('A1:E%d' % l_end, {'type': 'no_blanks', 'format': border_format})
             writer.save()
-            return create_excel_resp(file_path, '维修记录表')
+            return create_excel_resp(excel_file, '维修记录表')
         total_df.rename({'equipment_id': 'equipment'}, axis=1, inplace=True)
         result = total_df.to_dict('records')
         return REST_SUCCESS(result)
@@ -390,6 +378,7 @@ def get_maintenance_time(request):
 
 # 导出设备损坏信息
 @api_view(['GET'])
+@export_task('broken_record', operate='export')
 def get_broken_record(request):
     try:
         obj = EquipmentBrokenInfo.objects
@@ -409,8 +398,8 @@ def get_broken_record(request):
         ndf['broken_time'] = ndf['broken_time'].map(lambda x: x.strftime('%Y-%m-%d %H:%M:%S'))
         operate = request.GET.get('operate', 'list')
         if operate == 'export':
-            file_path = get_file_path('broken')
-            writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+            excel_file = create_excel_buffer()
+            writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
             workbook = writer.book
             fmt = workbook.add_format({'font_size': 11})
             border_format = workbook.add_format({'border': 1})
@@ -433,7 +422,7 @@ def get_broken_record(request):
             worksheet.set_column('E:E', 22, float_fmt)
             worksheet.conditional_format('A1:E%d' % l_end, {'type': 'no_blanks', 'format': border_format})
             writer.save()
-            return create_excel_resp(file_path, '损坏信息表')
+            return create_excel_resp(excel_file, '损坏信息表')
 
         ndf.rename({'equipment_id': 'equipment'}, axis=1, inplace=True)
         data = ndf.to_dict('records')
@@ -445,6 +434,7 @@ def get_broken_record(request):
 
 # 导出项目计费
 @api_view(['GET'])
+@export_task('equipment_fee', operate='export')
 def get_equipment_fee(request):
     try:
         obj = EquipmentBorrowRecord.objects.filter(~Q(total_amount=None), is_approval=1, is_return=2)
@@ -480,32 +470,24 @@ def get_equipment_fee(request):
         ndf = df.rename({'project__name': 'project_name',
                          'user__section__name': 'section_name', 'equipment__name': 'equipment_name',
                          'actual_end_time': 'end_time', 'actual_usage_time': 'usage_time'}, axis=1)
-        ndf['usage_time'] = ndf['usage_time'].map(lambda x: float(x) if x else x)
-        ndf['per_hour_price'] = ndf['per_hour_price'].map(lambda x: float(x) if x else x)
-        ndf['total_amount'] = ndf['total_amount'].map(lambda x: float(x) if x else x)
+        # 金额为0的Decimal也需转换, 否则与float混在一起时分组求和会丢掉该列
+        ndf['usage_time'] = ndf['usage_time'].map(lambda x: float(x) if x is not None else x)
+        ndf['per_hour_price'] = ndf['per_hour_price'].map(lambda x: float(x) if x is not None else x)
+        ndf['total_amount'] = ndf['total_amount'].map(lambda x: float(x) if x is not None else x)
         ndf = get_usagetime(ndf, start_time, end_time)
         tdf = ndf[['project_name', 'section_name', 'equipment_id', 'equipment_name', 'total_amount']]
         tdf[['project_name', 'section_name', 'equipment_id', 'equipment_name']] = \
             tdf[['project_name', 'section_name', 'equipment_id', 'equipment_name']].replace({None: ''})
         tdf = tdf.groupby(['project_name', 'section_name', 'equipment_id', 'equipment_name']).sum().reset_index()
-        project_name_ls = [project_name for project_name in list(tdf['project_name'].unique())]
-        project_name_ls.sort()
-
-        final_df = pd.DataFrame(columns=['project_name', 'section_name', 'equipment_id', 'equipment_name', 'total_amount'],
-                                dtype=object)
-        for project_name in project_name_ls:
-            ldf = tdf[tdf['project_name'] == project_name]
-            ldf.loc['总计'] = ldf[['total_amount']].apply(lambda x: x.sum())
-            ldf.fillna('', inplace=True)
-            final_df = pd.concat([final_df, ldf], axis=0)
+        final_df = insert_subtotal(tdf, 'project_name', 'total_amount', '总计')
         final_df['total_amount'] = final_df['total_amount'].map(lambda x: round(x, 2))
         excel_df = final_df.rename({'project_name': '项目', 'section_name': '部门', 'equipment_id': '设备ID',
                                     'equipment_name': '设备名称', 'total_amount': '费用'}, axis=1)
 
         operate = request.GET.get('operate', 'list')
         if operate == 'export':
-            file_path = get_file_path('fee')
-            writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+            excel_file = create_excel_buffer()
+            writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
             workbook = writer.book
             fmt = workbook.add_format({'font_size': 11})
             border_format = workbook.add_format({'border': 1})
@@ -531,10 +513,50 @@ def get_equipment_fee(request):
             worksheet.conditional_format('A1:E%d' % l_end, {'type': 'no_blanks', 'format': border_format})
             worksheet.conditional_format('A1:E%d' % l_end, {'type': 'blanks', 'format': blank_fmt})
             writer.save()
-            return create_excel_resp(file_path, '设备使用计费表')
+            return create_excel_resp(excel_file, '设备使用计费表')
         final_df.rename({'equipment_id': 'equipment'}, axis=1, inplace=True)
         data = final_df.to_dict('records')
         return REST_SUCCESS(data)
     except Exception as e:
         logger.error('查询失败, error: {}'.format(traceback.format_exc()))
         return REST_FAIL({'msg': '查询失败, error: {}'.format(str(e))})
+
+
+# 提交后台导出任务
+@api_view(['POST'])
+def submit_export(request):
+    try:
+        export_name = request.data.get('export_name')
+        params = request.data.get('params') or {}
+        if not export_name:
+            return REST_FAIL({'msg': 'export_name不能为空'})
+        if not isinstance(params, dict):
+            return REST_FAIL({'msg': 'params格式错误'})
+        job = submit_export_job(export_name, params, request.user)
+        return REST_SUCCESS(get_job_info(job))
+    except Exception as e:
+        logger.error('提交导出任务失败, error: {}'.format(traceback.format_exc()))
+        return REST_FAIL({'msg': '提交导出任务失败, error: {}'.format(str(e))})
+
+
+# 查询导出任务状态
+@api_view(['GET'])
+def get_export_job(request, pk):
+    # 进程重启后由轮询状态的请求启动工作线程, 继续处理表中排队的任务
+    export_worker.ensure_started()
+    expire_stale_jobs()
+    job = ExportJob.objects.filter(id=pk, user=request.user).first()
+    if not job:
+        return REST_FAIL({'msg': '导出任务不存在'})
+    return REST_SUCCESS(get_job_info(job))
+
+
+# 下载导出任务生成的文件
+@api_view(['GET'])
+def download_export_job(request, pk):
+    job = ExportJob.objects.filter(id=pk, user=request.user).first()
+    if not job:
+        return REST_FAIL({'msg': '导出任务不存在'})
+    if job.status != 2 or not os.path.exists(job.file_path):
+        return REST_FAIL({'msg': '文件尚未生成'})
+    return create_excel_resp(job.file_path, job.file_name)
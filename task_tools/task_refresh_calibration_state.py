@@ -1,96 +1,50 @@
-# 定时任务：每日刷新设备最校验到期日
+# 定时任务：每日把临近再校准日期的设备校验状态改为待送检, 到期日在读取时计算
 from django.db import transaction, close_old_connections
 
 from task_tools.task_utils import CronTaskObj
-from utils.timedelta_utls import calculate_due_date
-from equipments.ext_utils import execute_batch_sql
+from utils.timedelta_utls import DUE_REMIND_DAYS
 
+import datetime
 import traceback
 import logging
 
 logger = logging.getLogger('django')
 
 
-class RefreshCalibrationState:
+def refresh_calibration_state(today):
+    """再校准日期临近且未送检的记录改为待送检, 按再校准日期索引范围查询, 返回更新的行数"""
+    from equipments.models import EquipmentCalibrationInfo
+    threshold = today + datetime.timedelta(days=DUE_REMIND_DAYS)
+    return EquipmentCalibrationInfo.objects.filter(recalibration_time__lt=threshold).exclude(
+        state__in=['待送检', '已送检']).update(state='待送检')
 
-    def begin_calibration_task(self):
-        from equipments.models import EquipmentCalibrationInfo
-        qs = EquipmentCalibrationInfo.objects.all()
-        update_sql = 'update equipment_calibration_info set due_date=%s,state=%s where id=%s'
-        update_ls = []
-        count = 0
-        close_old_connections()
-        with transaction.atomic():
-            save_id = transaction.savepoint()
-            try:
-                for q in qs:
-                    count += 1
-                    _id = q.id
-                    state = q.state
-                    recalibration_time = q.recalibration_time
-                    if recalibration_time:
-                        old_due_date = q.due_date
-                        new_due_date = calculate_due_date(recalibration_time, 'calibration')
-                        if new_due_date == 'Please perform calibration ASAP':
-                            state = '待送检'
-                        if old_due_date != new_due_date:
-                            update_args = (new_due_date, state, _id)
-                            update_ls.append(update_args)
-
-                    if len(update_ls) >= 50:
-                        execute_batch_sql(update_sql, update_ls)
-                        update_ls = []
 
-                if len(update_ls) > 0:
-                    execute_batch_sql(update_sql, update_ls)
-                transaction.savepoint_commit(save_id)
-            except Exception as e:
-                transaction.savepoint_rollback(save_id)
-                logger.error('定期刷新校验到期日异常，error:{}'.format(traceback.format_exc()))
-                raise Exception(e)
-
-        logger.info('成功刷新{}条设备校验到期日'.format(count))
+class RefreshCalibrationState:
+    def __init__(self):
+        # 状态只在日期变化时改变, 记录最后刷新成功的日期, 当天已刷新则跳过
+        self.calibration_date = None
 
-    def begin_maintain_task(self):
-        from equipments.models import EquipmentMaintainInfo
-        qs = EquipmentMaintainInfo.objects.all()
-        update_sql = 'update equipment_maintain_info set due_date=%s where id=%s'
-        update_ls = []
-        count = 0
+    def begin_calibration_task(self):
+        today = datetime.date.today()
+        if self.calibration_date == today:
+            return
         close_old_connections()
         with transaction.atomic():
             save_id = transaction.savepoint()
             try:
-                for q in qs:
-                    count += 1
-                    _id = q.id
-                    recalibration_time = q.recalibration_time
-                    if recalibration_time:
-                        old_due_date = q.due_date
-                        new_due_date = calculate_due_date(recalibration_time, 'maintain')
-                        if old_due_date != new_due_date:
-                            update_args = (new_due_date, _id)
-                            update_ls.append(update_args)
-
-                    if len(update_ls) >= 50:
-                        execute_batch_sql(update_sql, update_ls)
-                        update_ls = []
-
-                if len(update_ls) > 0:
-                    execute_batch_sql(update_sql, update_ls)
+                count = refresh_calibration_state(today)
                 transaction.savepoint_commit(save_id)
             except Exception as e:
                 transaction.savepoint_rollback(save_id)
-                logger.error('定期刷新维护到期日异常，error:{}'.format(traceback.format_exc()))
+                logger.error('定期刷新校验状态异常，error:{}'.format(traceback.format_exc()))
                 raise Exception(e)
-
-        logger.info('成功刷新{}条设备维护到期日'.format(count))
+        self.calibration_date = today
+        logger.info('成功刷新{}条设备校验状态'.format(count))
 
 
 def init_refresh_task():
     refresh_obj = RefreshCalibrationState()
     task = CronTaskObj()
     task.interval_flag = False
-    task.add_job(refresh_obj.begin_calibration_task, id='定期刷新校验到期日', trigger='cron')
-    task.add_job(refresh_obj.begin_maintain_task, id='定期刷新维护到期日', trigger='cron')
+    task.add_job(refresh_obj.begin_calibration_task, id='定期刷新校验状态', trigger='cron')
     task.start()
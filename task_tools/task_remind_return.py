@@ -1,88 +1,95 @@
 # 提醒借用用户按时归还设备
-from django.db import connection, transaction, close_old_connections
+from django.db import transaction, close_old_connections
+from django.db.models import F
 from task_tools.task_utils import CronTaskObj
-from equipments.ext_utils import dictfetchall
-from utils.email_utils import send_mail
+from utils.email_utils import create_remind_mail, send_mails
 
+import datetime
 import traceback
 import logging
 
 logger = logging.getLogger('django')
 
+REMIND_SECONDS = 2 * 60 * 60  # 到期前多久提醒
+REMIND_BATCH_SIZE = 500  # 批量更新下次提醒时间的每批条数
+
+
+def get_remind_at(end_time, is_final_remind=False, is_overtime_remind=False):
+    """
+    已批准未归还的借用记录的下次提醒时间: 未提醒临期时为到期前REMIND_SECONDS, 未提醒超时时为到期时间, 都已提醒则不再提醒
+    """
+    if not end_time:
+        return None
+    if not is_final_remind:
+        return end_time - datetime.timedelta(seconds=REMIND_SECONDS)
+    if not is_overtime_remind:
+        return end_time
+    return None
+
 
 class RemindReturnTask:
     def __init__(self):
         self.final_remind_days = 1  # 到期前一天提醒
 
+    def get_cc_emails(self):
+        from users.models import User
+        emails = User.objects.filter(is_delete=False, need_cc=True).values_list('email', flat=True)
+        return list({email for email in emails if email})
+
     def begin_task(self):
-        remind_seconds = 2 * 60 * 60
-        # query_sql = '''select id, user_id, equipment_id, is_approval, is_return, end_time, is_final_remind,
-        #                     is_overtime_remind,round((julianday(strftime('%Y-%m-%d %H:%M:%S',end_time)) -
-        #                       julianday(strftime('%Y-%m-%d %H:%M:%S', datetime('now', 'localtime')))) * 86400, 2)
-        #                       as delta_seconds
-        #                    from equipment_borrow_record where delta_seconds < {}
-        #                               and is_approval=1 and is_return=0
-        #                               and is_overtime_remind=FALSE and is_delete=FALSE'''.format(remind_seconds)
-        query_sql = '''select id, user_id, equipment_id, is_approval, is_return, end_time, is_final_remind, is_overtime_remind,
-                           datediff(ss, getdate(), end_time) as delta_seconds
-                           from equipment_borrow_record where datediff(ss, getdate(), end_time) < {}
-                                      and is_approval=1 and is_return=0
-                                      and is_overtime_remind=0 and is_delete=0'''.format(remind_seconds)
+        from equipments.models import EquipmentBorrowRecord
+        now = datetime.datetime.now()
         close_old_connections()
-        with connection.cursor() as cursor:
-            cursor.execute(query_sql)
-            need_remind_qs = dictfetchall(cursor)
-        if need_remind_qs:
-            from users.models import User, Role
-            from equipments.models import EquipmentBorrowRecord
-            for q in need_remind_qs:
-                borrow_id = q['id']
-                user_id = q['user_id']
-
-                equipment_id = q['equipment_id']
-                end_time = q['end_time']
-                delta_seconds = q['delta_seconds']
-                is_final_remind = q['is_final_remind']
-                is_overtime_remind = q['is_overtime_remind']
-                with transaction.atomic():
-                    save_id = transaction.savepoint()
-                    try:
-                        # 未到期但是小于到期提醒时间,且未提醒过，发送邮件提醒
-                        if 0 < delta_seconds < remind_seconds and not is_final_remind:
-                            # TODO 发邮件给使用者
-                            user = User.objects.get(id=user_id)
-                            borrow_qs = EquipmentBorrowRecord.objects.filter(id=borrow_id)
-                            info = '即将到期'
-                            to = [user.email]
-                            send_mail(to, [], info, borrow_qs.first())
-                            borrow_qs.update(is_final_remind=True)
-                        elif delta_seconds < 0 and not is_overtime_remind:  # 超时
-                            # TODO 发邮件给使用者,抄送section manager、下一位借用者、实验室管理员，提示设备仪表超时未还
-                            user = User.objects.get(id=user_id)
-                            to = [user.email]
+        # 按下次提醒时间索引查出到期的提醒, 一并带出借用人、设备、项目
+        borrow_qs = EquipmentBorrowRecord.objects.filter(
+            remind_at__lte=now, is_approval=1, is_return=0, is_delete=False).select_related('user', 'equipment',
+                                                                                          'project')
+        messages = []
+        remind_fields = []
+        reschedule_ls = []
+        cc = None
+        for borrow in borrow_qs:
+            # 未到期但是小于到期提醒时间,且未提醒过，发送邮件提醒
+            if borrow.end_time > now and not borrow.is_final_remind:
+                messages.append(create_remind_mail([borrow.user.email], [], '即将到期', borrow))
+                remind_fields.append(('is_final_remind', borrow.id))
+            elif borrow.end_time <= now and not borrow.is_overtime_remind:  # 超时
+                # 发邮件给使用者, 抄送需要抄送的用户, 抄送列表每次执行只查询一次
+                if cc is None:
+                    cc = self.get_cc_emails()
+                messages.append(create_remind_mail([borrow.user.email], cc, '已经逾期', borrow))
+                remind_fields.append(('is_overtime_remind', borrow.id))
+            else:
+                reschedule_ls.append(borrow)
 
-                            # 查询下一位用户
-                            next_user_qs = EquipmentBorrowRecord.objects.filter(start_time__gte=end_time,
-                                                                                equipment_id=equipment_id,
-                                                                                is_delete=False,
-                                                                                is_approval=0).order_by('id')
-                            if next_user_qs:
-                                next_user = next_user_qs.first().user
-                            borrow_qs = EquipmentBorrowRecord.objects.filter(id=borrow_id)
-                            info = '已经逾期'
-                            # 查询需要抄送的用户
-                            need_cc_users = User.objects.filter(is_delete=False, need_cc=True).values()
-                            need_cc_email = [item['email'] for item in list(need_cc_users)]
-                            cc = list(set(need_cc_email))
-                            send_mail(to, cc, info, borrow_qs.first())
-                            borrow_qs.update(is_overtime_remind=True)
-                        transaction.savepoint_commit(save_id)
-                    except Exception as e:
-                        transaction.savepoint_rollback(save_id)
-                        logger.error('提醒临期借用者归还设备异常，error: {}'.format(traceback.format_exc()))
-                        raise Exception(e)
+        # 复用一个连接发送, 发送成功的记录才标记为已提醒并设置下次提醒时间, 失败的下次执行时重试
+        results = send_mails(messages)
+        remind_ids = {'is_final_remind': [], 'is_overtime_remind': []}
+        for (field, borrow_id), sent in zip(remind_fields, results):
+            if sent:
+                remind_ids[field].append(borrow_id)
+        with transaction.atomic():
+            save_id = transaction.savepoint()
+            try:
+                if remind_ids['is_final_remind']:
+                    EquipmentBorrowRecord.objects.filter(id__in=remind_ids['is_final_remind']).update(
+                        is_final_remind=True, remind_at=F('end_time'))
+                if remind_ids['is_overtime_remind']:
+                    EquipmentBorrowRecord.objects.filter(id__in=remind_ids['is_overtime_remind']).update(
+                        is_overtime_remind=True, remind_at=None)
+                # 其余记录按当前提醒状态重新计算下次提醒时间, 批量更新
+                for borrow in reschedule_ls:
+                    borrow.remind_at = get_remind_at(borrow.end_time, borrow.is_final_remind,
+                                                     borrow.is_overtime_remind)
+                EquipmentBorrowRecord.objects.bulk_update(reschedule_ls, ['remind_at'], batch_size=REMIND_BATCH_SIZE)
+                transaction.savepoint_commit(save_id)
+            except Exception as e:
+                transaction.savepoint_rollback(save_id)
+                logger.error('提醒临期借用者归还设备异常，error: {}'.format(traceback.format_exc()))
+                raise Exception(e)
 
-        logger.info('任务: [提醒临期借用者归还设备] 执行完成')
+        logger.info('任务: [提醒临期借用者归还设备] 执行完成, 发送{}封, 失败{}封'.format(
+            results.count(True), results.count(False)))
 
 
 def init_remind_return():
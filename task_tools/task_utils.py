@@ -38,10 +38,9 @@ class CronTaskObj:
         # else:
         #     self.scheduler.add_job(func, trigger=trigger, id=id, args=args, kwargs=kwargs,
         #                            hour=self.cron_hour, **trigger_args)
-        if id == '定期刷新校验到期日':
-            minutes = 0.3
-        elif id == '定期刷新维护到期日':
-            minutes = 0.5
+        if id == '定期刷新校验状态':
+            # 校验状态每天只实际刷新一次, 按默认轮询周期检查日期是否变化
+            minutes = self.interval_minutes
         else:
             minutes = 0.7
 
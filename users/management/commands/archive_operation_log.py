@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users.models import OperationLog
+from utils.log_writer import LOG_TIME_FORMAT
+
+import datetime
+import gzip
+import json
+import os
+
+ARCHIVE_BATCH_SIZE = 2000
+ARCHIVE_FIELDS = ('id', 'table_name', 'operate', 'user_id', 'reason', 'before', 'after', 'change', 'create_time')
+
+
+def get_archive_path(archive_dir, month):
+    return os.path.join(archive_dir, 'operation_log_{}.jsonl.gz'.format(month))
+
+
+def archive_batch(archive_dir, rows):
+    """按月份追加写入压缩文件, 写入并落盘后才删除库中记录; 中途失败重跑时该批记录可能在归档文件中重复, 按id去重即可"""
+    months = {}
+    for row in rows:
+        row['create_time'] = row['create_time'].strftime(LOG_TIME_FORMAT)
+        months.setdefault(row['create_time'][:7], []).append(row)
+    for month, month_rows in months.items():
+        # 追加模式会新增一个gzip成员, gzip读取时会连续解压
+        with gzip.open(get_archive_path(archive_dir, month), 'at', encoding='utf-8') as f:
+            for row in month_rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    with transaction.atomic():
+        OperationLog.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return {month: len(month_rows) for month, month_rows in months.items()}
+
+
+def archive_operation_log(before, archive_dir, batch_size=ARCHIVE_BATCH_SIZE):
+    """把before之前的操作日志归档到archive_dir, 返回各月份归档条数"""
+    os.makedirs(archive_dir, exist_ok=True)
+    queryset = OperationLog.objects.filter(create_time__lt=before).order_by('create_time', 'id').values(
+        *ARCHIVE_FIELDS)
+    counts = {}
+    while True:
+        rows = list(queryset[:batch_size])
+        if not rows:
+            break
+        for month, count in archive_batch(archive_dir, rows).items():
+            counts[month] = counts.get(month, 0) + count
+    return counts
+
+
+class Command(BaseCommand):
+    help = '把超过保留天数的操作日志按月归档为gzip压缩的json lines文件, 并从库中删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.OPERATION_LOG_KEEP_DAYS, help='库中保留的天数')
+        parser.add_argument('--dir', default=settings.OPERATION_LOG_ARCHIVE_DIR, help='归档目录')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='每批归档条数')
+
+    def handle(self, *args, **options):
+        before = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=options['days']),
+                                           datetime.time.min)
+        counts = archive_operation_log(before, options['dir'], options['batch_size'])
+        for month in sorted(counts):
+            self.stdout.write('{}: 归档{}条'.format(month, counts[month]))
+        self.stdout.write('归档完成, 共{}条{}之前的操作日志'.format(sum(counts.values()), before.strftime('%Y-%m-%d')))
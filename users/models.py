@@ -3,6 +3,8 @@ from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseU
     AbstractUser, Group
 from django.db.models import QuerySet
 
+import datetime
+
 
 class QuerySetManage(models.Manager):
     def get_queryset(self):
@@ -119,12 +121,18 @@ class OperationLog(models.Model):
     before = models.TextField(verbose_name='操作前', null=True)
     after = models.TextField(verbose_name='操作后', null=True)
     change = models.TextField(verbose_name='变化', null=True)
-    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    create_time = models.DateTimeField(verbose_name='创建时间', default=datetime.datetime.now)  # 异步写入时保留操作时间
 
     class Meta:
         db_table = 'operation_log'
         verbose_name = '操作日志表'
         verbose_name_plural = verbose_name
+        # 列表按时间倒序分页, 常用按表名或操作人筛选
+        indexes = [
+            models.Index(fields=['create_time', 'id']),
+            models.Index(fields=['table_name', 'create_time']),
+            models.Index(fields=['user', 'create_time']),
+        ]
 
 
 class Role(models.Model):
@@ -0,0 +1,63 @@
+from django.core.cache import caches
+
+import ast
+import json
+import logging
+
+logger = logging.getLogger('django')
+
+USER_ROLES_KEY = 'user_roles:{}'
+
+
+def get_permission_cache():
+    return caches['permission']
+
+
+def parse_routes(routes):
+    """角色权限按JSON解析, 兼容以前保存的Python列表写法, 不使用eval"""
+    if not routes:
+        return []
+    try:
+        permissions = json.loads(routes)
+    except ValueError:
+        try:
+            permissions = ast.literal_eval(routes)
+        except (ValueError, SyntaxError):
+            logger.error('角色权限格式错误: {}'.format(routes))
+            return []
+    if not isinstance(permissions, (list, tuple)):
+        return []
+    return list(permissions)
+
+
+def get_user_roles(user):
+    """
+    查询用户的角色编码和权限并集, 结果按用户缓存
+    返回: {'roles': [角色编码], 'permissions': [权限]}
+    """
+    from users.models import Role
+    cache = get_permission_cache()
+    key = USER_ROLES_KEY.format(user.id)
+    user_roles = cache.get(key)
+    if user_roles is None:
+        roles = []
+        permissions = set()
+        for role_code, routes in Role.objects.filter(users=user.id).values_list('role_code', 'routes'):
+            roles.append(role_code)
+            permissions.update(parse_routes(routes))
+        user_roles = {'roles': roles, 'permissions': list(permissions)}
+        cache.set(key, user_roles)
+    return user_roles
+
+
+def get_role_codes(user):
+    return get_user_roles(user)['roles']
+
+
+def clear_user_roles(user_ids=None):
+    """清除用户的角色缓存, 不传user_ids时清除全部"""
+    cache = get_permission_cache()
+    if user_ids is None:
+        cache.clear()
+    else:
+        cache.delete_many([USER_ROLES_KEY.format(user_id) for user_id in user_ids])
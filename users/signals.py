@@ -0,0 +1,31 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from users.models import User, Role
+from users.role_utils import clear_user_roles
+
+
+@receiver([post_save, post_delete], sender=Role)
+def clear_role_cache(sender, instance, **kwargs):
+    # 角色权限变化影响该角色下的所有用户, 角色修改很少, 直接清除全部缓存
+    clear_user_roles()
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_user_cache(sender, instance, update_fields=None, **kwargs):
+    # 登录时只更新last_login, 不影响角色
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    clear_user_roles([instance.id])
+
+
+@receiver(m2m_changed, sender=Role.users.through)
+def clear_member_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        # reverse为True时instance是用户(user.role_set), 否则instance是角色(role.users)
+        clear_user_roles([instance.id] if reverse else pk_set)
+    elif action == 'post_clear':
+        if reverse:
+            clear_user_roles([instance.id])
+        else:
+            clear_user_roles()
@@ -1,3 +1,224 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+from unittest import mock
 
-# Create your tests here.
+from users.models import User, Role, OperationLog
+from users.role_utils import get_user_roles, parse_routes
+from users.management.commands.archive_operation_log import archive_operation_log, get_archive_path
+from users.views import UserDetailGeneric, OperationLogGeneric
+from utils import log_writer
+from utils.jwt_handle import jwt_response_payload_handler
+from utils.log_utils import save_operateLog, get_field_values, get_differ
+
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import time
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'permission': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'permission-test'},
+})
+class RoleCacheTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='u1')
+        self.manager = Role.objects.create(role_code='labManager', name='实验室管理员', routes='["a", "b"]')
+        self.viewer = Role.objects.create(role_code='viewer', name='访客', routes="['b', 'c']")
+        self.manager.users.add(self.user)
+
+    def test_parse_routes(self):
+        self.assertEqual(parse_routes('["a"]'), ['a'])
+        self.assertEqual(parse_routes("['a']"), ['a'])
+        self.assertEqual(parse_routes('__import__("os")'), [])
+        self.assertEqual(parse_routes(None), [])
+
+    def test_cached_roles(self):
+        with self.assertNumQueries(1):
+            payload = jwt_response_payload_handler('token', self.user)
+        self.assertEqual(payload['roles'], ['labManager'])
+        self.assertEqual(sorted(payload['permissions']), ['a', 'b'])
+        with self.assertNumQueries(0):
+            jwt_response_payload_handler('token', self.user)
+
+    def test_invalidate(self):
+        get_user_roles(self.user)
+        self.user.role_set.add(self.viewer)
+        self.assertEqual(sorted(get_user_roles(self.user)['permissions']), ['a', 'b', 'c'])
+        self.viewer.routes = '["d"]'
+        self.viewer.save()
+        self.assertEqual(sorted(get_user_roles(self.user)['permissions']), ['a', 'b', 'd'])
+        self.manager.users.remove(self.user)
+        self.assertEqual(get_user_roles(self.user)['roles'], ['viewer'])
+        self.viewer.delete()
+        self.assertEqual(get_user_roles(self.user), {'roles': [], 'permissions': []})
+
+
+@mock.patch.object(log_writer.OperationLogWriter, 'run', lambda self: None)
+class OperationLogWriterTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='u1')
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        settings_patcher = override_settings(OPERATION_LOG_SPOOL_DIR=self.spool_dir, OPERATION_LOG_ASYNC=True)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+
+    def record(self, reason):
+        return {'user_id': self.user.id, 'table_name': 'equipment', 'operate': 'add', 'reason': reason,
+                'before': None, 'after': str({'id': 'E1'}), 'change': None,
+                'create_time': '2022-01-01 08:00:00.000000'}
+
+    def test_flush(self):
+        writer = log_writer.OperationLogWriter()
+        for i in range(3):
+            writer.put(self.record(str(i)))
+        self.assertEqual(OperationLog.objects.count(), 0)
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(sorted(OperationLog.objects.values_list('reason', flat=True)), ['0', '1', '2'])
+        self.assertEqual(OperationLog.objects.first().create_time, datetime.datetime(2022, 1, 1, 8))
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_recover_orphan(self):
+        path = os.path.join(self.spool_dir, '1-dead.spool')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.record('a')) + '\n' + json.dumps(self.record('b')) + '\n{"user_id"')
+        writer = log_writer.OperationLogWriter()
+        writer.put(self.record('c'))
+        self.assertEqual(writer.recover(), 0)  # 刚修改过的文件可能属于运行中的进程
+        old = time.time() - log_writer.LOG_ORPHAN_SECONDS - 1
+        os.utime(path, (old, old))
+        self.assertEqual(writer.recover(), 2)
+        self.assertEqual(sorted(OperationLog.objects.values_list('reason', flat=True)), ['a', 'b'])
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)  # 本进程的落盘文件不会被补写
+
+    def test_failed_file_quarantined(self):
+        real_write = log_writer.write_records
+
+        def write_records(records):
+            if any(record['reason'] == 'bad' for record in records):
+                raise ValueError('bad record')
+            real_write(records)
+        writer = log_writer.OperationLogWriter()
+        with mock.patch.object(log_writer, 'write_records', side_effect=write_records):
+            writer.put(self.record('bad'))
+            writer.process()
+            self.assertEqual(list(writer.pending.values()), [1])
+            # 重试失败的文件不影响新记录写入
+            writer.put(self.record('good'))
+            writer.process()
+            self.assertEqual(list(OperationLog.objects.values_list('reason', flat=True)), ['good'])
+            for i in range(log_writer.LOG_MAX_ATTEMPTS):
+                writer.process()
+        self.assertEqual(writer.pending, {})
+        self.assertEqual([name.rsplit('.', 1)[1] for name in os.listdir(self.spool_dir)], ['failed'])
+        self.assertEqual(OperationLog.objects.count(), 1)
+
+    def test_write_records_atomic(self):
+        real_bulk_create = OperationLog.objects.bulk_create
+        calls = []
+
+        def bulk_create(objs):
+            calls.append(len(objs))
+            if len(calls) > 1:
+                raise ValueError('bad chunk')
+            return real_bulk_create(objs)
+        records = [self.record(str(i)) for i in range(log_writer.LOG_BATCH_SIZE + 1)]
+        with mock.patch.object(OperationLog.objects, 'bulk_create', side_effect=bulk_create):
+            with self.assertRaises(ValueError):
+                log_writer.write_records(records)
+        self.assertEqual(calls, [log_writer.LOG_BATCH_SIZE, 1])
+        # 第一批已插入的记录随事务回滚, 重试时不会重复
+        self.assertEqual(OperationLog.objects.count(), 0)
+
+    def test_save_log(self):
+        with override_settings(OPERATION_LOG_ASYNC=False):
+            save_operateLog('update', self.user, 'equipment', '设备表', {'name': 'a'}, {'name': 'b'},
+                            [{'column': 'name', 'before': 'a', 'after': 'b'}])
+        log = OperationLog.objects.get()
+        self.assertEqual((log.reason, log.before, log.after), ('修改设备', "{'name': 'a'}", "{'name': 'b'}"))
+
+
+@override_settings(OPERATION_LOG_ASYNC=False)
+class UpdateLogTest(TestCase):
+
+    def test_update_log(self):
+        user = User.objects.create(username='u1', telephone='1', password='p')
+        role = Role.objects.create(role_code='viewer', name='访客')
+        request = APIRequestFactory().patch('/', {'telephone': '2', 'role_set': [role.id], 'password': 'p'},
+                                            format='json')
+        force_authenticate(request, user)
+        with CaptureQueriesContext(connection) as queries:
+            response = UserDetailGeneric.as_view()(request, pk=user.id)
+        self.assertEqual(response.status_code, 200)
+        user_reads = [q['sql'] for q in queries.captured_queries
+                      if q['sql'].startswith('SELECT') and 'FROM "user" WHERE' in q['sql']]
+        self.assertEqual(len(user_reads), 1)
+        log = OperationLog.objects.get()
+        change = {item['column']: (item['before'], item['after']) for item in eval(log.change)}
+        self.assertEqual(change, {'telephone': ('1', '2'), 'role_set': ([], [role.id])})
+
+    def test_auto_fields_ignored(self):
+        role = Role.objects.create(role_code='viewer', name='访客')
+        before = get_field_values(role)
+        role.save()
+        self.assertNotIn('update_time', before)
+        self.assertEqual(get_differ(before, get_field_values(role)), [])
+        user = User.objects.create(username='u1')
+        self.assertNotIn('last_login', get_field_values(user))
+
+
+class OperationLogListTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='admin')
+        other = User.objects.create(username='other')
+        # 同一时间写入多条, 游标需按id区分
+        for i in range(7):
+            OperationLog.objects.create(user=self.user if i % 2 else other, table_name='equipment', operate='add',
+                                        create_time=datetime.datetime(2022, 1, 1 + i // 3))
+
+    def get(self, params):
+        request = APIRequestFactory().get('/operation-log', params)
+        force_authenticate(request, self.user)
+        return OperationLogGeneric.as_view()(request).data
+
+    def test_cursor_pages(self):
+        ids = []
+        data = self.get({'cursor': '', 'size': 3})
+        while True:
+            ids.extend(item['id'] for item in data['results'])
+            if not data['next_cursor']:
+                break
+            data = self.get({'cursor': data['next_cursor'], 'size': 3})
+        expected = OperationLog.objects.order_by('-create_time', '-id').values_list('id', flat=True)
+        self.assertEqual(ids, list(expected))
+        self.assertEqual(self.get({'cursor': '', 'user_name': 'adm'})['results'][0]['user_name'], 'admin')
+        self.assertEqual(self.get({'page': 1, 'user_name': 'adm'})['count'], 3)
+
+    def test_filters(self):
+        OperationLog.objects.create(user=self.user, table_name='equipment_borrow_record', operate='add')
+        # 表名精确匹配
+        self.assertEqual(self.get({'page': 1, 'table_name': 'equipment'})['count'], 7)
+        self.assertEqual(self.get({'page': 1, 'table_name': 'equip'})['count'], 0)
+        data = self.get({'page': 1, 'table_name': 'equipment_borrow_record', 'user_name': 'adm'})
+        self.assertEqual([item['table_name'] for item in data['results']], ['equipment_borrow_record'])
+        self.assertEqual(self.get({'page': 1, 'user_name': 'nobody'})['count'], 0)
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            counts = archive_operation_log(datetime.datetime(2022, 1, 3), archive_dir, batch_size=4)
+            self.assertEqual(counts, {'2022-01': 6})
+            with gzip.open(get_archive_path(archive_dir, '2022-01'), 'rt', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]['create_time'], '2022-01-01 00:00:00.000000')
+        self.assertEqual(OperationLog.objects.count(), 1)
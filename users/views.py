@@ -19,6 +19,7 @@ from equipments.ext_utils import REST_SUCCESS, REST_FAIL
 from users.serializers import RegisterSerializer, SectionSerializer, UserSerializer, OperationLogSerializer, \
    RoleSerializer, OperateRoleSerializer
 from users.models import Section, User, OperationLog, Role
+from users.role_utils import get_role_codes
 from utils.log_utils import set_update_log, set_delete_log, set_create_log
 from utils.pagination import MyPagePagination
 from lab_system_backend import settings
@@ -45,8 +46,7 @@ class RoleListGeneric(generics.ListCreateAPIView):
         queryset = self.filter_queryset(self.get_queryset())
         distribute = request.GET.get('distribute')
         req_user = request.user
-        user_roles = req_user.role_set.values('id', 'role_code')
-        user_roles = [item['role_code'] for item in list(user_roles)]
+        user_roles = get_role_codes(req_user)
         if not distribute:
             if 'developer' not in user_roles:
                 managerRoles = list(set(['gcManager', 'labManager', 'fbaManager', 'pwmManager']) & set(user_roles))
@@ -285,8 +285,7 @@ class UserListGeneric(generics.ListAPIView):
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         req_user = request.user
-        user_roles = req_user.role_set.values('id', 'role_code')
-        user_roles = [item['role_code'] for item in list(user_roles)]
+        user_roles = get_role_codes(req_user)
         if 'developer' in user_roles:
             pass
         elif list(set(['gcManager', 'labManager', 'fbaManager', 'pwmManager']) & set(user_roles)):
@@ -336,6 +335,7 @@ class UserDetailGeneric(generics.RetrieveUpdateDestroyAPIView):
     verbose_name = model._meta.verbose_name
     queryset = model.objects.filter(is_delete=False).all()
     serializer_class = UserSerializer
+    log_related_fields = ('role_set',)  # 操作日志中记录角色变化
 
     @set_update_log
     def update(self, request, *args, **kwargs):
@@ -381,7 +381,7 @@ class ChangePassword(APIView):
 
 
 class OperationLogGeneric(generics.ListAPIView):
-    queryset = OperationLog.objects.all().order_by('-create_time')
+    queryset = OperationLog.objects.select_related('user').order_by('-create_time', '-id')
     serializer_class = OperationLogSerializer
     pagination_class = MyPagePagination
 
@@ -391,18 +391,15 @@ class OperationLogGeneric(generics.ListAPIView):
         if operate:
             queryset = queryset.filter(operate=operate)  # 精确查询
 
-        fuzzy_params = {}
-        fuzzy_params['user_name'] = request.GET.get('user_name', '')
-        fuzzy_params['table_name'] = request.GET.get('table_name', '')
-
-        filter_params = {}
-        for k, v in fuzzy_params.items():
-            if v != None and v != '':
-                k = k + '__contains'
-                filter_params[k] = v
-
-        if filter_params:
-            queryset = queryset.filter(**filter_params)
+        # 前端传入的是数据库表名, 精确查询以使用(table_name, create_time)索引
+        table_name = request.GET.get('table_name')
+        if table_name:
+            queryset = queryset.filter(table_name=table_name)
+        # 用户名仍模糊查询, 先在用户表中查出id, 日志表按(user, create_time)索引过滤
+        user_name = request.GET.get('user_name')
+        if user_name:
+            user_ids = list(User.objects.filter(username__contains=user_name).values_list('id', flat=True))
+            queryset = queryset.filter(user_id__in=user_ids)
 
         start_time = request.GET.get('start_time')
         end_time = request.GET.get('end_time')
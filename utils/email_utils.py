@@ -3,13 +3,14 @@ from django.core.mail import EmailMultiAlternatives
 from lab_system_backend.settings import EMAIL_FROM
 
 import os
+import traceback
 import logging
 
 logger = logging.getLogger('django')
 
 
-def send_mail(to, cc, info, borrow):
-    # with mail.get_connection(fail_silently=False) as conn:
+def create_remind_mail(to, cc, info, borrow):
+    """生成设备到期提醒邮件, borrow需带出user、equipment、project"""
     msg = EmailMultiAlternatives(
         subject='设备使用到期提醒',
         body='testBody',
@@ -57,4 +58,40 @@ def send_mail(to, cc, info, borrow):
                           borrow.equipment_name, borrow.project_name, borrow.start_time.strftime('%Y-%m-%d %H:%M:%S'),
                           borrow.end_time.strftime('%Y-%m-%d %H:%M:%S'))
     msg.attach_alternative(content=h, mimetype="text/html")
-    msg.send()
+    return msg
+
+
+def close_connection(conn):
+    try:
+        conn.close()
+    except Exception:
+        logger.error('关闭邮件连接失败, error: {}'.format(traceback.format_exc()))
+
+
+def send_mails(messages):
+    """
+    复用同一个SMTP连接逐封发送, 单封失败只记录日志不影响其他邮件
+    返回每封邮件是否发送成功
+    """
+    results = []
+    if not messages:
+        return results
+    conn = mail.get_connection(fail_silently=False)
+    opened = False
+    try:
+        for msg in messages:
+            try:
+                # 先打开连接, send_messages不会在每封邮件后关闭调用方打开的连接
+                if not opened:
+                    conn.open()
+                    opened = True
+                results.append(conn.send_messages([msg]) == 1)
+            except Exception:
+                logger.error('邮件发送失败, to: {}, error: {}'.format(msg.to, traceback.format_exc()))
+                results.append(False)
+                # 连接可能已断开, 关闭后下一封邮件重新建立连接
+                close_connection(conn)
+                opened = False
+    finally:
+        close_connection(conn)
+    return results
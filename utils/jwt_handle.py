@@ -1,18 +1,8 @@
-from users.models import User, Role
+from users.role_utils import get_user_roles
 
 
 def jwt_response_payload_handler(token, user=None, request=None):
-    roles = []
-    permissions = []
-    if user.role_set.values('id', 'role_code'):
-        user_roles = user.role_set.values('id', 'role_code')
-        roles = [u['role_code'] for u in list(user_roles)]
-        permissions = []
-        for role in user_roles:
-            routes = Role.objects.get(id=role['id']).routes
-            if routes:
-                permissions.extend(eval(routes))
-        permissions = list(set(permissions))
+    user_roles = get_user_roles(user)
     return {
         'userInfo': {
             'user_id': user.id,
@@ -23,8 +13,8 @@ def jwt_response_payload_handler(token, user=None, request=None):
             'pwd_status': user.pwd_status,
         },
         'token': 'JWT ' + token,
-        'roles': roles,
-        'permissions': permissions
+        'roles': user_roles['roles'],
+        'permissions': user_roles['permissions']
     }
 
 
@@ -1,7 +1,10 @@
-from users.models import OperationLog
+from utils.log_writer import enqueue_operation_log, LOG_TIME_FORMAT
 
+import datetime
 import re
 
+LOG_IGNORE_FIELDS = ('last_login',)  # 登录时更新的字段不计入修改
+
 
 def get_differ(before, after):
     differ = before.keys() & after
@@ -9,9 +12,15 @@ def get_differ(before, after):
     return differ_vals
 
 
+def format_log_value(value):
+    # 与原先直接保存到TextField时的格式一致
+    return str(value) if value is not None else None
+
+
 def save_operateLog(operate, user, table_name, verbose_name, before=None, after=None, change=None):
+    """在请求中整理好日志内容后放入异步写入队列"""
     log_dic = {}
-    log_dic['user'] = user
+    log_dic['user_id'] = user.id
     log_dic['table_name'] = table_name
     log_dic['operate'] = operate
     if re.findall(r'表', verbose_name):
@@ -27,10 +36,11 @@ def save_operateLog(operate, user, table_name, verbose_name, before=None, after=
     else:
         return '操作类型不正确'
     log_dic['reason'] = reason
-    log_dic['before'] = before
-    log_dic['after'] = after
-    log_dic['change'] = change
-    OperationLog.objects.create(**log_dic)
+    log_dic['before'] = format_log_value(before)
+    log_dic['after'] = format_log_value(after)
+    log_dic['change'] = format_log_value(change)
+    log_dic['create_time'] = datetime.datetime.now().strftime(LOG_TIME_FORMAT)
+    enqueue_operation_log(log_dic)
     return 'success'
 
 
@@ -43,13 +53,38 @@ def set_create_log(func):
     return wrapper
 
 
+def get_field_values(instance, related_fields=()):
+    """
+    取出模型实例各字段的值用于比较, 外键取id, 非基本类型转为字符串
+    自动更新的时间字段每次保存都会变化, 不参与比较
+    related_fields为需要一并记录的多对多字段, 记录关联的id列表
+    """
+    values = {}
+    for field in instance._meta.concrete_fields:
+        if field.name in LOG_IGNORE_FIELDS or getattr(field, 'auto_now', False) or \
+                getattr(field, 'auto_now_add', False):
+            continue
+        value = getattr(instance, field.attname)
+        if value is not None and not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        values[field.name] = value
+    for name in related_fields:
+        values[name] = sorted(getattr(instance, name).values_list('id', flat=True))
+    return values
+
+
 def set_update_log(func):
     def wrapper(self, request, *args, **kwargs):
-        before_instance = self.get_object()
-        before = self.get_serializer(before_instance).data
-        res = func(self, request, *args, **kwargs)
-        after_instance = self.get_object()
-        after = self.get_serializer(after_instance).data
+        # 只查询一次: 处理函数中的get_object直接返回该实例, 更新后按字段比较前后的值
+        instance = self.get_object()
+        related_fields = getattr(self, 'log_related_fields', ())
+        before = get_field_values(instance, related_fields)
+        self.get_object = lambda: instance
+        try:
+            res = func(self, request, *args, **kwargs)
+        finally:
+            del self.get_object
+        after = get_field_values(instance, related_fields)
         change = get_differ(before, after)
 
         if change:
@@ -0,0 +1,218 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+import logging
+
+logger = logging.getLogger('django')
+
+LOG_FLUSH_SECONDS = 2  # 后台线程写库间隔
+LOG_BATCH_SIZE = 500  # 每次bulk_create的条数
+LOG_ORPHAN_SECONDS = 10 * 60  # 其他进程的落盘文件超过该时长未修改, 视为进程已退出, 由当前进程补写
+LOG_MAX_ATTEMPTS = 3  # 落盘文件连续写库失败的次数达到该值后改名为.failed隔离, 需人工处理
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class OperationLogWriter(object):
+    """
+    操作日志异步写入: 请求中先追加到本进程的落盘文件并放入队列, 由后台线程批量写库
+    写库成功后才删除对应的落盘文件, 进程重启后未写入的记录由后续进程补写
+    写库失败的文件在后续周期重试, 多次失败后隔离, 不影响新记录写入
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pending = {}
+
+    def reset(self):
+        # uwsgi在加载应用后fork出工作进程, 线程和队列需在各自进程中重新创建
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.pending = {}  # 写库失败待重试的文件及已失败次数
+        self.prefix = '{}-{}'.format(self.pid, uuid.uuid4().hex)
+        self.spool_path = os.path.join(self.get_spool_dir(), '{}.spool'.format(self.prefix))
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='operation-log-writer', daemon=True)
+        self.thread.start()
+
+    def get_spool_dir(self):
+        spool_dir = settings.OPERATION_LOG_SPOOL_DIR
+        os.makedirs(spool_dir, exist_ok=True)
+        return spool_dir
+
+    def get_path(self, suffix):
+        return os.path.join(self.get_spool_dir(), '{}-{}.{}'.format(self.prefix, uuid.uuid4().hex, suffix))
+
+    def put(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+            self.queue.put(record)
+        if self.queue.qsize() >= LOG_BATCH_SIZE:
+            self.wakeup.set()
+
+    def rotate(self):
+        """取出队列中的记录, 同时把落盘文件改名为处理中, 之后的记录写入新文件"""
+        with self.lock:
+            records = []
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not records:
+                return None, records
+            processing_path = self.get_path('processing')
+            os.replace(self.spool_path, processing_path)
+            return processing_path, records
+
+    def flush(self):
+        """把队列中的记录写库, 返回写入条数"""
+        if self.pid != os.getpid():
+            return 0
+        processing_path, records = self.rotate()
+        if not records:
+            return 0
+        write_records(records)
+        os.remove(processing_path)
+        return len(records)
+
+    def recover(self):
+        """补写已退出进程遗留的落盘文件, 先改名认领, 避免多个进程重复写入"""
+        spool_dir = self.get_spool_dir()
+        count = 0
+        for name in os.listdir(spool_dir):
+            path = os.path.join(spool_dir, name)
+            if name.startswith(self.prefix) or not name.endswith(('.spool', '.processing', '.recover')):
+                continue
+            try:
+                if time.time() - os.stat(path).st_mtime < LOG_ORPHAN_SECONDS:
+                    continue
+                recover_path = self.get_path('recover')
+                os.replace(path, recover_path)
+                os.utime(recover_path)
+            except FileNotFoundError:
+                continue
+            try:
+                count += recover_file(recover_path)
+            except Exception:
+                logger.error('补写操作日志失败, 稍后重试, error: {}'.format(traceback.format_exc()))
+                self.pending[recover_path] = 1
+        return count
+
+    def quarantine(self, path):
+        failed_path = os.path.splitext(path)[0] + '.failed'
+        os.replace(path, failed_path)
+        logger.error('操作日志文件连续{}次写库失败, 已改名为{}'.format(LOG_MAX_ATTEMPTS, failed_path))
+
+    def retry_pending(self):
+        """重试写库失败的文件, 每个文件单独处理, 达到失败次数上限后隔离"""
+        for path in list(self.pending):
+            try:
+                if not os.path.exists(path):
+                    self.pending.pop(path)
+                    continue
+                # 重试前更新修改时间, 避免被其他进程当作遗留文件认领
+                os.utime(path)
+                recover_file(path)
+                self.pending.pop(path)
+            except Exception:
+                logger.error('操作日志重试写入失败, error: {}'.format(traceback.format_exc()))
+                self.pending[path] += 1
+                if self.pending[path] >= LOG_MAX_ATTEMPTS:
+                    self.pending.pop(path)
+                    try:
+                        self.quarantine(path)
+                    except OSError:
+                        logger.error('操作日志文件隔离失败, error: {}'.format(traceback.format_exc()))
+
+    def process(self):
+        """后台线程的一个周期: 重试失败文件, 写入队列中的新记录"""
+        close_old_connections()
+        self.retry_pending()
+        # 重试失败不影响新记录写库, 队列和落盘文件每个周期都会取出
+        processing_path = None
+        try:
+            processing_path, records = self.rotate()
+            if records:
+                write_records(records)
+                os.remove(processing_path)
+        except Exception:
+            logger.error('操作日志写入失败, 稍后重试, error: {}'.format(traceback.format_exc()))
+            if processing_path and os.path.exists(processing_path):
+                self.pending[processing_path] = 1
+
+    def run(self):
+        recover_at = 0
+        while True:
+            self.wakeup.wait(LOG_FLUSH_SECONDS)
+            self.wakeup.clear()
+            try:
+                self.process()
+                if time.time() - recover_at > LOG_ORPHAN_SECONDS:
+                    recover_at = time.time()
+                    self.recover()
+            except Exception:
+                logger.error('操作日志写入失败, 稍后重试, error: {}'.format(traceback.format_exc()))
+
+
+def write_records(records):
+    from users.models import OperationLog
+    objs = [OperationLog(user_id=record['user_id'], table_name=record['table_name'], operate=record['operate'],
+                         reason=record['reason'], before=record['before'], after=record['after'],
+                         change=record['change'],
+                         create_time=datetime.datetime.strptime(record['create_time'], LOG_TIME_FORMAT))
+            for record in records]
+    # 整个文件在一个事务中写入, 中途失败重试时不会重复插入已写入的部分
+    with transaction.atomic():
+        for i in range(0, len(objs), LOG_BATCH_SIZE):
+            OperationLog.objects.bulk_create(objs[i:i + LOG_BATCH_SIZE])
+
+
+def recover_file(path):
+    records = []
+    try:
+        with open(path, encoding='utf-8') as f:
+            # 进程退出时可能只写了半行, 跳过无法解析的行
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.error('操作日志落盘记录无法解析: {}'.format(line))
+    except FileNotFoundError:
+        return 0
+    write_records(records)
+    os.remove(path)
+    return len(records)
+
+
+operation_log_writer = OperationLogWriter()
+
+
+@atexit.register
+def flush_on_exit():
+    try:
+        operation_log_writer.flush()
+    except Exception:
+        # 未写入的记录仍在落盘文件中, 由后续进程补写
+        logger.error('退出时写入操作日志失败, error: {}'.format(traceback.format_exc()))
+
+
+def enqueue_operation_log(record):
+    """record中的时间已格式化为字符串; 未开启异步时直接写库"""
+    if getattr(settings, 'OPERATION_LOG_ASYNC', False):
+        operation_log_writer.put(record)
+    else:
+        write_records([record])
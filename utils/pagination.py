@@ -1,7 +1,117 @@
-from rest_framework.pagination import PageNumberPagination
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+import base64
+import datetime
+import hashlib
+import json
 
 
 class MyPagePagination(PageNumberPagination):
+    """
+    默认按页码分页; 传入cursor参数(第一页为空值)且数据有create_time字段时改用KeysetPagination游标分页
+    """
+    page_size = 10
+    page_size_query_param = 'size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.cursor_query_param in request.query_params:
+            try:
+                queryset.model._meta.get_field(KeysetPagination.time_field)
+                self.keyset = KeysetPagination()
+                return self.keyset.paginate_queryset(queryset, request, view)
+            except FieldDoesNotExist:
+                pass
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class KeysetPagination(BasePagination):
+    """
+    按(create_time, id)倒序的游标分页, 下一页从上一页最后一条记录之后开始查询, 翻到多深都只需按索引定位
+    游标为上一页最后一条记录的(create_time, id), 第一页传空的cursor参数
+    传入count参数时返回总数, 同一查询条件的总数缓存一段时间, 翻页时不再重复统计
+    """
     page_size = 10
     page_size_query_param = 'size'
     max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    count_cache_seconds = 60
+    time_field = 'create_time'
+    time_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_count(self, queryset):
+        """按查询语句缓存总数, 缓存期内的新增记录不计入"""
+        sql = str(queryset.order_by().query)
+        key = 'page_count:{}'.format(hashlib.md5(sql.encode('utf-8')).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_seconds)
+        return count
+
+    def encode_cursor(self, obj):
+        position = [getattr(obj, self.time_field).strftime(self.time_format), obj.pk]
+        return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            create_time, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            return datetime.datetime.strptime(create_time, self.time_format), int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound('无效的cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = self.get_count(queryset) if request.query_params.get(self.count_query_param) else None
+        queryset = queryset.order_by('-{}'.format(self.time_field), '-pk')
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            create_time, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(**{'{}__lt'.format(self.time_field): create_time}) |
+                                       Q(**{self.time_field: create_time, 'pk__lt': pk}))
+        # 多取一条判断是否还有下一页
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+        return url
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'next_cursor': self.encode_cursor(self.page[-1]) if self.has_next else None,
+            'results': data
+        }
+        if self.count is not None:
+            response['count'] = self.count
+        return Response(response)
@@ -1,25 +1,252 @@
 from chinese_calendar import is_holiday
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from functools import lru_cache
+
+import threading
+import numpy as np
+
+
+WORK_START_HOUR = 9  # 上班时间
+WORK_END_HOUR = 19  # 下班时间
+WORK_START_SECONDS = WORK_START_HOUR * 3600
+WORK_END_SECONDS = WORK_END_HOUR * 3600
+WORK_DAY_SECONDS = WORK_END_SECONDS - WORK_START_SECONDS  # 每日工作时长
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class _CalendarState(object):
+    """连续年份区间内的节假日位图及工作日前缀和, 构建后只读"""
+
+    def __init__(self, first_year, last_year, year_bitmaps):
+        self.first_year = first_year
+        self.last_year = last_year
+        self.base = date(first_year, 1, 1).toordinal()
+        self.holiday = np.concatenate([year_bitmaps[year] for year in range(first_year, last_year + 1)])
+        days = len(self.holiday)
+        # work_prefix[i]: base之后前i天中的工作日数
+        self.work_prefix = np.zeros(days + 1, dtype=np.int64)
+        np.cumsum(~self.holiday, out=self.work_prefix[1:])
+        # next_work[i]: 第i天及之后的第一个工作日, 区间内没有则为区间结束后的第一天
+        workdays = np.append(np.flatnonzero(~self.holiday), days)
+        self.next_work = workdays[np.searchsorted(workdays, np.arange(days + 1))]
+
+    def covers(self, first_year, last_year):
+        return self.first_year <= first_year and last_year <= self.last_year
+
+    def is_holiday(self, ordinal):
+        return bool(self.holiday[ordinal - self.base])
+
+    def next_workday(self, ordinal):
+        return int(self.next_work[ordinal - self.base]) + self.base
+
+    def workdays(self, start_ordinal, end_ordinal):
+        """[start_ordinal, end_ordinal)之间的工作日数"""
+        return int(self.work_prefix[end_ordinal - self.base] - self.work_prefix[start_ordinal - self.base])
+
+    def nth_workday(self, ordinal, n):
+        """ordinal当天及之后的第n个工作日"""
+        target = self.work_prefix[ordinal - self.base] + n
+        return int(np.searchsorted(self.work_prefix, target, side='left')) - 1 + self.base
+
+
+class WorkingCalendar(object):
+    """
+    进程级工作日历
+    每年的节假日只用chinese_calendar判断一次, 按需扩展年份区间
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._year_bitmaps = {}
+        self._state = None
+
+    def get_state(self, first_year, last_year):
+        state = self._state
+        if state is not None and state.covers(first_year, last_year):
+            return state
+        with self._lock:
+            state = self._state
+            if state is not None:
+                if state.covers(first_year, last_year):
+                    return state
+                first_year = min(first_year, state.first_year)
+                last_year = max(last_year, state.last_year)
+            for year in range(first_year, last_year + 1):
+                if year not in self._year_bitmaps:
+                    self._year_bitmaps[year] = self._build_year(year)
+            state = _CalendarState(first_year, last_year, self._year_bitmaps)
+            self._state = state
+        return state
+
+    @staticmethod
+    def _build_year(year):
+        base = date(year, 1, 1).toordinal()
+        days = date(year + 1, 1, 1).toordinal() - base
+        return np.array([is_holiday(date.fromordinal(base + i)) for i in range(days)], dtype=bool)
+
+    def holidays(self, year):
+        """某一年所有假期日"""
+        state = self.get_state(year, year)
+        start = date(year, 1, 1).toordinal() - state.base
+        end = date(year + 1, 1, 1).toordinal() - state.base
+        return [date.fromordinal(int(i) + state.base) for i in np.flatnonzero(state.holiday[start:end]) + start]
+
+    def working_hours(self, start, end):
+        """
+        计算两个时间点中间的工作时间(小时)
+        节假日只在开始、结束时间所在年份范围内识别, 与原逐年节假日列表的结果保持一致
+        """
+        start = _to_second_datetime(start)
+        end = _to_second_datetime(end)
+        first_year, last_year = start.year, end.year
+        state = self.get_state(first_year, last_year) if first_year <= last_year else None
+        window_start = date(first_year, 1, 1).toordinal()
+        window_end = date(last_year + 1, 1, 1).toordinal()
+
+        def next_workday(ordinal):
+            if state is None or not window_start <= ordinal < window_end:
+                return ordinal
+            return min(state.next_workday(ordinal), window_end)
+
+        start_d, start_s = start.toordinal(), start.hour * 3600 + start.minute * 60 + start.second
+        end_d, end_s = end.toordinal(), end.hour * 3600 + end.minute * 60 + end.second
+        # 开始时间晚于下班时间，则转到后一天开始计算
+        if start_s >= WORK_END_SECONDS:
+            start_d += 1
+            start_s = WORK_START_SECONDS
+        # 结束时间早于上班时间，转到前一天计算
+        if end_s <= WORK_START_SECONDS:
+            end_d -= 1
+            end_s = WORK_END_SECONDS
+        # 在节假日中，则转换成假期结束后第一天上班时间
+        workday = next_workday(start_d)
+        if workday != start_d:
+            start_d, start_s = workday, WORK_START_SECONDS
+        workday = next_workday(end_d)
+        if workday != end_d:
+            end_d, end_s = workday, WORK_START_SECONDS
+        if start_s < WORK_START_SECONDS:
+            start_s = WORK_START_SECONDS
+        if (start_d, start_s) >= (end_d, end_s):
+            return 0
+        if start_d == end_d:
+            result = end_s - start_s
+        else:
+            # 开始当天剩余工时 + 中间工作日工时 + 结束当天已用工时
+            result = (WORK_END_SECONDS - start_s) + WORK_DAY_SECONDS * state.workdays(start_d + 1, end_d) + \
+                     (end_s - WORK_START_SECONDS)
+        delta_seconds = result if result > 0 else 0
+        return round((delta_seconds / 3600), 2)
+
+    def working_hours_array(self, starts, ends):
+        """
+        working_hours的向量化版本
+        starts、ends为datetime64数组(或可广播的标量), 空值返回nan
+        """
+        present, result = self._working_seconds(starts, ends)
+        hours = np.full(present.shape, np.nan)
+        result_hours = np.round(result / 3600, 2)
+        # 恰好落在0.005小时边界上的值按内置round处理, 保证与逐条计算结果一致
+        ties = result % 36 == 18
+        if ties.any():
+            result_hours[ties] = [round(x, 2) for x in (result[ties] / 3600).tolist()]
+        hours[present] = result_hours
+        return hours
+
+    def working_seconds_array(self, starts, ends):
+        """两个时间点中间的工作时间(秒, 不取整), 空值返回0"""
+        present, result = self._working_seconds(starts, ends)
+        seconds = np.zeros(present.shape, dtype=np.int64)
+        seconds[present] = result
+        return seconds
+
+    def _working_seconds(self, starts, ends):
+        starts = np.asarray(starts, dtype='datetime64[s]')
+        ends = np.asarray(ends, dtype='datetime64[s]')
+        starts, ends = np.broadcast_arrays(starts, ends)
+        present = ~(np.isnat(starts) | np.isnat(ends))
+        if not present.any():
+            return present, np.zeros(0, dtype=np.int64)
+        starts, ends = starts[present], ends[present]
+        start_years = starts.astype('datetime64[Y]')
+        end_years = ends.astype('datetime64[Y]')
+        years = np.concatenate([start_years, end_years]).astype(np.int64) + 1970
+        state = self.get_state(int(years.min()), int(years.max()))
+        window_start = start_years.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+        window_end = (end_years + 1).astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+
+        def next_workday(ordinal):
+            inside = (window_start <= ordinal) & (ordinal < window_end)
+            index = np.clip(ordinal - state.base, 0, len(state.next_work) - 1)
+            return np.where(inside, np.minimum(state.next_work[index] + state.base, window_end), ordinal)
+
+        start_d, start_s = np.divmod(starts.astype(np.int64), 86400)
+        end_d, end_s = np.divmod(ends.astype(np.int64), 86400)
+        start_d += EPOCH_ORDINAL
+        end_d += EPOCH_ORDINAL
+        late = start_s >= WORK_END_SECONDS
+        start_d = start_d + late
+        start_s = np.where(late, WORK_START_SECONDS, start_s)
+        early = end_s <= WORK_START_SECONDS
+        end_d = end_d - early
+        end_s = np.where(early, WORK_END_SECONDS, end_s)
+        workday = next_workday(start_d)
+        start_s = np.where(workday != start_d, WORK_START_SECONDS, start_s)
+        start_d = workday
+        workday = next_workday(end_d)
+        end_s = np.where(workday != end_d, WORK_START_SECONDS, end_s)
+        end_d = workday
+        start_s = np.maximum(start_s, WORK_START_SECONDS)
+
+        last = len(state.work_prefix) - 1
+        middle = state.work_prefix[np.clip(end_d - state.base, 0, last)] - \
+            state.work_prefix[np.clip(start_d + 1 - state.base, 0, last)]
+        result = np.where(start_d == end_d, end_s - start_s,
+                          (WORK_END_SECONDS - start_s) + WORK_DAY_SECONDS * middle + (end_s - WORK_START_SECONDS))
+        valid = (start_d < end_d) | ((start_d == end_d) & (start_s < end_s))
+        return present, np.where(valid, np.maximum(result, 0), 0)
+
+    def skip_workdays(self, day, count):
+        """
+        从day当天开始数count个工作日, 返回最后一个工作日的后一天
+        原逐日推算在某年12月31日为工作日时不会再加载下一年的节假日, 之后的日期均按工作日计算, 这里保持一致
+        """
+        ordinal = day.toordinal()
+        while True:
+            year = date.fromordinal(ordinal).year
+            state = self.get_state(year, year)
+            year_end = date(year, 12, 31).toordinal()
+            left = state.workdays(ordinal, year_end + 1)
+            if count <= left:
+                ordinal = state.nth_workday(ordinal, count) + 1
+                break
+            count -= left
+            if not state.is_holiday(year_end):
+                ordinal = year_end + 1 + count
+                break
+            ordinal = year_end + 1
+        return day + timedelta(days=ordinal - day.toordinal())
+
+
+working_calendar = WorkingCalendar()
+
+
+def _to_second_datetime(value):
+    """转换成精确到秒的datetime"""
+    if isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day, value.hour, value.minute, value.second)
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
 
 
 def get_holiday(year, date_type):
     """得到某一年所有假期日"""
-    list_holiday = []
-    year = int(year)
-    for month in range(1, 13):
-        for day in range(1, 32):
-            try:
-                dt = date(year, month, day)
-            except:
-                break
-            if is_holiday(dt):
-                list_holiday.append('{}-{:02d}-{:02d}'.format(year, month, day))
+    list_holiday = working_calendar.holidays(int(year))
     if date_type == 'datetime':
-        list_holiday = list(map(lambda x: datetime.strptime(x, '%Y-%m-%d'), list_holiday))
+        return [datetime(d.year, d.month, d.day) for d in list_holiday]
     elif date_type == 'date':
-        list_holiday = list(map(lambda x: datetime.strptime(x, '%Y-%m-%d').date(), list_holiday))
-    return list_holiday
+        return list_holiday
+    return [d.strftime('%Y-%m-%d') for d in list_holiday]
 
 
 def calculate_datediff(start, end):
@@ -27,78 +254,12 @@ def calculate_datediff(start, end):
     计算两个时间点中间的工作时间
     每日工作时间：9:00-19:00
     """
-    if isinstance(start, datetime):
-        start = start.strftime('%Y-%m-%d %H:%M:%S')
-    if isinstance(end, datetime):
-        end = end.strftime('%Y-%m-%d %H:%M:%S')
-    if start[:4] == end[:4]:
-        list_holiday = get_holiday(end[:4], 'datetime')  # 后续从数据库查
-    else:
-        list_holiday = []
-        for year in range(int(start[:4]), int(end[:4]) + 1):
-            list_holiday = list_holiday + get_holiday(str(year), 'datetime')  # 后续从数据库查
-    result = 0
-    list_start = start.split(' ')
-    start = datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
-    start_d = datetime.strptime(list_start[0], '%Y-%m-%d')
-    list_end = end.split(' ')
-    end = datetime.strptime(end, '%Y-%m-%d %H:%M:%S')
-    end_d = datetime.strptime(list_end[0], '%Y-%m-%d')
-    # 判断开始时间，如果大于今天下班时间，则转到后一天开始计算
-    if list_start[1] >= '19:00:00':
-        start_d += timedelta(days=1)
-        start = start_d + timedelta(hours=9)
-        list_start[1] = '09:00:00'
-    # 结束时间小于上班时间，转到前一天计算
-    if list_end[1] <= '09:00:00':
-        end_d += timedelta(days=-1)
-        end = end_d + timedelta(hours=19)
-        list_end[1] = '19:00:00'
-    # 判断是否在节假日中,如果在，则转换成假期结束后第一天上班时间
-    if start_d in list_holiday:
-        while start_d in list_holiday:
-            start_d += timedelta(days=1)
-        start = start_d + timedelta(hours=9)
-        list_start[1] = '09:00:00'
-    if end_d in list_holiday:
-        while end_d in list_holiday:
-            end_d += timedelta(days=1)
-        end = end_d + timedelta(hours=9)
-        list_end[1] = '09:00:00'
-    if list_start[1] < '09:00:00':
-        start = start_d + timedelta(hours=9)
-    # 开始时间在午休，从下午13点开始
-    # if '12:00:00' < list_start[1] < '13:00:00':
-    #     start = start_d + timedelta(hours=13)
-    #     list_start[1] = '13:00:00'
-    # 结束时间在午休，截止到上午12点
-    # if '12:00:00' < list_end[1] < '13:00:00':
-    #     end = end_d + timedelta(hours=12)
-    #     list_end[1] = '12:00:00'
-    if start >= end:
-        return 0
-    # 开始结束在同一天
-    if start_d == end_d:
-        result = (end-start).total_seconds()
-        # if list_start[1] <= '12:00:00':
-        #     if list_end[1] >= '13:00:00':
-        #         result -= 3600
-    # 开始结束不在一天，排除中间的节假日
-    else:
-        # if list_start[1] <= '12:00:00':
-        #     result -= 3600
-        result += (start_d + timedelta(hours=19) - start).total_seconds()  # 今天下班时间-开始时间
-        start_d += timedelta(days=1)  # 下一日开始算
-        while start_d < end_d:
-            if start_d not in list_holiday:
-                result += 10 * 60 * 60  # 不是休息日，则加上每日工作时长
-            start_d += timedelta(days=1)
-        result += (end - (end_d + timedelta(hours=9))).total_seconds()  # 结束日减去上班前的时间
-        # if list_end[1] >= '13:00:00':
-        #     result -= 3600
-    delta_seconds = result if result > 0 else 0
-    hours = round((delta_seconds/3600), 2)
-    return hours
+    return working_calendar.working_hours(start, end)
+
+
+def calculate_datediff_array(starts, ends):
+    """calculate_datediff的向量化版本, 用于整列计算"""
+    return working_calendar.working_hours_array(starts, ends)
 
 
 # 根据预计工作时长和开始时间计算出合理的结束时间(跳过非工作时间)
@@ -118,17 +279,8 @@ def calculate_end_time(start_time, hours):
         weekdays = int(extra_hours // 10)
         remainder_hours = extra_hours % 10
         if weekdays > 0:
-            list_holiday = get_holiday(end.year, 'datetime')
-            for i in range(1, weekdays + 1):
-                if end_d in list_holiday:
-                    while end_d in list_holiday:
-                        end_d += timedelta(days=1)
-                        if end_d.year != end.year:
-                            list_holiday = get_holiday(end_d.year, 'datetime')
-                end_d += timedelta(days=1)
-            end = end_d + timedelta(hours=(9 + remainder_hours))
-        else:
-            end = end_d + timedelta(hours=(9 + remainder_hours))
+            end_d = working_calendar.skip_workdays(end_d, weekdays)
+        end = end_d + timedelta(hours=(9 + remainder_hours))
     return end
 
 
@@ -138,12 +290,19 @@ def calculate_recalibration_time(calibration_time, months):
     return recalibration_time
 
 
-# 计算校准到期日
+DUE_REMIND_DAYS = 30  # 距再校准日期不足该天数时提示尽快处理
+
+
+# 计算校准到期日, 读取时按当天日期计算
 def calculate_due_date(recalibration_time, module):
-    today_date = datetime.today().date()
-    recalibration_date = recalibration_time
-    delta_days = (recalibration_date - today_date).days
-    if delta_days < 30:
+    return get_due_date(datetime.today().date(), recalibration_time, module)
+
+
+# 以当天日期为key缓存, 同一天内相同的再校准日期只计算一次, 日期变化后旧的结果自然淘汰
+@lru_cache(maxsize=4096)
+def get_due_date(today_date, recalibration_time, module):
+    delta_days = (recalibration_time - today_date).days
+    if delta_days < DUE_REMIND_DAYS:
         if module == 'calibration':
             due_date = 'Please perform calibration ASAP'
         elif module == 'maintain':